@@ -2,12 +2,18 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import jensenshannon
+from scipy.special import rel_entr
 from datetime import datetime, date, timedelta
 import re
 import hashlib
+import hmac
 import time
+import os
+import threading
+import sqlite3
+from contextlib import closing
 import uuid
+import json
 import itertools
 import bcrypt
 import base64
@@ -16,7 +22,8 @@ from google.oauth2.service_account import Credentials
 import plotly.graph_objects as go
 import plotly.express as px
 import pytz
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # --- A. 定数と基本設定 ---
 st.set_page_config(layout="wide", page_title="Harmony Navigator", page_icon="🧭")
@@ -41,6 +48,10 @@ LONG_ELEMENTS = {
 ALL_ELEMENT_COLS = sorted([f's_element_{e}' for d in LONG_ELEMENTS.values() for e in d])
 Q_COLS = ['q_' + d for d in DOMAINS]
 S_COLS = ['s_' + d for d in DOMAINS]
+# 要素→領域の対応行列（行: ALL_ELEMENT_COLS の順, 列: DOMAINS の順）。深掘りモードの領域平均に使う
+ELEMENT_DOMAIN_MATRIX = np.array(
+    [[1.0 if col in {f's_element_{e}' for e in LONG_ELEMENTS[d]} else 0.0 for d in DOMAINS] for col in ALL_ELEMENT_COLS]
+)
 
 CAPTION_TEXT = "0: 全く当てはまらない | 25: あまり当てはまらない | 50: どちらとも言えない| 75: やや当てはまる | 100: 完全に当てはまる"
 
@@ -171,14 +182,25 @@ DEMOGRAPHIC_OPTIONS = {
     'country': ['未選択', '日本', 'アメリカ合衆国', 'その他']
 }
 # ゲーミフィケーション機能：アチーブメント定義
+# アチーブメント定義。'inputs' に条件が使う入力を宣言し、'condition' はその名前のキーワード引数で呼ばれる。
+# 入力: 'record' = 保存した1件の記録 (dict), 'streak' = 保存後の連続記録の状態 (dict), 'rhi' = ダッシュボードの RHI 計算結果 (dict)
+# 評価は、宣言した入力がそろったとき（記録の保存時、RHI の表示時）に、まだ解除されていないものだけを行う。
 ACHIEVEMENTS = {
-    'record_1': {'name': '最初の航海日誌', 'description': '最初の記録をつけました。', 'emoji': '🎉', 'condition': lambda df: len(df) >= 1},
-    'record_7': {'name': '航海士の習慣', 'description': '7日間、連続で記録をつけました。', 'emoji': '🗓️', 'condition': lambda df, streak: streak >= 7},
-    'record_30': {'name': '熟練の航海士', 'description': '30日間、連続で記録をつけました。', 'emoji': '📅', 'condition': lambda df, streak: streak >= 30},
-    'deep_dive_1': {'name': '深海への探求者', 'description': '初めてディープ・ダイブモードで記録しました。', 'emoji': '🔬', 'condition': lambda df: 'deep' in df['mode'].values},
-    'q_updated': {'name': '羅針盤の調整', 'description': '価値観（q_t）を更新しました。', 'emoji': '🧭', 'condition': lambda df: len(df.dropna(subset=Q_COLS, how='all')) > 1},
-    'rhi_plus': {'name': '順風満帆', 'description': '初めてRHIがプラスになりました。', 'emoji': '⛵', 'condition': lambda df, rhi_results: rhi_results and rhi_results.get('RHI', 0) > 0},
-    'balance_master': {'name': '調和の達人', 'description': '全てのドメインの充足度が70点以上になった日がありました。', 'emoji': '⚖️', 'condition': lambda df: (df[S_COLS] >= 70).all(axis=1).any()}
+    'record_1': {'name': '最初の航海日誌', 'description': '最初の記録をつけました。', 'emoji': '🎉',
+                 'inputs': ('record',), 'condition': lambda record: True},
+    'record_7': {'name': '航海士の習慣', 'description': '7日間、連続で記録をつけました。', 'emoji': '🗓️',
+                 'inputs': ('streak',), 'condition': lambda streak: streak['streak_current'] >= 7},
+    'record_30': {'name': '熟練の航海士', 'description': '30日間、連続で記録をつけました。', 'emoji': '📅',
+                  'inputs': ('streak',), 'condition': lambda streak: streak['streak_current'] >= 30},
+    'deep_dive_1': {'name': '深海への探求者', 'description': '初めてディープ・ダイブモードで記録しました。', 'emoji': '🔬',
+                    'inputs': ('record',), 'condition': lambda record: record.get('mode') == 'deep'},
+    # 価値観の設定（ガイド）の後に、q_t を含む記録をもう1件保存したとき
+    'q_updated': {'name': '羅針盤の調整', 'description': '価値観（q_t）を更新しました。', 'emoji': '🧭',
+                  'inputs': ('record',), 'condition': lambda record: any(pd.notna(record.get(col)) for col in Q_COLS)},
+    'rhi_plus': {'name': '順風満帆', 'description': '初めてRHIがプラスになりました。', 'emoji': '⛵',
+                 'inputs': ('rhi',), 'condition': lambda rhi: bool(rhi) and rhi.get('RHI', 0) > 0},
+    'balance_master': {'name': '調和の達人', 'description': '全てのドメインの充足度が70点以上になった日がありました。', 'emoji': '⚖️',
+                       'inputs': ('record',), 'condition': lambda record: all(pd.notna(record.get(col)) and record.get(col) >= 70 for col in S_COLS)},
 }
 # レベル2介入提案機能：介入レシピ定義
 INTERVENTION_RECIPES = {
@@ -226,15 +248,49 @@ INTERVENTION_RECIPES = {
 }
 
 # --- B. 暗号化エンジン ---
+# イベントログの暗号文の形式:
+#   v2: "v2:" + base64(nonce 16バイト || 暗号文 || HMAC-SHA256 タグ 32バイト)
+#       鍵はパスワードから scrypt（user_id をソルトに使う）で導出した暗号化用・認証用の2本。
+#       キーストリームは SHAKE-256(暗号化鍵 || nonce) で、レコードごとに独立しているため、
+#       まとめて（並列に）暗号化・復号できる。タグは "v2:" || nonce || 暗号文 に対する HMAC（Encrypt-then-MAC）。
+#   旧形式（接頭辞なし）: base64(平文 XOR SHA-256(パスワード) の繰り返し)。読み込み時に v2 へ移行する。
+LOG_CIPHER_V2_PREFIX = 'v2:'
+LOG_NONCE_BYTES = 16
+LOG_TAG_BYTES = 32
+LOG_KDF_SCRYPT_N = 2 ** 14
+LOG_KDF_PBKDF2_ITERATIONS = 200_000
+DECRYPTION_FAILED_TEXT = "[復号に失敗しました]"
+
+def derive_log_keys(password_bytes: bytes, user_id: str) -> tuple:
+    """パスワードからイベントログ用の (暗号化鍵, 認証鍵) を導出する。scrypt がない環境では PBKDF2 を使う"""
+    salt = f'harmony-navigator|event_log|{user_id}'.encode('utf-8')
+    if hasattr(hashlib, 'scrypt'):
+        key_material = hashlib.scrypt(password_bytes, salt=salt, n=LOG_KDF_SCRYPT_N, r=8, p=1, dklen=64)
+    else:
+        key_material = hashlib.pbkdf2_hmac('sha256', password_bytes, salt, LOG_KDF_PBKDF2_ITERATIONS, dklen=64)
+    return key_material[:32], key_material[32:]
+
+def _xor_buffers(data: bytes, keystream: np.ndarray) -> bytes:
+    return (np.frombuffer(data, dtype=np.uint8) ^ keystream).tobytes()
+
 class EncryptionManager:
-    def __init__(self, password: str):
+    # セッション内で保持する復号済みログの上限（超えたら作り直す）
+    MAX_CACHED_LOGS = 10000
+
+    def __init__(self, password: str, user_id: str = '', log_keys: tuple | None = None):
+        """log_keys に derive_log_keys の結果を渡すと、鍵導出を省略する（ログイン時にワーカーで導出済みの場合）"""
         self.password_bytes = password.encode('utf-8')
+        # 旧形式の復号用
         self.key = hashlib.sha256(self.password_bytes).digest()
+        self._key_array = np.frombuffer(self.key, dtype=np.uint8)
+        self._enc_key, self._mac_key = log_keys or derive_log_keys(self.password_bytes, user_id)
+        # 暗号文 -> 平文。EncryptionManager はセッションごとに作られるので、キャッシュもセッション単位
+        self._decrypted_cache = {}
 
     @staticmethod
-    def hash_password(password: str) -> str:
+    def hash_password(password: str, rounds: int = 12) -> str:
         password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
+        salt = bcrypt.gensalt(rounds)
         hashed_bytes = bcrypt.hashpw(password_bytes, salt)
         return hashed_bytes.decode('utf-8')
 
@@ -247,113 +303,457 @@ class EncryptionManager:
         except (ValueError, TypeError):
             return False
 
+    def _xor_with_key(self, data: bytes, offsets: np.ndarray | None = None) -> bytes:
+        """
+        旧形式: バイト列全体と鍵の繰り返しの XOR を numpy でまとめて計算する。
+        offsets を渡すと、連結した複数のペイロードそれぞれの先頭から鍵を当て直す（各バイトのペイロード内の位置）。
+        """
+        data_array = np.frombuffer(data, dtype=np.uint8)
+        positions = np.arange(len(data_array)) if offsets is None else offsets
+        return (data_array ^ self._key_array[positions % len(self._key_array)]).tobytes()
+
+    def _keystream(self, nonce: bytes, length: int) -> bytes:
+        return hashlib.shake_256(self._enc_key + nonce).digest(length)
+
+    def _tag(self, nonce: bytes, ciphertext: bytes) -> bytes:
+        return hmac.digest(self._mac_key, LOG_CIPHER_V2_PREFIX.encode('ascii') + nonce + ciphertext, 'sha256')
+
+    @staticmethod
+    def is_legacy_ciphertext(value) -> bool:
+        """空でない旧形式（v2 より前）の暗号文かどうか"""
+        return isinstance(value, str) and bool(value) and not value.startswith(LOG_CIPHER_V2_PREFIX)
+
     def encrypt_log(self, log_text: str) -> str:
         if not log_text:
             return ""
-        encrypted_bytes = bytes([b ^ self.key[i % len(self.key)] for i, b in enumerate(log_text.encode('utf-8'))])
-        return base64.b64encode(encrypted_bytes).decode('utf-8')
+        return self.encrypt_many([log_text])[0]
+
+    def encrypt_many(self, log_texts: list) -> list:
+        """複数のログを v2 形式でまとめて暗号化する（空のログは空文字列のまま）"""
+        plaintexts = [text.encode('utf-8') if text else b'' for text in log_texts]
+        nonces = [os.urandom(LOG_NONCE_BYTES) for _ in plaintexts]
+        keystream = np.frombuffer(b''.join(self._keystream(nonce, len(pt)) for nonce, pt in zip(nonces, plaintexts)), dtype=np.uint8)
+        ciphertext_buffer = _xor_buffers(b''.join(plaintexts), keystream)
+
+        results, start = [], 0
+        for nonce, plaintext in zip(nonces, plaintexts):
+            if not plaintext:
+                results.append("")
+                continue
+            ciphertext = ciphertext_buffer[start:start + len(plaintext)]
+            start += len(plaintext)
+            payload = nonce + ciphertext + self._tag(nonce, ciphertext)
+            results.append(LOG_CIPHER_V2_PREFIX + base64.b64encode(payload).decode('ascii'))
+        return results
 
     def decrypt_log(self, encrypted_log: str) -> str:
         if not encrypted_log or pd.isna(encrypted_log):
             return ""
-        try:
-            encrypted_bytes = base64.b64decode(encrypted_log.encode('utf-8'))
-            decrypted_bytes = bytes([b ^ self.key[i % len(self.key)] for i, b in enumerate(encrypted_bytes)])
-            return decrypted_bytes.decode('utf-8')
-        except Exception:
-            return "[復号に失敗しました]"
+        return self.decrypt_many([encrypted_log])[0]
+
+    def decrypt_many(self, encrypted_logs):
+        """
+        列全体をまとめて復号する。Series を渡すと同じインデックスの Series を、それ以外はリストを返す。
+        未復号のログだけを形式ごとに1つのバッファに連結して一度に XOR し、結果はセッション内にキャッシュする。
+        v2 はタグを検証し、改ざん・鍵違いのものは復号しない。
+        """
+        values = list(encrypted_logs)
+        pending = list(dict.fromkeys(
+            value for value in values if isinstance(value, str) and value and value not in self._decrypted_cache
+        ))
+        if len(self._decrypted_cache) + len(pending) > self.MAX_CACHED_LOGS:
+            self._decrypted_cache.clear()
+
+        legacy, current = {}, {}
+        for value in pending:
+            try:
+                if value.startswith(LOG_CIPHER_V2_PREFIX):
+                    payload = base64.b64decode(value[len(LOG_CIPHER_V2_PREFIX):].encode('ascii'), validate=True)
+                    nonce, ciphertext, tag = payload[:LOG_NONCE_BYTES], payload[LOG_NONCE_BYTES:-LOG_TAG_BYTES], payload[-LOG_TAG_BYTES:]
+                    if len(payload) < LOG_NONCE_BYTES + LOG_TAG_BYTES or not hmac.compare_digest(tag, self._tag(nonce, ciphertext)):
+                        raise ValueError("authentication failed")
+                    current[value] = (nonce, ciphertext)
+                else:
+                    legacy[value] = base64.b64decode(value.encode('utf-8'))
+            except Exception:
+                self._decrypted_cache[value] = DECRYPTION_FAILED_TEXT
+
+        decrypted = {}
+        if legacy:
+            payloads = list(legacy.values())
+            lengths = np.array([len(payload) for payload in payloads], dtype=np.int64)
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            offsets = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+            buffer = self._xor_with_key(b''.join(payloads), offsets)
+            decrypted.update({value: buffer[s:s + n] for value, s, n in zip(legacy, starts, lengths)})
+        if current:
+            ciphertexts = [ciphertext for _, ciphertext in current.values()]
+            keystream = np.frombuffer(b''.join(self._keystream(nonce, len(ct)) for nonce, ct in current.values()), dtype=np.uint8)
+            buffer = _xor_buffers(b''.join(ciphertexts), keystream)
+            start = 0
+            for value, ciphertext in zip(current, ciphertexts):
+                decrypted[value] = buffer[start:start + len(ciphertext)]
+                start += len(ciphertext)
+
+        for value, plaintext in decrypted.items():
+            try:
+                self._decrypted_cache[value] = plaintext.decode('utf-8')
+            except UnicodeDecodeError:
+                self._decrypted_cache[value] = DECRYPTION_FAILED_TEXT
+
+        results = [
+            (self._decrypted_cache.get(value, DECRYPTION_FAILED_TEXT) if value else "") if isinstance(value, str)
+            else "" if pd.isna(value) else DECRYPTION_FAILED_TEXT
+            for value in values
+        ]
+        if isinstance(encrypted_logs, pd.Series):
+            return pd.Series(results, index=encrypted_logs.index, dtype=object)
+        return results
+
+    def upgrade_ciphertexts(self, encrypted_logs) -> dict:
+        """旧形式の暗号文を v2 に再暗号化し、{旧暗号文: v2 暗号文} を返す（復号できないものは含めない）"""
+        legacy = list(dict.fromkeys(value for value in encrypted_logs if self.is_legacy_ciphertext(value)))
+        if not legacy:
+            return {}
+        plaintexts = self.decrypt_many(legacy)
+        upgradable = [(value, text) for value, text in zip(legacy, plaintexts) if text != DECRYPTION_FAILED_TEXT]
+        upgraded = self.encrypt_many([text for _, text in upgradable])
+        for (_, text), new_value in zip(upgradable, upgraded):
+            self._decrypted_cache[new_value] = text
+        return {value: new_value for (value, _), new_value in zip(upgradable, upgraded)}
+
+# --- B-2. パスワード処理のワーカープール ---
+# bcrypt と鍵導出（scrypt）は GIL を解放するので、スクリプトスレッドの外のスレッドプールで実行する。
+# ログイン時は bcrypt の照合と鍵導出を同時に走らせ、待ち時間を2つの合計ではなく長い方だけにする。
+# 導出した鍵は EncryptionManager としてセッションに保持し、再実行（rerun）のたびに導出し直さない。
+class PasswordHashPool:
+    def __init__(self, max_workers: int = 4, bcrypt_rounds: int = 12, history_size: int = 1000):
+        self.bcrypt_rounds = bcrypt_rounds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hash')
+        self._lock = threading.Lock()
+        # 1リクエストごとの {'op', 'wait_ms', 'run_ms'}（キュー待ちと実行時間を分けて記録する）
+        self._timings = deque(maxlen=history_size)
+
+    def _submit(self, op: str, fn, *args):
+        submitted_at = time.perf_counter()
+
+        def timed():
+            started_at = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self._timings.append({
+                        'op': op,
+                        'wait_ms': (started_at - submitted_at) * 1000.0,
+                        'run_ms': (finished_at - started_at) * 1000.0,
+                    })
+        return self._executor.submit(timed)
+
+    def hash_password(self, password: str) -> str:
+        return self._submit('bcrypt_hash', EncryptionManager.hash_password, password, self.bcrypt_rounds).result()
+
+    def check_password(self, password: str, hashed_password: str) -> bool:
+        return self._submit('bcrypt_check', EncryptionManager.check_password, password, hashed_password).result()
+
+    def register(self, password: str, user_id: str) -> tuple:
+        """新規登録: パスワードのハッシュと鍵導出を並行して行い、(ハッシュ, EncryptionManager) を返す"""
+        hash_future = self._submit('bcrypt_hash', EncryptionManager.hash_password, password, self.bcrypt_rounds)
+        keys_future = self._submit('derive_log_keys', derive_log_keys, password.encode('utf-8'), user_id)
+        return hash_future.result(), EncryptionManager(password, user_id, log_keys=keys_future.result())
+
+    def login(self, password: str, hashed_password: str, user_id: str) -> EncryptionManager | None:
+        """ログイン: 照合と鍵導出を並行して行い、成功すれば EncryptionManager を、失敗すれば None を返す"""
+        check_future = self._submit('bcrypt_check', EncryptionManager.check_password, password, hashed_password)
+        keys_future = self._submit('derive_log_keys', derive_log_keys, password.encode('utf-8'), user_id)
+        if not check_future.result():
+            keys_future.cancel()
+            return None
+        return EncryptionManager(password, user_id, log_keys=keys_future.result())
+
+    def stats(self) -> dict:
+        """処理ごとの件数と所要時間（ミリ秒）の中央値・95パーセンタイル・最大値"""
+        with self._lock:
+            timings = list(self._timings)
+        summary = {}
+        for op in sorted({timing['op'] for timing in timings}):
+            run_ms = np.array([t['run_ms'] for t in timings if t['op'] == op])
+            wait_ms = np.array([t['wait_ms'] for t in timings if t['op'] == op])
+            summary[op] = {
+                'count': len(run_ms),
+                'run_p50_ms': float(np.percentile(run_ms, 50)), 'run_p95_ms': float(np.percentile(run_ms, 95)),
+                'run_max_ms': float(run_ms.max()), 'wait_p95_ms': float(np.percentile(wait_ms, 95)),
+            }
+        return summary
+
+@st.cache_resource
+def get_password_hash_pool() -> PasswordHashPool:
+    """
+    Secrets の [security] 設定で調整できる。
+    例: bcrypt_rounds = 12, password_hash_workers = 4
+    """
+    try:
+        security_config = dict(st.secrets.get("security", {}))
+    except FileNotFoundError:
+        security_config = {}
+    return PasswordHashPool(
+        max_workers=int(security_config.get("password_hash_workers", 4)),
+        bcrypt_rounds=int(security_config.get("bcrypt_rounds", 12)),
+    )
 
 # --- C. コア計算 & ユーティリティ関数 ---
-def calculate_s_domains_from_row(row: pd.Series) -> pd.Series:
-    s_domain_scores = {}
-    
-    for domain, elements in LONG_ELEMENTS.items():
-        domain_scores_list = []
-        for e in elements:
-            col = f's_element_{e}'
-            if col in row and pd.notna(row[col]):
-                domain_scores_list.append(row[col])
-        
-        if domain_scores_list:
-            s_domain_scores['s_' + domain] = int(round(np.mean(domain_scores_list)))
-        else:
-            s_domain_scores['s_' + domain] = row.get('s_' + domain, np.nan)
-            
-    return pd.Series(s_domain_scores)
+def masked_domain_means(elements: np.ndarray, fallback: np.ndarray) -> np.ndarray:
+    """
+    要素スコア（行 × ALL_ELEMENT_COLS、未記入は NaN）から、領域ごとの平均（四捨五入）を行列演算で求める。
+    記入された要素だけで平均をとり、要素が1つも記入されていない領域は fallback（行 × DOMAINS）の値を使う。
+    """
+    elements = np.asarray(elements, dtype=float)
+    answered = ~np.isnan(elements)
+    element_sums = np.where(answered, elements, 0.0) @ ELEMENT_DOMAIN_MATRIX
+    element_counts = answered.astype(float) @ ELEMENT_DOMAIN_MATRIX
+    with np.errstate(invalid='ignore', divide='ignore'):
+        domain_means = np.round(element_sums / element_counts)
+    return np.where(element_counts > 0, domain_means, np.asarray(fallback, dtype=float))
+
+def deep_domain_scores(df: pd.DataFrame) -> np.ndarray:
+    """深掘りモードの行の s_ 列（行 × S_COLS）。保存時と calculate_metrics の両方で使う"""
+    # 保存前のレコードは pd.NA を含む object 型なので、欠損を NaN にそろえてから渡す
+    return masked_domain_means(
+        df.reindex(columns=ALL_ELEMENT_COLS).astype('Float64').to_numpy(dtype=float, na_value=np.nan),
+        df.reindex(columns=S_COLS).astype('Float64').to_numpy(dtype=float, na_value=np.nan),
+    )
 
-@st.cache_data
 def calculate_metrics(df: pd.DataFrame, alpha: float = 0.6) -> pd.DataFrame:
+    """
+    全行の S（充足度）・U（一致度）・H（調和度）を行列演算でまとめて計算する。
+    深掘りモードの行は、要素スコアの領域平均（四捨五入）で s_ 列を置き換える。
+    """
     df_copy = df.copy()
     if df_copy.empty:
         return df_copy
 
-    def get_s_domains_based_on_mode(row):
-        if row.get('mode') == 'deep':
-            return calculate_s_domains_from_row(row)
-        else:
-            return row[S_COLS]
+    # 読み込み時の UInt8 は、計算・グラフ描画の前に float にそろえる
+    numeric_cols = [c for c in SCORE_COLS if c in df_copy.columns]
+    df_copy[numeric_cols] = df_copy[numeric_cols].astype(float)
 
-    s_domain_updates = df_copy.apply(get_s_domains_based_on_mode, axis=1)
-    df_copy[S_COLS] = s_domain_updates
+    # 深掘りモード: 記入された要素だけの平均を、要素→領域の対応行列で一度に求める
+    if 'mode' in df_copy.columns:
+        is_deep = (df_copy['mode'] == 'deep').fillna(False).to_numpy(dtype=bool)
+        if is_deep.any():
+            # 要素が1つも記入されていない領域は、保存されている s_ の値をそのまま使う
+            df_copy.loc[is_deep, S_COLS] = deep_domain_scores(df_copy.loc[is_deep])
 
     for col in Q_COLS + S_COLS:
          if col in df_copy.columns:
             df_copy[col] = df_copy[col].fillna(0)
     
-    s_vectors_normalized = df_copy[S_COLS].values / 100.0
-    q_vectors = df_copy[Q_COLS].values / 100.0
-    
-    df_copy['S'] = np.nansum(q_vectors * s_vectors_normalized, axis=1)
+    q_raw = df_copy[Q_COLS].to_numpy(dtype=float)
+    s_raw = df_copy[S_COLS].to_numpy(dtype=float)
     
-    def calculate_unity(row):
-        q_vec = row[Q_COLS].values.astype(float)
-        s_vec_raw = row[S_COLS].values.astype(float)
-        
-        if np.sum(q_vec) == 0: return 0.0
-        q_vec_norm = q_vec / np.sum(q_vec)
-        
-        if np.sum(s_vec_raw) == 0: return 0.0
-        s_tilde = s_vec_raw / np.sum(s_vec_raw)
-        
-        jsd_sqrt = jensenshannon(q_vec_norm, s_tilde)
-        jsd = float(jsd_sqrt) ** 2
-        return 1.0 - jsd
-
-    df_copy['U'] = df_copy.apply(calculate_unity, axis=1)
+    df_copy['S'], df_copy['U'] = harmony_components(q_raw, s_raw)
     df_copy['H'] = alpha * df_copy['S'] + (1 - alpha) * df_copy['U']
     
     return df_copy
 
-def calculate_ahp_weights(comparisons: dict, items: list) -> np.ndarray:
+def harmony_components(q_raw: np.ndarray, s_raw: np.ndarray) -> tuple:
+    """
+    q_・s_ の配列（最後の軸が領域）から S と U を求める。先頭の軸はいくつあってもよい。
+    U = 1 - JSD(q, s)（scipy の jensenshannon の2乗と同じ定義、自然対数）。q か s の合計が 0 の行は U = 0。
+    """
+    S = np.nansum((q_raw / 100.0) * (s_raw / 100.0), axis=-1)
+    q_total = q_raw.sum(axis=-1, keepdims=True)
+    s_total = s_raw.sum(axis=-1, keepdims=True)
+    valid = (q_total[..., 0] != 0) & (s_total[..., 0] != 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = q_raw / q_total
+        r = s_raw / s_total
+    m = (p + r) / 2.0
+    jsd = (rel_entr(p, m).sum(axis=-1) + rel_entr(r, m).sum(axis=-1)) / 2.0
+    return S, np.where(valid, 1.0 - jsd, 0.0)
+
+# AHP の一対比較行列: 勝った方を 3、負けた方を 1/3 とする
+AHP_PREFERENCE_RATIO = 3.0
+# Saaty のランダム整合度指標 RI（n=1..10）
+AHP_RANDOM_INDEX = {1: 0.0, 2: 0.0, 3: 0.58, 4: 0.90, 5: 1.12, 6: 1.24, 7: 1.32, 8: 1.41, 9: 1.45, 10: 1.49}
+# 勝ち負けだけ（3 と 1/3）の比較では、完全に推移的な回答でも 7 項目で CR ≈ 0.11 になるため、
+# 一般的な 0.1 ではなく、矛盾（三すくみ）が1つ入ると超える 0.2 を警告の目安にする
+AHP_CR_WARNING = 0.2
+
+def _comparison_components(comparisons: dict, items: list) -> list:
+    """回答済みの組をつないだグラフの連結成分ごとに、項目の番号を返す"""
+    item_map = {item: i for i, item in enumerate(items)}
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for item1, item2 in comparisons:
+        parent[find(item_map[item1])] = find(item_map[item2])
+    components = {}
+    for i in range(len(items)):
+        components.setdefault(find(i), []).append(i)
+    return list(components.values())
+
+def build_comparison_matrix(comparisons: dict, items: list, harker: bool = False) -> np.ndarray:
+    """
+    {(item1, item2): 勝った方} から逆数対称な一対比較行列を作る。
+    未回答の組は 1（同等）とみなす。harker=True では Harker 法に従い、未回答の組を 0 にして
+    対角成分を「1 + その行の未回答数」にする（回答済みの組だけから重みを推定できる）。
+    回答のグラフがつながっていない間は Harker 法が使えないため、同等とみなす方法で作る。
+    """
     n = len(items)
-    matrix = np.ones((n, n), dtype=float)
+    harker = harker and len(_comparison_components(comparisons, items)) == 1
+    matrix = np.zeros((n, n), dtype=float) if harker else np.ones((n, n), dtype=float)
     item_map = {item: i for i, item in enumerate(items)}
 
     for (item1, item2), winner in comparisons.items():
         i, j = item_map[item1], item_map[item2]
         if winner == item1:
-            matrix[i, j] = 3.0
-            matrix[j, i] = 1.0 / 3.0
+            matrix[i, j] = AHP_PREFERENCE_RATIO
+            matrix[j, i] = 1.0 / AHP_PREFERENCE_RATIO
         elif winner == item2:
-            matrix[i, j] = 1.0 / 3.0
-            matrix[j, i] = 3.0
-
-    eigenvalues, eigenvectors = np.linalg.eig(matrix)
-    max_eigenvalue_index = np.argmax(np.real(eigenvalues))
-    principal_eigenvector = np.real(eigenvectors[:, max_eigenvalue_index])
-    weights = principal_eigenvector / np.sum(principal_eigenvector)
-    weights = np.clip(weights, 0, None)
-    if weights.sum() == 0:
-        weights = np.ones_like(weights) / len(weights)
-    
+            matrix[i, j] = 1.0 / AHP_PREFERENCE_RATIO
+            matrix[j, i] = AHP_PREFERENCE_RATIO
+        elif harker:
+            matrix[i, j] = matrix[j, i] = 1.0
+    if harker:
+        np.fill_diagonal(matrix, 0.0)
+        np.fill_diagonal(matrix, 1.0 + (n - 1) - np.count_nonzero(matrix, axis=1))
+    return matrix
+
+def solve_ahp(matrices: np.ndarray, method: str = 'power', tol: float = 1e-12, max_iter: int = 200) -> tuple:
+    """
+    一対比較行列（(n, n) または (B, n, n)）から、重み・最大固有値・整合比 CR をまとめて求める。
+    method='power' は幾何平均を初期値にしたべき乗法で主固有ベクトルを求め、
+    method='geometric' は行の幾何平均（対数最小二乗の近似解）をそのまま使う。
+    正の行列なので主固有ベクトルは正で、べき乗法は必ず収束する（Perron-Frobenius）。
+    Harker 法の行列（未回答の組が 0、対角が正）も、回答のグラフがつながっていれば同様に収束する。
+    """
+    matrices = np.asarray(matrices, dtype=float)
+    single = matrices.ndim == 2
+    if single:
+        matrices = matrices[None]
+    if matrices.ndim != 3 or matrices.shape[1] != matrices.shape[2]:
+        raise ValueError(f"一対比較行列の形が不正です: {matrices.shape}")
+    diagonals = np.diagonal(matrices, axis1=1, axis2=2)
+    if not np.all(np.isfinite(matrices)) or np.any(matrices < 0) or np.any(diagonals <= 0):
+        raise ValueError("一対比較行列の要素は有限の非負値で、対角成分は正である必要があります。")
+    if method not in ('power', 'geometric'):
+        raise ValueError(f"未対応の method です: {method}")
+
+    n = matrices.shape[1]
+    # 幾何平均は値のある（0 でない）成分だけでとる
+    known = matrices > 0
+    weights = np.exp(np.where(known, np.log(np.where(known, matrices, 1.0)), 0.0).sum(axis=2) / known.sum(axis=2))
+    weights /= weights.sum(axis=1, keepdims=True)
+    if method == 'power':
+        # 収束した行列はそこで止め、まとめて解いても1つずつ解いても同じ結果になるようにする
+        active = np.ones(len(matrices), dtype=bool)
+        for _ in range(max_iter):
+            updated = np.einsum('bij,bj->bi', matrices[active], weights[active])
+            updated /= updated.sum(axis=1, keepdims=True)
+            converged = np.max(np.abs(updated - weights[active]), axis=1) < tol
+            weights[active] = updated
+            active[np.flatnonzero(active)[converged]] = False
+            if not active.any():
+                break
+
+    # Aw = λw の成分ごとの比の平均を最大固有値の推定値とする（固有ベクトルなら全成分で一致する）
+    lambda_max = (np.einsum('bij,bj->bi', matrices, weights) / weights).mean(axis=1)
+    random_index = AHP_RANDOM_INDEX.get(n, 1.49)
+    if n > 2 and random_index > 0:
+        consistency_ratio = np.maximum((lambda_max - n) / (n - 1), 0.0) / random_index
+    else:
+        consistency_ratio = np.zeros(len(matrices))
+
+    if single:
+        return weights[0], lambda_max[0], consistency_ratio[0]
+    return weights, lambda_max, consistency_ratio
+
+def round_weights_to_percent(weights: np.ndarray) -> np.ndarray:
+    """重み（合計 1）を合計がちょうど 100 になる整数に丸める。端数は最大の項目で調整する"""
+    weights = np.atleast_2d(weights)
     int_weights = (weights * 100).round().astype(int)
-    diff = 100 - np.sum(int_weights)
-    if diff != 0:
-        int_weights[np.argmax(int_weights)] += diff
-        
+    diff = 100 - int_weights.sum(axis=1)
+    int_weights[np.arange(len(int_weights)), np.argmax(int_weights, axis=1)] += diff
     return int_weights
 
-def analyze_discrepancy(df_processed: pd.DataFrame):
+def calculate_ahp_weights_batch(comparison_sets: list, items: list) -> tuple:
+    """
+    複数の回答セット（ユーザーごとの comparisons）をまとめて解き、
+    (整数の重み (B, n), 整合比 (B,)) を返す。q_t の一括再計算用。
+    """
+    if not comparison_sets:
+        return np.zeros((0, len(items)), dtype=int), np.zeros(0)
+    matrices = np.stack([build_comparison_matrix(comparisons, items) for comparisons in comparison_sets])
+    weights, _, consistency_ratio = solve_ahp(matrices)
+    return round_weights_to_percent(weights), consistency_ratio
+
+def calculate_ahp_consistency(comparisons: dict, items: list, harker: bool = False) -> float:
+    """回答の整合比 CR（0 に近いほど矛盾が少ない）"""
+    return float(solve_ahp(build_comparison_matrix(comparisons, items, harker=harker))[2])
+
+def calculate_ahp_weights(comparisons: dict, items: list, harker: bool = False) -> np.ndarray:
+    weights, _, _ = solve_ahp(build_comparison_matrix(comparisons, items, harker=harker))
+    return round_weights_to_percent(weights)[0]
+
+# 適応型ウィザード: 直近 AHP_STABLE_ROUNDS 回の回答で順位が変わらず、
+# 重みの変化が AHP_STABLE_TOLERANCE ポイント以内に収まったら質問を打ち切る
+AHP_STABLE_ROUNDS = 3
+AHP_STABLE_TOLERANCE = 3
+
+def is_ahp_ranking_stable(comparisons: dict, items: list, rounds: int = AHP_STABLE_ROUNDS,
+                          tolerance: int = AHP_STABLE_TOLERANCE) -> bool:
+    """回答順に重みを推定し直し、直近 rounds 回の回答で順位と重みが安定しているかを返す"""
+    answered = list(comparisons.items())
+    if len(answered) <= rounds or len(_comparison_components(comparisons, items)) > 1:
+        return False
+    # 直近 rounds+1 個の時点（回答の途中経過）の重みを、まとめて解く
+    prefixes = [dict(answered[:k]) for k in range(len(answered) - rounds, len(answered) + 1)]
+    matrices = np.stack([build_comparison_matrix(prefix, items, harker=True) for prefix in prefixes])
+    weights, _, _ = solve_ahp(matrices)
+    int_weights = round_weights_to_percent(weights)
+    rankings = np.argsort(-weights, axis=1, kind='stable')
+    return bool(np.all(rankings == rankings[-1]) and np.abs(int_weights - int_weights[-1]).max() <= tolerance)
+
+def select_next_ahp_pair(comparisons: dict, items: list) -> tuple | None:
+    """
+    次に聞くべき組を返す。順位が安定した（またはすべて聞き終えた）ら None。
+    回答のグラフがつながるまでは、まだ回答の少ない項目どうしを別の成分から選ぶ。
+    つながった後は、現在の推定で重みが最も近い（順位が最も不確かな）未回答の組を選ぶ。
+    """
+    remaining = [pair for pair in itertools.combinations(items, 2)
+                 if pair not in comparisons and pair[::-1] not in comparisons]
+    if not remaining or is_ahp_ranking_stable(comparisons, items):
+        return None
+
+    item_map = {item: i for i, item in enumerate(items)}
+    degree = np.zeros(len(items), dtype=int)
+    for item1, item2 in comparisons:
+        degree[item_map[item1]] += 1
+        degree[item_map[item2]] += 1
+
+    components = _comparison_components(comparisons, items)
+    if len(components) > 1:
+        component_of = {i: c for c, members in enumerate(components) for i in members}
+        bridging = [pair for pair in remaining if component_of[item_map[pair[0]]] != component_of[item_map[pair[1]]]]
+        return min(bridging, key=lambda pair: degree[item_map[pair[0]]] + degree[item_map[pair[1]]])
+
+    weights, _, _ = solve_ahp(build_comparison_matrix(comparisons, items, harker=True))
+    log_weights = np.log(weights)
+
+    def closeness(pair):
+        i, j = item_map[pair[0]], item_map[pair[1]]
+        return (abs(log_weights[i] - log_weights[j]), degree[i] + degree[j])
+
+    return min(remaining, key=closeness)
+
+def analyze_discrepancy(df_processed: pd.DataFrame, gap_std: float = None):
+    """gap_std を渡すと、ズレの標準偏差を計算し直さずにそれを使う（DailySummary.gap_stats の値）"""
     df_analysis = df_processed.dropna(subset=['H', 'g_happiness']).copy()
     
     if df_analysis.empty:
@@ -390,8 +790,10 @@ def analyze_discrepancy(df_processed: pd.DataFrame):
                     素晴らしいスタートです！
                     """)
     else:
-        df_analysis['gap'] = df_analysis['g_happiness'] - (df_analysis['H'] * 100.0)
-        std_gap = df_analysis['gap'].std()
+        if gap_std is None:
+            df_analysis['gap'] = df_analysis['g_happiness'] - (df_analysis['H'] * 100.0)
+            gap_std = df_analysis['gap'].std()
+        std_gap = gap_std
         dynamic_threshold = max(15, 1.0 * std_gap) 
 
         with st.expander("▼ これは、あなたの過去データに基づいた統計的診断です", expanded=True):
@@ -424,46 +826,215 @@ def calculate_rhi_metrics(df_period: pd.DataFrame, lambda_rhi: float, gamma_rhi:
     frac_below = (df_period['H'] < tau_rhi).mean()
     rhi = mean_H - (lambda_rhi * std_H) - (gamma_rhi * frac_below)
     return {'mean_H': mean_H, 'std_H': std_H, 'frac_below': frac_below, 'RHI': rhi}
-def generate_intervention_proposal(df_period: pd.DataFrame, rhi_results: dict):
+
+def _prefix_sums(values: np.ndarray) -> np.ndarray:
+    """先頭に 0 の行を足した累積和。区間 [i, j) の合計は out[j] - out[i] で求まる"""
+    out = np.zeros((len(values) + 1,) + values.shape[1:], dtype=values.dtype)
+    np.cumsum(values, axis=0, out=out[1:])
+    return out
+
+class DailySummary:
+    """
+    ダッシュボード用に、日ごとの H・S・U と累積の集計（合計・二乗和・閾値未満の日数・s_ 列の積和）を
+    まとめて持つ要約表。直近 k 日の統計は累積値の差から O(1) で引ける。
+    入力は calculate_metrics の結果を日付順に並べたもの。
+    """
+    TAU_GRID = np.round(np.linspace(0.0, 1.0, 21), 2)
+
+    def __init__(self, df_processed: pd.DataFrame):
+        self.n = len(df_processed)
+        self.daily = df_processed.reindex(columns=['date', 'H', 'S', 'U']).reset_index(drop=True)
+        h = df_processed['H'].to_numpy(dtype=float) if 'H' in df_processed.columns else np.full(self.n, np.nan)
+        s = df_processed.reindex(columns=S_COLS).to_numpy(dtype=float)
+        g = df_processed['g_happiness'].to_numpy(dtype=float) if 'g_happiness' in df_processed.columns else np.full(self.n, np.nan)
+        self._h = h
+
+        # 桁落ちを防ぐため、H と ズレ(G-H) は全期間の平均を引いてから二乗和をとる
+        self._h_center = float(np.nanmean(h)) if self.n else 0.0
+        h_centered = h - self._h_center
+        self._cum_h = _prefix_sums(h_centered)
+        self._cum_h2 = _prefix_sums(h_centered ** 2)
+        self._cum_below = _prefix_sums((h[:, None] < self.TAU_GRID).astype(np.int64))
+
+        self._cum_s = _prefix_sums(s)
+        self._cum_ss = _prefix_sums(s[:, :, None] * s[:, None, :])
+
+        gap = g - h * 100.0
+        gap_valid = ~np.isnan(gap)
+        self._gap_center = float(gap[gap_valid].mean()) if gap_valid.any() else 0.0
+        gap_centered = np.where(gap_valid, gap - self._gap_center, 0.0)
+        self._cum_gap_n = _prefix_sums(gap_valid.astype(np.int64))
+        self._cum_gap = _prefix_sums(gap_centered)
+        self._cum_gap2 = _prefix_sums(gap_centered ** 2)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self._h, self._cum_h, self._cum_h2, self._cum_below, self._cum_s, self._cum_ss,
+                  self._cum_gap_n, self._cum_gap, self._cum_gap2]
+        return sum(a.nbytes for a in arrays) + int(self.daily.memory_usage(index=True, deep=True).sum())
+
+    def _window(self, cum: np.ndarray, k: int):
+        return cum[self.n] - cum[self.n - k]
+
+    def rhi(self, k: int, lambda_rhi: float, gamma_rhi: float, tau_rhi: float) -> dict:
+        """直近 k 日の calculate_rhi_metrics と同じ結果を返す"""
+        k = min(k, self.n)
+        if k == 0:
+            return {'mean_H': 0, 'std_H': 0, 'frac_below': 0, 'RHI': 0}
+        sum_h = self._window(self._cum_h, k)
+        mean_H = self._h_center + sum_h / k
+        std_H = float(np.sqrt(max(self._window(self._cum_h2, k) / k - (sum_h / k) ** 2, 0.0))) if k > 1 else 0
+        tau_index = np.flatnonzero(np.isclose(self.TAU_GRID, tau_rhi, rtol=0.0, atol=1e-9))
+        if tau_index.size:
+            frac_below = self._window(self._cum_below, k)[tau_index[0]] / k
+        else:
+            # 刻みにない閾値は、その期間の H から直接数える（全期間の累積は作らない）
+            frac_below = float(np.mean(self._h[self.n - k:] < tau_rhi))
+        rhi = mean_H - (lambda_rhi * std_H) - (gamma_rhi * frac_below)
+        return {'mean_H': mean_H, 'std_H': std_H, 'frac_below': frac_below, 'RHI': rhi}
+
+    def _cum_below_for(self, tau_rhi: float) -> np.ndarray:
+        """閾値 tau 未満の日数の累積。刻みにない閾値はその場で1回だけ累積をとる"""
+        tau_index = np.flatnonzero(np.isclose(self.TAU_GRID, tau_rhi, rtol=0.0, atol=1e-9))
+        if tau_index.size:
+            return self._cum_below[:, tau_index[0]]
+        return _prefix_sums((self._h < tau_rhi).astype(np.int64))
+
+    def rolling_rhi(self, k: int, lambda_rhi: float, gamma_rhi: float, tau_rhi: float, min_periods: int = None) -> pd.DataFrame:
+        """
+        各日を末尾とする k 日窓の mean_H・std_H・frac_below・RHI を、累積値の差から全日まとめて求める。
+        各行は、その日までの直近 k 日に calculate_rhi_metrics を適用した結果と同じ。
+        窓の日数が min_periods（既定は k）に満たない日は NaN にする。
+        """
+        k = max(int(k), 1)
+        min_periods = k if min_periods is None else max(int(min_periods), 1)
+        ends = np.arange(1, self.n + 1)
+        starts = np.maximum(ends - k, 0)
+        counts = (ends - starts).astype(float)
+
+        sum_h = self._cum_h[ends] - self._cum_h[starts]
+        sum_h2 = self._cum_h2[ends] - self._cum_h2[starts]
+        cum_below = self._cum_below_for(tau_rhi)
+        mean_H = self._h_center + sum_h / counts
+        std_H = np.where(counts > 1, np.sqrt(np.maximum(sum_h2 / counts - (sum_h / counts) ** 2, 0.0)), 0.0)
+        frac_below = (cum_below[ends] - cum_below[starts]) / counts
+        rolling = pd.DataFrame({
+            'date': self.daily['date'].to_numpy(),
+            'mean_H': mean_H,
+            'std_H': std_H,
+            'frac_below': frac_below,
+            'RHI': mean_H - (lambda_rhi * std_H) - (gamma_rhi * frac_below),
+        })
+        rolling.loc[counts < min_periods, ['mean_H', 'std_H', 'frac_below', 'RHI']] = np.nan
+        return rolling
+
+    def mean_s(self, k: int) -> np.ndarray:
+        """直近 k 日の s_ 列の平均（S_COLS の順）"""
+        k = min(k, self.n)
+        if k == 0:
+            return np.full(len(S_COLS), np.nan)
+        return self._window(self._cum_s, k) / k
+
+    def corr_s(self, k: int) -> pd.DataFrame:
+        """直近 k 日の s_ 列の相関行列。分散が 0 の列は pandas の corr と同じく NaN になる"""
+        k = min(k, self.n)
+        corr = np.full((len(S_COLS), len(S_COLS)), np.nan)
+        if k > 1:
+            sum_s = self._window(self._cum_s, k)
+            cov = self._window(self._cum_ss, k) - np.outer(sum_s, sum_s) / k
+            var = np.diag(cov).copy()
+            scale = np.diag(self._window(self._cum_ss, k))
+            valid = var > 1e-12 * np.maximum(scale, 1.0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                corr = np.clip(cov / np.sqrt(np.outer(var, var)), -1.0, 1.0)
+            corr[~(valid[:, None] & valid[None, :])] = np.nan
+            corr[np.diag_indices_from(corr)] = np.where(valid, 1.0, np.nan)
+        return pd.DataFrame(corr, index=S_COLS, columns=S_COLS)
+
+    def gap_stats(self, k: int) -> tuple:
+        """直近 k 日のズレ (G - 100H) の平均と標準偏差（不偏、G が欠けた日は除く）"""
+        k = min(k, self.n)
+        count = self._window(self._cum_gap_n, k) if k else 0
+        if count == 0:
+            return np.nan, np.nan
+        sum_gap = self._window(self._cum_gap, k)
+        mean_gap = self._gap_center + sum_gap / count
+        if count < 2:
+            return mean_gap, np.nan
+        var = max((self._window(self._cum_gap2, k) - sum_gap ** 2 / count) / (count - 1), 0.0)
+        return mean_gap, float(np.sqrt(var))
+def domain_impact_scores(df_period: pd.DataFrame) -> pd.Series:
+    """
+    期間中の各ドメインの悪影響度（ヒューリスティック）を、期間の行列から一度に求める。
+    変動の大きさ（s_ の標準偏差）と、価値が高いのに満たされていない度合い（q × (1 - s/100)）の加重和。
+    """
+    s_values = df_period.reindex(columns=S_COLS).to_numpy(dtype=float)
+    q_values = df_period.reindex(columns=Q_COLS).to_numpy(dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        domain_std = np.nanstd(s_values, axis=0, ddof=1) if len(s_values) > 1 else np.full(len(DOMAINS), np.nan)
+        q_mean = np.nanmean(q_values, axis=0)
+        s_mean = np.nanmean(s_values, axis=0)
+    gap_contribution = q_mean * (1 - (s_mean / 100.0))
+    return pd.Series((domain_std / 100.0) * 0.7 + gap_contribution * 0.3, index=DOMAINS)
+
+def leave_one_domain_out_rhi(df_period: pd.DataFrame, alpha: float, lambda_rhi: float, gamma_rhi: float, tau_rhi: float) -> pd.Series:
+    """
+    各ドメインを1つずつ除いた場合の期間 RHI を、(除くドメイン × 日 × ドメイン) の配列でまとめてシミュレーションする。
+    除いたドメインの q は残りのドメインに比例配分し（合計は元のまま）、s は 0 とみなす。
+    戻り値は「除いた場合の RHI - 実際の RHI」（正なら、そのドメインが RHI を押し下げている）。
+    """
+    q_raw = np.nan_to_num(df_period.reindex(columns=Q_COLS).to_numpy(dtype=float))
+    s_raw = np.nan_to_num(df_period.reindex(columns=S_COLS).to_numpy(dtype=float))
+    n_domains = len(DOMAINS)
+
+    keep = ~np.eye(n_domains, dtype=bool)[:, None, :]
+    q_kept = np.where(keep, q_raw[None], 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(q_kept.sum(axis=-1, keepdims=True) > 0, q_raw.sum(axis=-1)[None, :, None] / q_kept.sum(axis=-1, keepdims=True), 0.0)
+    S_all, U_all = harmony_components(np.concatenate([q_raw[None], q_kept * scale]), np.concatenate([s_raw[None], np.where(keep, s_raw[None], 0.0)]))
+    H_all = alpha * S_all + (1 - alpha) * U_all
+
+    mean_H = H_all.mean(axis=1)
+    std_H = H_all.std(axis=1) if H_all.shape[1] > 1 else np.zeros(len(H_all))
+    frac_below = (H_all < tau_rhi).mean(axis=1)
+    rhi = mean_H - lambda_rhi * std_H - gamma_rhi * frac_below
+    return pd.Series(rhi[1:] - rhi[0], index=DOMAINS)
+
+def daily_proposal_rng(user_id: str, domain: str, day: date | None = None) -> np.random.Generator:
+    """ユーザー・日付・ドメインから決まる乱数生成器。同じ日のうちは何度描画しても同じ提案になる"""
+    day = day or datetime.now(JST).date()
+    digest = hashlib.sha256(f'{user_id}|{day.isoformat()}|{domain}'.encode('utf-8')).digest()
+    return np.random.default_rng(int.from_bytes(digest[:8], 'big'))
+
+def generate_intervention_proposal(df_period: pd.DataFrame, rhi_results: dict, user_id: str = '',
+                                   alpha: float = 0.6, lambda_rhi: float = 0.5, gamma_rhi: float = 1.0,
+                                   tau_rhi: float = 0.5, method: str = 'simulation'):
     """
     分析結果に基づき、パーソナライズされた介入提案を生成する。
-    RHIへの悪影響が最も大きいドメインを特定し、レシピを提案する。
+    method='simulation' では、ドメインを1つずつ除いた RHI をシミュレーションし、
+    除くと RHI が最も改善するドメインを選ぶ（改善するドメインがなければ提案しない）。
+    method='heuristic' では、変動と価値-充足ギャップによる悪影響度が最大のドメインを選ぶ。
     """
     if df_period.empty or not rhi_results:
         return None, None
 
-    # RHIへの各要素の寄与度（悪影響度）を計算
-    mean_h = rhi_results.get('mean_H', 0)
-    std_h = rhi_results.get('std_H', 0)
-    
-    # 各ドメインを一つずつ除外した場合のRHIの変化をシミュレーション
-    impacts = {}
-    for domain_to_exclude in DOMAINS:
-        temp_s_cols = [s for s in S_COLS if 's_' + domain_to_exclude not in s]
-        
-        # 悪影響を計算するため、単純化して標準偏差への寄与を測る
-        # あるドメインの変動が全体の変動にどれだけ寄与したか
-        domain_std = df_period['s_' + domain_to_exclude].std()
-        
-        # ズレ（U）への影響も考慮する
-        q_val = df_period['q_' + domain_to_exclude].mean()
-        s_val = df_period['s_' + domain_to_exclude].mean()
-        gap_contribution = q_val * (1 - (s_val / 100.0)) # 価値が高いのに満たされていない度合い
-        
-        # 影響度をスコアリング（標準偏差と価値-充足ギャップを重視）
-        impact_score = (domain_std / 100.0) * 0.7 + gap_contribution * 0.3
-        impacts[domain_to_exclude] = impact_score
-
-    if not impacts:
+    if method == 'simulation':
+        impacts = leave_one_domain_out_rhi(df_period, alpha, lambda_rhi, gamma_rhi, tau_rhi)
+        if not (impacts > 0).any():
+            return None, None
+    else:
+        impacts = domain_impact_scores(df_period)
+    impacts = impacts.dropna()
+    if impacts.empty:
         return None, None
 
     # 最も悪影響が大きいドメインを特定
-    focus_domain = max(impacts, key=impacts.get)
+    focus_domain = impacts.idxmax()
     
-    # そのドメインに対応する介入レシピをランダムに2つ提案
+    # そのドメインに対応する介入レシピを2つ提案（ユーザー・日付ごとに固定）
     recipes = INTERVENTION_RECIPES.get(focus_domain, [])
     if len(recipes) > 2:
-        proposal = np.random.choice(recipes, 2, replace=False).tolist()
+        proposal = daily_proposal_rng(user_id, focus_domain).choice(recipes, 2, replace=False).tolist()
     else:
         proposal = recipes
         
@@ -483,145 +1054,2229 @@ def get_gspread_client():
         st.error("Google Sheetsへの認証に失敗しました。Secretsの設定とGCPのAPI設定を確認してください。")
         return None
 
-@st.cache_data(ttl=60)
-def read_data(sheet_name: str, spreadsheet_id: str) -> pd.DataFrame:
-    gc = get_gspread_client()
-    if gc is None: return pd.DataFrame()
+SCORE_COLS = Q_COLS + S_COLS + ALL_ELEMENT_COLS + ['g_happiness']
+CATEGORICAL_COLS = ['user_id', 'mode']
+
+def _to_score_column(values: pd.Series) -> pd.Series:
+    """
+    0〜100 の整数スコアは欠損ありの UInt8 に、それ以外の数値は float64 のままにする。
+    float32 にすると、読み込んだ行を書き戻す処理（移行・再保存）で '33.3' が '33.29999923706055' に変わってしまう。
+    """
+    numeric = pd.to_numeric(values, errors='coerce')
+    valid = numeric.dropna()
+    if ((valid % 1 == 0) & (valid >= 0) & (valid <= 255)).all():
+        return numeric.astype('UInt8')
+    return numeric.astype('float64')
+
+def coerce_loaded_types(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    シートから読み込んだ文字列の列を、列ごとにまとめて型変換する。
+    スコアは UInt8、user_id / mode はカテゴリ型にして、1行ごとの処理やメモリを減らす。
+    """
+    # --- ▼▼▼ タイムゾーンなし（ナイーブ）に統一 ▼▼▼ ---
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    if 'record_timestamp' in df.columns:
+        df['record_timestamp'] = pd.to_datetime(df['record_timestamp'], errors='coerce')
+    # --- ▲▲▲ タイムゾーンなし（ナイーブ）に統一 ▲▲▲ ---
+
+    for col in [c for c in SCORE_COLS if c in df.columns]:
+        df[col] = _to_score_column(df[col])
+    for col in [c for c in ['S', 'U'] if c in df.columns]:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    for col in [c for c in CATEGORICAL_COLS if c in df.columns]:
+        df[col] = df[col].replace('', np.nan).astype('category')
+    if 'consent' in df.columns:
+        df['consent'] = df['consent'].astype(str).str.strip().str.upper().isin(['TRUE', '1'])
+    if 'schema_version' in df.columns:
+        # 空欄は schema_version 導入前の行（バージョン 0）
+        df['schema_version'] = pd.to_numeric(df['schema_version'], errors='coerce').fillna(0).astype(int)
+        
+    return df
+
+SHARDED_SHEETS = ('data', 'metrics')
+
+def base_sheet_name(sheet_name: str) -> str:
+    """シャードのワークシート名（例: data_03）から元のシート名を返す"""
+    match = re.fullmatch(r'(.+)_(\d{2,})', sheet_name)
+    return match.group(1) if match and match.group(1) in SHARDED_SHEETS else sheet_name
+
+def get_sheet_schema(sheet_name: str) -> list:
+    """シートごとの列順（スキーマ）を返す"""
+    db_schema_cols = ['user_id', 'password_hash', 'consent'] + list(DEMOGRAPHIC_OPTIONS.keys()) + STREAK_COLS + ['achievements']
+    if base_sheet_name(sheet_name) == 'metrics':
+        db_schema_cols = ['user_id', 'metric_key', 'input_hash', 'S', 'U'] + S_COLS
+    if base_sheet_name(sheet_name) == 'data':
+        element_cols_ordered = [f's_element_{e}' for domain_key in DOMAINS for e in LONG_ELEMENTS[domain_key]]
+        db_schema_cols = (
+            ['user_id', 'date', 'record_timestamp', 'consent', 'mode'] + 
+            Q_COLS + S_COLS + 
+            ['g_happiness', 'event_log'] +
+            element_cols_ordered +
+            ['schema_version']
+        )
+    return db_schema_cols
+
+def serialize_for_sheet(sheet_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """書き込み用に、スキーマ順・文字列型に揃えたDataFrameを作る"""
+    df_copy = df.copy()
+
+    # --- ▼▼▼ タイムゾーンなし（ナイーブ）に統一 ▼▼▼ ---
+    if 'date' in df_copy.columns:
+        df_copy['date'] = pd.to_datetime(df_copy['date'], errors='coerce').dt.strftime('%Y-%m-%d')
+    if 'record_timestamp' in df_copy.columns:
+        # タイムゾーン情報を完全に削除して、シンプルな文字列に変換
+        timestamps = pd.to_datetime(df_copy['record_timestamp'], errors='coerce').dt.tz_localize(None)
+        df_copy['record_timestamp'] = timestamps.dt.strftime('%Y-%m-%d %H:%M:%S')
+    # --- ▲▲▲ タイムゾーンなし（ナイーブ）に統一 ▲▲▲ ---
+
+    db_schema_cols = get_sheet_schema(sheet_name)
+    for col in db_schema_cols:
+        if col not in df_copy.columns:
+            df_copy[col] = '' 
+    
+    df_to_write = df_copy[db_schema_cols]
+    return df_to_write.astype(object).fillna('').astype(str)
+
+def _normalize_key_value(col: str, value) -> str:
+    """キー比較用に値を正規化する（日付は YYYY-MM-DD に揃える）"""
+    if col == 'date':
+        parsed = pd.to_datetime(value, errors='coerce')
+        return '' if pd.isna(parsed) else parsed.strftime('%Y-%m-%d')
+    return '' if value is None else str(value).strip()
+
+class StorageUnavailableError(Exception):
+    """バックエンドに接続できない場合の例外"""
+
+class WriteConflictError(Exception):
+    """再試行しても他の書き込みとの競合が解消しなかった場合の例外"""
+    def __init__(self, user_ids):
+        self.user_ids = set(user_ids)
+        super().__init__(f"他の書き込みと競合しました: {', '.join(sorted(self.user_ids))}")
+
+class StorageBackend:
+    """
+    read_data / write_data などが使う永続化バックエンドの共通インターフェース。
+    受け渡しは serialize_for_sheet で文字列化したDataFrameで行い、型変換は呼び出し側が担う。
+    """
+    def read_table(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None) -> pd.DataFrame:
+        """columns を指定すると、その列だけを読み込む"""
+        raise NotImplementedError
+
+    def read_user_rows(self, sheet_name: str, spreadsheet_id: str, user_id: str, columns: tuple | None = None, fresh: bool = False) -> pd.DataFrame:
+        """fresh=True の場合は、プロセス内のキャッシュ（行インデックスなど）を使わずに読む"""
+        raise NotImplementedError
+
+    def iter_table_chunks(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None, chunk_size: int = 5000):
+        """テーブル全体を chunk_size 行ずつ返すジェネレータ（全体を一度にメモリに載せない）"""
+        raise NotImplementedError
+
+    def read_revisions(self, sheet_name: str, spreadsheet_id: str, user_ids: list) -> dict:
+        """保存されているユーザーごとのリビジョン {user_id: int} を返す（未登録は 0）"""
+        raise NotImplementedError
+
+    def write_table(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        """テーブル全体を置き換える（メンテナンス用）"""
+        raise NotImplementedError
+
+    def upsert_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple,
+                    expected_revisions: dict | None = None) -> set:
+        """
+        key_cols が一致する行を置き換え、なければ追加する。
+        expected_revisions を渡すと、リビジョンが一致したユーザーの行だけを書き込み、
+        一致しなかった（他の書き込みが先に入った）ユーザーの集合を返す。
+        """
+        raise NotImplementedError
+
+    def append_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        raise NotImplementedError
+
+    def delete_user_rows(self, sheet_name: str, spreadsheet_id: str, user_ids: list):
+        """指定ユーザーの行だけを削除する"""
+        raise NotImplementedError
+
+# --- D-1. Google Sheets バックエンド ---
+# 'data' / 'users' シートの各ユーザーがどの行にあるかを '<シート名>_index' シートに保存しておき、
+# ログイン中のユーザーの行だけを取得できるようにする。
+ROW_INDEXED_SHEETS = ('data', 'users', 'metrics')
+AUTO_CREATED_SHEETS = ('metrics',)
+# 共有シートの行は物理的に削除しない。削除すると後ろの行番号がずれ、他のレプリカ（や同じプロセスの
+# 別スレッド）が直前に調べた行番号への書き込みが、別のユーザーの行を上書きしてしまうため。
+# 削除する行は user_id をこの印に置き換えて中身を空にする（どのユーザーの行とも一致しなくなる）。
+DELETED_ROW_MARKER = '#deleted'
+
+def _index_sheet_name(sheet_name: str) -> str:
+    return f'{sheet_name}_index'
+
+def _compress_row_numbers(row_numbers: list) -> str:
+    """[2, 3, 4, 9] -> '2-4,9' のように連続する行番号を範囲表記にまとめる"""
+    ranges = []
+    for row_number in sorted(set(row_numbers)):
+        if ranges and row_number == ranges[-1][1] + 1:
+            ranges[-1][1] = row_number
+        else:
+            ranges.append([row_number, row_number])
+    return ','.join(f'{start}-{end}' if start != end else str(start) for start, end in ranges)
+
+def _expand_row_ranges(text: str) -> list:
+    """'2-4,9' -> [(2, 4), (9, 9)]"""
+    ranges = []
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        ranges.append((int(start), int(end or start)))
+    return ranges
+
+def _parse_appended_start_row(response) -> int | None:
+    """append_rows の応答（updatedRange）から、追記された先頭行の番号を取り出す"""
+    try:
+        updated_range = response['updates']['updatedRange']
+        match = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(match.group(1)) if match else None
+    except (KeyError, TypeError):
+        return None
+
+def _column_letter(col_number: int) -> str:
+    return gspread.utils.rowcol_to_a1(1, col_number).rstrip('1')
+
+def _get_or_create_worksheet(sh, title: str, cols: int = 2):
+    try:
+        return sh.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        return sh.add_worksheet(title=title, rows=1000, cols=cols)
+
+def build_row_index(user_ids: list, first_row: int = 2) -> dict:
+    """上から順に並んだ user_id 列から {user_id: [行番号, ...]} を作る（削除済みの行は含めない）"""
+    row_index = {}
+    for offset, user_id in enumerate(user_ids):
+        if user_id and user_id != DELETED_ROW_MARKER:
+            row_index.setdefault(str(user_id), []).append(first_row + offset)
+    return row_index
+
+def _tombstone_rows(worksheet, header: list, row_numbers) -> None:
+    """行番号の行を削除済みにする（行は残し、user_id を DELETED_ROW_MARKER に、他の列を空にする）"""
+    row_numbers = sorted(set(row_numbers))
+    if not row_numbers:
+        return
+    last_col = _column_letter(len(header))
+    tombstone = [DELETED_ROW_MARKER if col == 'user_id' else '' for col in header]
+    worksheet.batch_update([{'range': f'A{r}:{last_col}{r}', 'values': [tombstone]} for r in row_numbers],
+                           value_input_option='RAW')
+
+def _drop_deleted_rows(df: pd.DataFrame) -> pd.DataFrame:
+    if 'user_id' not in df.columns:
+        return df
+    return df[df['user_id'] != DELETED_ROW_MARKER].reset_index(drop=True)
+
+def _appended_rows_by_user(user_ids: list, response) -> dict | None:
+    """append_rows の応答から {user_id: [追記した行番号, ...]} を作る（位置が分からなければ None）"""
+    start_row = _parse_appended_start_row(response)
+    if start_row is None:
+        return None
+    return build_row_index([str(u) for u in user_ids], first_row=start_row)
+
+def _scan_user_row_numbers(worksheet, header: list, user_ids) -> dict:
+    """user_id 列だけを読んで {user_id: [行番号, ...]} を返す（インデックスが使えないときの探し方）"""
+    if 'user_id' not in header:
+        return {}
+    user_ids = {str(u) for u in user_ids}
+    row_index = build_row_index(worksheet.col_values(header.index('user_id') + 1)[1:])
+    return {u: rows for u, rows in row_index.items() if u in user_ids}
+
+# インデックス・リビジョンのシートは、ユーザーごとに1行（A 列が user_id）で、行は追記されるだけで
+# 並び替えも削除もしない。そのため一度見つけた行番号は変わらず、プロセス内に覚えておける。
+# 知らないユーザーは、前に読んだ行より後ろの A 列だけを読んで探す。
+TARGETED_READ_MAX_USERS = 200  # これより多いユーザーを一度に読むときは、シート全体を1回で読む
+
+class SheetRowLocator:
+    """(スプレッドシートID, シート名) ごとに {user_id: 行番号} を覚えておく"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sheets = {}  # (spreadsheet_id, title) -> ({user_id: 行番号}, 読んだ最終行)
+
+    def locate(self, worksheet, user_ids) -> dict:
+        key = (worksheet.spreadsheet_id, worksheet.title)
+        with self._lock:
+            positions, scanned = self._sheets.get(key, ({}, 1))
+            if any(u not in positions for u in user_ids):
+                tail = worksheet.get_values(f'A{scanned + 1}:A')
+                for offset, values in enumerate(tail):
+                    if values and values[0]:
+                        positions.setdefault(values[0], scanned + 1 + offset)
+                scanned += len(tail)
+                self._sheets[key] = (positions, scanned)
+            return {u: positions[u] for u in user_ids if u in positions}
+
+    def forget(self, worksheet):
+        with self._lock:
+            self._sheets.pop((worksheet.spreadsheet_id, worksheet.title), None)
+
+_sheet_row_locator = SheetRowLocator()
+
+def _read_user_cells(worksheet, user_ids, n_cols: int) -> dict:
+    """ユーザーの行（A 列から n_cols 列）だけを読み、{user_id: (行番号, [値, ...])} を返す（重複行は先頭を正とする）"""
+    user_ids = list(dict.fromkeys(str(u) for u in user_ids))
+    if len(user_ids) > TARGETED_READ_MAX_USERS:
+        cells = {}
+        for offset, values in enumerate(worksheet.get_values()[1:]):
+            if values and values[0] and values[0] not in cells:
+                cells[values[0]] = (offset + 2, list(values) + [''] * (n_cols - len(values)))
+        return {u: cells[u] for u in user_ids if u in cells}
+
+    last_col = _column_letter(n_cols)
+    for _ in range(2):
+        positions = _sheet_row_locator.locate(worksheet, user_ids)
+        fetched = worksheet.batch_get([f'A{r}:{last_col}{r}' for r in positions.values()]) if positions else []
+        cells = {}
+        for (user_id, row_number), value_range in zip(positions.items(), fetched):
+            values = list(value_range[0]) if value_range else []
+            cells[user_id] = (row_number, values + [''] * (n_cols - len(values)))
+        if all(values[0] == user_id for user_id, (_, values) in cells.items()):
+            return cells
+        # 手作業での編集などで行がずれていたら、覚えている位置を捨てて探し直す
+        _sheet_row_locator.forget(worksheet)
+    return {u: cell for u, cell in cells.items() if cell[1][0] == u}
+
+# ユーザーごとのリビジョンは '<シート名>_revisions' シートに (user_id, revision, writer) として保存する。
+# Sheets には比較と更新を一度に行う操作がないため、次の手順のベストエフォートの compare-and-swap とする:
+#   1. 書き込む前にリビジョン R を読む（expected_revisions と違うユーザーの行は書かない）
+#   2. R のままで他の書き手の予約がないユーザーだけ、writer 列に自分の予約（nonce@時刻）を書き、
+#      読み直して自分の予約が残っていることを確かめる（リビジョンはまだ進めない）
+#   3. データの行を書き込む（予約できなかったユーザーの行は、上書きも追記もしない）
+#   4. 読み直して R のままで自分の予約が残っているユーザーだけ R+1 と自分の nonce を書く
+#   5. もう一度読み、nonce が自分のものでなくなっていれば競合
+# 既存の行を上書きする前に予約するので、同じ R から始めた2つの書き込みのうち、負けた方は何も書かずに
+# 競合を返し、勝った方の行を読み直してからやり直す。リビジョンはデータより先に進まないため、
+# R+1 を読んだ読み手はその書き込み後の行を必ず読む。予約したまま止まった書き手の予約は
+# REVISION_CLAIM_TTL 秒で無効になる。どの手順も、対象ユーザーの行だけを読み書きする。
+REVISION_CLAIM_TTL = 60.0
+
+def _revision_sheet_name(sheet_name: str) -> str:
+    return f'{sheet_name}_revisions'
+
+def _is_active_claim(writer: str) -> bool:
+    """writer 列の値が、有効期限内の予約（nonce@時刻）かどうか"""
+    _, sep, claimed_at = str(writer).partition('@')
+    try:
+        return bool(sep) and time.time() - float(claimed_at) < REVISION_CLAIM_TTL
+    except ValueError:
+        return False
+
+def _open_revision_sheet(sh, sheet_name: str):
+    revision_ws = _get_or_create_worksheet(sh, _revision_sheet_name(sheet_name), cols=3)
+    if not revision_ws.row_values(1):
+        revision_ws.update([['user_id', 'revision', 'writer']], 'A1', value_input_option='RAW')
+    return revision_ws
+
+def _read_revision_rows(revision_ws, user_ids=None) -> dict:
+    """{user_id: (行番号, revision, writer)} を返す（user_ids を渡すと、そのユーザーの行だけを読む）"""
+    if user_ids is None:
+        rows = [(offset + 2, values) for offset, values in enumerate(revision_ws.get_values()[1:])]
+    else:
+        rows = _read_user_cells(revision_ws, user_ids, 3).values()
+    revision_rows = {}
+    for row_number, values in rows:
+        values = list(values) + [''] * (3 - len(values))
+        if values[0] and values[0] not in revision_rows:
+            revision = int(values[1]) if str(values[1]).isdigit() else 0
+            revision_rows[values[0]] = (row_number, revision, values[2])
+    return revision_rows
+
+def _read_user_revisions(sh, sheet_name: str, user_ids=None) -> dict:
+    """{user_id: 現在のリビジョン} を返す（まだ書き込みのないユーザーは 0。user_ids が None なら全ユーザー）"""
+    try:
+        revision_rows = _read_revision_rows(sh.worksheet(_revision_sheet_name(sheet_name)), user_ids)
+    except gspread.exceptions.WorksheetNotFound:
+        revision_rows = {}
+    if user_ids is None:
+        return {u: revision for u, (_, revision, _) in revision_rows.items()}
+    return {str(u): revision_rows.get(str(u), (None, 0, ''))[1] for u in user_ids}
+
+def _claim_revisions(sh, sheet_name: str, base_revisions: dict) -> tuple:
+    """
+    既存の行を書き換える前に呼び、ユーザーごとに書き込みを予約する（手順 2）。
+    base_revisions は書き込み前に読んだ {user_id: R}。(予約できなかったユーザーの集合, 予約の文字列) を返す。
+    """
+    revision_ws = _open_revision_sheet(sh, sheet_name)
+    revision_rows = _read_revision_rows(revision_ws, base_revisions)
+    claim = f'{uuid.uuid4().hex}@{time.time():.3f}'
+    conflicts, claimed, updates, appends = set(), [], [], []
+    for user_id, base_revision in base_revisions.items():
+        row_number, revision, writer = revision_rows.get(user_id, (None, 0, ''))
+        if revision != base_revision or _is_active_claim(writer):
+            conflicts.add(user_id)
+            continue
+        entry = [user_id, str(revision), claim]
+        if row_number:
+            updates.append({'range': f'A{row_number}:C{row_number}', 'values': [entry]})
+        else:
+            appends.append(entry)
+        claimed.append(user_id)
+
+    if updates:
+        revision_ws.batch_update(updates, value_input_option='RAW')
+    if appends:
+        revision_ws.append_rows(appends, value_input_option='RAW', table_range='A1')
+
+    if claimed:
+        # 読み直して、自分の予約が残っていないユーザー（同時に予約した他の書き手に上書きされた）は競合
+        current_rows = _read_revision_rows(revision_ws, claimed)
+        conflicts.update(u for u in claimed if current_rows.get(u, (None, 0, ''))[2] != claim)
+    return conflicts, claim
+
+def _advance_revisions(sh, sheet_name: str, base_revisions: dict, claim: str | None = None) -> tuple:
+    """
+    データの書き込み後に呼び、ユーザーのリビジョンを1つ進める（手順 4・5）。
+    base_revisions は書き込み前に読んだ {user_id: R}。R が None のユーザーは比較せず、今の値から進める。
+    claim を渡すと、R のユーザーはその予約が残っている場合だけ進める。
+    (競合したユーザーの集合, {user_id: 進めた後のリビジョン}) を返す。R が None のユーザーでも、
+    書き込み前から他の書き込みが入っていた場合は、進めた値が R+1 にならないことで分かる。
+    """
+    revision_ws = _open_revision_sheet(sh, sheet_name)
+    revision_rows = _read_revision_rows(revision_ws, base_revisions)
+
+    nonce = uuid.uuid4().hex
+    conflicts, advanced, updates, appends = set(), {}, [], []
+    for user_id, base_revision in base_revisions.items():
+        row_number, revision, writer = revision_rows.get(user_id, (None, 0, ''))
+        if base_revision is not None and (revision != base_revision or (claim is not None and writer != claim)):
+            conflicts.add(user_id)
+            continue
+        entry = [user_id, str(revision + 1), nonce]
+        if row_number:
+            updates.append({'range': f'A{row_number}:C{row_number}', 'values': [entry]})
+        else:
+            appends.append(entry)
+        advanced[user_id] = revision + 1
+
+    if updates:
+        revision_ws.batch_update(updates, value_input_option='RAW')
+    if appends:
+        revision_ws.append_rows(appends, value_input_option='RAW', table_range='A1')
+
+    if advanced:
+        # 読み直して、自分の nonce が残っていないユーザーは競合として扱う
+        current_rows = _read_revision_rows(revision_ws, advanced)
+        conflicts.update(u for u in advanced if current_rows.get(u, (None, 0, ''))[2] != nonce)
+    return conflicts, {u: revision for u, revision in advanced.items() if u not in conflicts}
+
+# インデックスの各エントリは (user_id, 行範囲, indexed_revision)。indexed_revision は、その行範囲が
+# ユーザーのどのリビジョンまでの書き込みを反映しているかを表す。書き込みは、データを書く前にエントリを
+# INDEX_DIRTY にし、リビジョンを進めた後で新しい行範囲と進めたリビジョンを書く。
+# そのため indexed_revision が現在のリビジョンより小さいエントリ（途中で止まった書き込みや、
+# インデックスの更新だけが失敗した場合）は信用せず、読み手は user_id 列を読んで行を探す。
+# また、どの書き込みもデータの行より先にエントリを作るので、今の形式のインデックスにエントリがない
+# ユーザーには行がない（登録時の存在確認や追記で、user_id 列を読まずに済む）。古い形式のインデックスは
+# 次の書き込みで作り直し、それまでは user_id 列を読む。
+ROW_INDEX_HEADER = ['user_id', 'row_ranges', 'indexed_revision']
+INDEX_DIRTY = -1
+
+_current_row_indexes = set()  # 今の形式であることを確認したインデックスシート（古い形式に戻ることはない）
+
+def _parse_index_entry(values: list) -> tuple:
+    """インデックスの1行から ([データの行番号, ...], indexed_revision) を作る"""
+    values = list(values) + [''] * (3 - len(values))
+    rows = [r for start, end in _expand_row_ranges(values[1]) for r in range(start, end + 1)]
+    indexed_revision = int(values[2]) if re.fullmatch(r'-?\d+', str(values[2])) else INDEX_DIRTY
+    return rows, indexed_revision
+
+def _open_current_row_index(sh, sheet_name: str):
+    """今の形式（indexed_revision 列がある）のインデックスシートを返す。ない・古い形式なら None"""
+    try:
+        index_ws = sh.worksheet(_index_sheet_name(sheet_name))
+    except gspread.exceptions.WorksheetNotFound:
+        return None
+    key = (index_ws.spreadsheet_id, index_ws.title)
+    if key not in _current_row_indexes:
+        if index_ws.row_values(1)[:len(ROW_INDEX_HEADER)] != ROW_INDEX_HEADER:
+            return None
+        _current_row_indexes.add(key)
+    return index_ws
+
+def _ensure_row_index(sh, sheet_name: str, worksheet):
+    """書き込みの前に呼ぶ。インデックスがない・古い形式なら作り直す"""
+    if _open_current_row_index(sh, sheet_name) is None:
+        rebuild_row_index(sh, sheet_name, worksheet)
+
+def _read_index_entries(sh, sheet_name: str, user_ids) -> dict | None:
+    """ユーザーのエントリだけを読み、{user_id: ([行番号, ...], indexed_revision)} を返す（使えるインデックスがなければ None）"""
+    index_ws = _open_current_row_index(sh, sheet_name)
+    if index_ws is None:
+        return None
+    return {u: _parse_index_entry(values) for u, (_, values) in _read_user_cells(index_ws, user_ids, 3).items()}
+
+def _find_user_rows(sh, sheet_name: str, worksheet, header: list, user_ids, revisions: dict) -> dict:
+    """
+    {user_id: [データの行番号, ...]} を返す。エントリが revisions のリビジョンまでを反映していれば
+    その行範囲を使い（エントリがなければ行もない）、そうでないユーザーだけ user_id 列を読んで探す。
+    """
+    entries = _read_index_entries(sh, sheet_name, user_ids)
+    user_rows, stale_user_ids = {}, []
+    for user_id in user_ids:
+        entry = None if entries is None else entries.get(user_id, ([], 0))
+        if entry is not None and entry[1] >= revisions[user_id]:
+            user_rows[user_id] = list(entry[0])
+        else:
+            stale_user_ids.append(user_id)
+    if stale_user_ids:
+        scanned = _scan_user_row_numbers(worksheet, header, stale_user_ids)
+        user_rows.update({u: scanned.get(u, []) for u in stale_user_ids})
+    return user_rows
+
+def _save_row_index(sh, sheet_name: str, row_index: dict, revisions: dict, default_revision: int = INDEX_DIRTY):
+    """
+    インデックス全体を書き直す（作り直し用）。シートを消してから書くと、その間に読んだ他のレプリカが
+    空のインデックスを見てしまうため、先頭から上書きしてから、余った末尾の行だけを消す。
+    他のレプリカが覚えている行番号を変えないよう、既存のエントリは同じ行に書き、行がなくなった
+    ユーザーのエントリも空の行範囲として残す（重複していた行は空にする）。
+    revisions にないユーザーの indexed_revision は default_revision とする。
+    """
+    index_ws = _get_or_create_worksheet(sh, _index_sheet_name(sheet_name), cols=len(ROW_INDEX_HEADER))
+    if index_ws.col_count < len(ROW_INDEX_HEADER):
+        index_ws.add_cols(len(ROW_INDEX_HEADER) - index_ws.col_count)
+    old_values = index_ws.get_values()
+
+    def entry(user_id):
+        return [user_id, _compress_row_numbers(row_index.get(user_id, [])), str(revisions.get(user_id, default_revision))]
+
+    rows, written = [ROW_INDEX_HEADER], set()
+    for values in old_values[1:]:
+        user_id = values[0] if values else ''
+        if user_id and user_id not in written:
+            rows.append(entry(user_id))
+            written.add(user_id)
+        else:
+            rows.append(['', '', ''])
+    rows.extend(entry(user_id) for user_id in row_index if user_id not in written)
+    while len(rows) > 1 and not rows[-1][0]:
+        rows.pop()
+
+    index_ws.update(rows, 'A1', value_input_option='RAW')
+    if len(old_values) > len(rows):
+        last_col = _column_letter(max(len(ROW_INDEX_HEADER), max(len(values) for values in old_values)))
+        index_ws.batch_clear([f'A{len(rows) + 1}:{last_col}{len(old_values)}'])
+    _sheet_row_locator.forget(index_ws)
+    _current_row_indexes.add((index_ws.spreadsheet_id, index_ws.title))
+
+def _save_row_index_entries(sh, sheet_name: str, entries: dict):
+    """{user_id: ([行番号, ...], indexed_revision)} のエントリだけを書き込む（他ユーザーのエントリには触れない）"""
+    if not entries:
+        return
+    index_ws = _get_or_create_worksheet(sh, _index_sheet_name(sheet_name), cols=len(ROW_INDEX_HEADER))
+    positions = _sheet_row_locator.locate(index_ws, list(entries))
+    updates, appends = [], []
+    for user_id, (rows, indexed_revision) in entries.items():
+        entry = [user_id, _compress_row_numbers(rows), str(indexed_revision)]
+        if user_id in positions:
+            updates.append({'range': f'A{positions[user_id]}:C{positions[user_id]}', 'values': [entry]})
+        else:
+            appends.append(entry)
+    if updates:
+        index_ws.batch_update(updates, value_input_option='RAW')
+    if appends:
+        index_ws.append_rows(appends, value_input_option='RAW', table_range='A1')
+
+def rebuild_row_index(sh, sheet_name: str, worksheet=None) -> dict:
+    """user_id 列だけを読み直して、インデックスを作り直す"""
+    worksheet = worksheet or sh.worksheet(sheet_name)
+    # 先にリビジョンを読むので、作り直したエントリは少なくともそのリビジョンまでの書き込みを反映している
+    revisions = _read_user_revisions(sh, sheet_name)
+    header = worksheet.row_values(1)
+    if 'user_id' not in header:
+        row_index = {}
+    else:
+        row_index = build_row_index(worksheet.col_values(header.index('user_id') + 1)[1:])
+    _save_row_index(sh, sheet_name, row_index, revisions, default_revision=0)
+    return row_index
+
+def _finish_row_index(sh, worksheet, sheet_name: str, user_rows: dict, advanced: dict):
+    """
+    書き込みの最後に、リビジョンを進められたユーザーのエントリを新しい行範囲とリビジョンで書く。
+    進められなかった（競合した）ユーザーのエントリは INDEX_DIRTY のまま残し、読み手に user_id 列を探させる。
+    user_rows が None（追記した位置が分からない）の場合は作り直す。
+    """
+    if user_rows is None:
+        rebuild_row_index(sh, sheet_name, worksheet)
+        return
+    _save_row_index_entries(sh, sheet_name, {u: (rows, advanced[u]) for u, rows in user_rows.items() if u in advanced})
+
+class GoogleSheetsBackend(StorageBackend):
+    """Google Sheets をそのまま使うバックエンド（既定）"""
+
+    def _open(self, spreadsheet_id: str):
+        gc = get_gspread_client()
+        if gc is None:
+            raise StorageUnavailableError()
+        return gc.open_by_key(spreadsheet_id)
+
+    def _worksheet(self, sh, sheet_name: str):
+        """
+        ワークシートを返す。アプリが計算結果を保存するシート（AUTO_CREATED_SHEETS）は、
+        なければヘッダー付きで作成する。それ以外のシートがない場合はエラーのままにする。
+        """
+        if base_sheet_name(sheet_name) not in AUTO_CREATED_SHEETS:
+            return sh.worksheet(sheet_name)
+        try:
+            return sh.worksheet(sheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            header = get_sheet_schema(sheet_name)
+            worksheet = sh.add_worksheet(title=sheet_name, rows=1000, cols=len(header))
+            worksheet.update([header], 'A1', value_input_option='RAW')
+            return worksheet
+
+    def _ensure_header(self, worksheet, sheet_name: str) -> list:
+        """1行目のヘッダーを取得し、スキーマにない列があれば右端に追加する"""
+        header = worksheet.row_values(1)
+        missing_cols = [col for col in get_sheet_schema(sheet_name) if col not in header]
+        if missing_cols:
+            header = header + missing_cols
+            if worksheet.col_count < len(header):
+                worksheet.add_cols(len(header) - worksheet.col_count)
+            worksheet.update([header], 'A1', value_input_option='USER_ENTERED')
+        return header
+
+    def _fetch_columns(self, worksheet, header: list, columns: tuple | None, row_ranges: list) -> pd.DataFrame:
+        """
+        必要な列だけを、列方向（COLUMNS）の値範囲として1回の batch_get でまとめて取得する。
+        行ごとの dict を作らず、列ごとのリストから直接 DataFrame を組み立てる。
+        """
+        wanted = [c for c in (columns or header) if c in header]
+        col_numbers = sorted({header.index(c) + 1 for c in wanted})
+        col_groups = []
+        for col_number in col_numbers:
+            if col_groups and col_number == col_groups[-1][1] + 1:
+                col_groups[-1][1] = col_number
+            else:
+                col_groups.append([col_number, col_number])
+
+        ranges = [
+            f'{_column_letter(first)}{start}:{_column_letter(last)}{end or ""}'
+            for start, end in row_ranges for first, last in col_groups
+        ]
+        value_ranges = iter(worksheet.batch_get(ranges, major_dimension='COLUMNS')) if ranges else iter([])
+
+        columns_data = {header[n - 1]: [] for n in col_numbers}
+        for start, end in row_ranges:
+            block = []
+            for first, last in col_groups:
+                fetched = list(next(value_ranges))
+                block.append((first, fetched + [[] for _ in range(last - first + 1 - len(fetched))]))
+            n_rows = end - start + 1 if end else max((len(values) for _, cols in block for values in cols), default=0)
+            for first, cols in block:
+                for offset, values in enumerate(cols):
+                    columns_data[header[first - 1 + offset]].extend(list(values) + [''] * (n_rows - len(values)))
+        return pd.DataFrame(columns_data)
+
+    def _fetch_live_rows(self, worksheet, header: list, columns: tuple | None, row_ranges: list) -> pd.DataFrame:
+        """削除済みの行を除いて取得する（判定に使うため user_id 列は常に読む）"""
+        fetch_columns = None if columns is None else tuple(dict.fromkeys(('user_id',) + tuple(columns)))
+        df = _drop_deleted_rows(self._fetch_columns(worksheet, header, fetch_columns, row_ranges))
+        if columns is not None and 'user_id' not in columns:
+            df = df.drop(columns=['user_id'], errors='ignore')
+        return df
+
+    def _read_key_rows(self, worksheet, header: list, key_cols: tuple, row_numbers: list | None = None) -> dict:
+        """キー列だけを取得して {キー: [行番号, ...]} を返す（row_numbers を渡すと、その行だけを読む）"""
+        if row_numbers is None:
+            key_df = self._fetch_columns(worksheet, header, key_cols, [(2, None)])
+            row_numbers = range(2, len(key_df) + 2)
+        else:
+            row_numbers = sorted(set(row_numbers))
+            if not row_numbers:
+                return {}
+            key_df = self._fetch_columns(worksheet, header, key_cols, _expand_row_ranges(_compress_row_numbers(row_numbers)))
+        existing_rows = {}
+        for row_number, values in zip(row_numbers, key_df[list(key_cols)].itertuples(index=False)):
+            key = tuple(_normalize_key_value(col, value) for col, value in zip(key_cols, values))
+            existing_rows.setdefault(key, []).append(row_number)
+        return existing_rows
+
+    def read_table(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None) -> pd.DataFrame:
+        worksheet = self._worksheet(self._open(spreadsheet_id), sheet_name)
+        header = worksheet.row_values(1)
+        return self._fetch_live_rows(worksheet, header, columns, [(2, None)])
+
+    def iter_table_chunks(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None, chunk_size: int = 5000):
+        worksheet = self._worksheet(self._open(spreadsheet_id), sheet_name)
+        header = worksheet.row_values(1)
+        if not header:
+            return
+        # 最終行は user_id 列（なければ A 列）の長さから求める
+        key_col = header.index('user_id') + 1 if 'user_id' in header else 1
+        last_row = len(worksheet.col_values(key_col))
+        for start in range(2, last_row + 1, chunk_size):
+            yield self._fetch_live_rows(worksheet, header, columns, [(start, min(start + chunk_size - 1, last_row))])
+
+    def _empty_frame(self, sheet_name: str, columns: tuple | None) -> pd.DataFrame:
+        return pd.DataFrame(columns=[c for c in get_sheet_schema(sheet_name) if columns is None or c in columns])
+
+    def read_user_rows(self, sheet_name: str, spreadsheet_id: str, user_id: str, columns: tuple | None = None, fresh: bool = False) -> pd.DataFrame:
+        """インデックスを使って、指定ユーザーの行だけを読み込む（インデックスは読むだけで書き換えない）"""
+        sh = self._open(spreadsheet_id)
+        worksheet = self._worksheet(sh, sheet_name)
+        header = worksheet.row_values(1)
+        if columns is not None:
+            # 取り違えの検出に使うため、user_id 列は常に読む
+            columns = tuple(dict.fromkeys(('user_id',) + tuple(columns)))
+        if base_sheet_name(sheet_name) not in ROW_INDEXED_SHEETS:
+            df = self._fetch_live_rows(worksheet, header, columns, [(2, None)])
+            return df[df['user_id'] == user_id].reset_index(drop=True) if 'user_id' in df.columns else pd.DataFrame()
+
+        # リビジョンを先に読む。エントリがそのリビジョンまでの書き込みを反映していれば、行範囲だけを読む
+        # （リビジョンもエントリも、そのユーザーの行だけを読む）
+        revision = _read_user_revisions(sh, sheet_name, [user_id])[user_id]
+        entries = _read_index_entries(sh, sheet_name, [user_id])
+        entry = None if entries is None else entries.get(user_id, ([], 0))
+        if entry is not None and entry[1] >= revision:
+            row_numbers = entry[0]
+            if not row_numbers:
+                return self._empty_frame(sheet_name, columns)
+            df = self._fetch_columns(worksheet, header, columns, _expand_row_ranges(_compress_row_numbers(row_numbers)))
+            if not df.empty and (df['user_id'] == user_id).all():
+                return df
+
+        # インデックスがない（古い形式を含む）・エントリが古い・行がずれている場合は、user_id 列を読んで行を探す
+        row_numbers = _scan_user_row_numbers(worksheet, header, [user_id]).get(user_id, [])
+        if not row_numbers:
+            return self._empty_frame(sheet_name, columns)
+        return self._fetch_live_rows(worksheet, header, columns, _expand_row_ranges(_compress_row_numbers(row_numbers)))
+
+    def read_revisions(self, sheet_name: str, spreadsheet_id: str, user_ids: list) -> dict:
+        return _read_user_revisions(self._open(spreadsheet_id), sheet_name, user_ids)
+
+    def write_table(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        """メンテナンス用: 行の位置が変わるため、他の書き込みを止めた状態で使う"""
+        sh = self._open(spreadsheet_id)
+        # シャードへの分割時は、まだ存在しないワークシートに書き込むことがある
+        worksheet = _get_or_create_worksheet(sh, sheet_name, cols=max(len(df.columns), 1))
+        indexed = base_sheet_name(sheet_name) in ROW_INDEXED_SHEETS
+        row_index = build_row_index(df['user_id'].astype(str).tolist())
+        if indexed:
+            _save_row_index(sh, sheet_name, row_index, dict.fromkeys(row_index, INDEX_DIRTY))
+        worksheet.clear()
+        worksheet.update([df.columns.values.tolist()] + df.values.tolist(), value_input_option='USER_ENTERED')
+        _, advanced = _advance_revisions(sh, sheet_name, dict.fromkeys(df['user_id'].astype(str)))
+        if indexed:
+            _save_row_index(sh, sheet_name, row_index, advanced)
+
+    def upsert_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple,
+                    expected_revisions: dict | None = None) -> set:
+        sh = self._open(spreadsheet_id)
+        worksheet = self._worksheet(sh, sheet_name)
+        header = self._ensure_header(worksheet, sheet_name)
+        last_col = _column_letter(len(header))
+        indexed = base_sheet_name(sheet_name) in ROW_INDEXED_SHEETS
+
+        # 書き込む前のリビジョンを読み、条件と違うユーザーの行は書き込まない
+        user_ids = list(dict.fromkeys(df['user_id'].astype(str)))
+        base_revisions = _read_user_revisions(sh, sheet_name, user_ids)
+        conflicts = set()
+        if expected_revisions is not None:
+            conflicts = {u for u in user_ids if base_revisions[u] != expected_revisions.get(u, 0)}
+        # 既存の行を上書きする前に予約する。予約できなかったユーザーの行は書かずに競合として返す
+        claim_conflicts, claim = _claim_revisions(sh, sheet_name, {u: base_revisions[u] for u in user_ids if u not in conflicts})
+        conflicts |= claim_conflicts
+        df_to_write = df[~df['user_id'].astype(str).isin(conflicts)].copy()
+        if df_to_write.empty:
+            return conflicts
+        for col in header:
+            if col not in df_to_write.columns:
+                df_to_write[col] = ''
+        rows_to_write = df_to_write[header].values.tolist()
+        written_user_ids = list(dict.fromkeys(df_to_write['user_id'].astype(str)))
+
+        # 既存行の位置（シート上の行番号）を調べる。インデックスのあるシートでは、書き込むユーザーの行を
+        # インデックスから求めて、その行のキー列だけを読む
+        if indexed and 'user_id' in key_cols:
+            _ensure_row_index(sh, sheet_name, worksheet)
+            user_position = key_cols.index('user_id')
+            found_rows = _find_user_rows(sh, sheet_name, worksheet, header, written_user_ids, base_revisions)
+            existing_rows = self._read_key_rows(worksheet, header, key_cols, [r for rows in found_rows.values() for r in rows])
+            owners = {r: key[user_position] for key, rows in existing_rows.items() for r in rows}
+            if any(owners.get(r) != u for u, rows in found_rows.items() for r in rows):
+                # 行がずれていた（手作業での編集など）場合は、user_id 列を読んで探し直す
+                found_rows = _scan_user_row_numbers(worksheet, header, written_user_ids)
+                existing_rows = self._read_key_rows(worksheet, header, key_cols, [r for rows in found_rows.values() for r in rows])
+        else:
+            existing_rows = self._read_key_rows(worksheet, header, key_cols)
+
+        new_rows = {}
+        for record, values in zip(df_to_write.to_dict('records'), rows_to_write):
+            key = tuple(_normalize_key_value(col, record[col]) for col in key_cols)
+            new_rows.setdefault(key, []).append((str(record.get('user_id', '')), values))
+
+        updates, appends, appended_user_ids, surplus_rows = [], [], [], []
+        for key, records in new_rows.items():
+            matched_rows = existing_rows.get(key, [])
+            # 一致行を先頭から上書きし、余った既存行は削除済みにし、足りない分は追記する
+            for row_number, (_, values) in zip(matched_rows, records):
+                updates.append({'range': f'A{row_number}:{last_col}{row_number}', 'values': [values]})
+            surplus_rows.extend(matched_rows[len(records):])
+            for user_id, values in records[len(matched_rows):]:
+                appends.append(values)
+                appended_user_ids.append(user_id)
+
+        # 書き込み後の各ユーザーの行 = キーの一致した既存行 - 削除済みにする行 + 追記した行
+        user_rows = None
+        if indexed and 'user_id' in key_cols:
+            surplus = set(surplus_rows)
+            user_rows = {u: [] for u in written_user_ids}
+            for key, rows in existing_rows.items():
+                if key[user_position] in user_rows:
+                    user_rows[key[user_position]].extend(r for r in rows if r not in surplus)
+        if indexed:
+            # 行を書き換える間、エントリを INDEX_DIRTY にしておく（新しいユーザーはここでエントリができる）
+            _ensure_row_index(sh, sheet_name, worksheet)
+            _save_row_index_entries(sh, sheet_name, {u: ([], INDEX_DIRTY) for u in written_user_ids})
+
+        if updates:
+            worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+        appended = {}
+        if appends:
+            append_response = worksheet.append_rows(appends, value_input_option='USER_ENTERED', table_range='A1')
+            appended = _appended_rows_by_user(appended_user_ids, append_response)
+        _tombstone_rows(worksheet, header, surplus_rows)
+
+        # データを書き込んだ後にリビジョンを進める。予約が破られていた（同時に予約が通った・期限切れ）
+        # ユーザーが追記した行は削除済みにして、再送（最新の行を読み直してからの書き込み）に任せる
+        write_conflicts, advanced = _advance_revisions(sh, sheet_name, {u: base_revisions[u] for u in written_user_ids}, claim)
+        conflicts |= write_conflicts
+        if appended is not None:
+            _tombstone_rows(worksheet, header, [r for u in write_conflicts for r in appended.get(u, [])])
+        if indexed:
+            if user_rows is not None and appended is not None:
+                for user_id, rows in appended.items():
+                    user_rows[user_id] = sorted(user_rows[user_id] + rows)
+            _finish_row_index(sh, worksheet, sheet_name, None if appended is None else user_rows, advanced)
+        return conflicts
+
+    def append_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        sh = self._open(spreadsheet_id)
+        worksheet = self._worksheet(sh, sheet_name)
+        header = self._ensure_header(worksheet, sheet_name)
+        indexed = base_sheet_name(sheet_name) in ROW_INDEXED_SHEETS
+
+        df_to_write = df.copy()
+        for col in header:
+            if col not in df_to_write.columns:
+                df_to_write[col] = ''
+        user_ids = list(dict.fromkeys(df_to_write['user_id'].astype(str)))
+        base_revisions = _read_user_revisions(sh, sheet_name, user_ids)
+        user_rows = {}
+        if indexed:
+            # 既存の行は、書き込み前のリビジョンを反映したエントリから取る（古ければ user_id 列を探す）
+            _ensure_row_index(sh, sheet_name, worksheet)
+            user_rows = _find_user_rows(sh, sheet_name, worksheet, header, user_ids, base_revisions)
+            _save_row_index_entries(sh, sheet_name, {u: ([], INDEX_DIRTY) for u in user_ids})
+
+        append_response = worksheet.append_rows(df_to_write[header].values.tolist(), value_input_option='USER_ENTERED', table_range='A1')
+        # 追記は条件なしで進める。書き込み前から他の書き込みが入っていたユーザーのエントリは INDEX_DIRTY のまま残す
+        _, advanced = _advance_revisions(sh, sheet_name, dict.fromkeys(user_ids))
+        advanced = {u: revision for u, revision in advanced.items() if revision == base_revisions[u] + 1}
+        if indexed:
+            appended = _appended_rows_by_user(df_to_write['user_id'].tolist(), append_response)
+            if appended is not None:
+                for user_id, rows in appended.items():
+                    user_rows[user_id] = sorted(user_rows[user_id] + rows)
+            _finish_row_index(sh, worksheet, sheet_name, None if appended is None else user_rows, advanced)
+
+    def delete_user_rows(self, sheet_name: str, spreadsheet_id: str, user_ids: list):
+        sh = self._open(spreadsheet_id)
+        worksheet = self._worksheet(sh, sheet_name)
+        header = worksheet.row_values(1)
+        if 'user_id' not in header:
+            return
+        indexed = base_sheet_name(sheet_name) in ROW_INDEXED_SHEETS
+
+        # user_id 列だけを読んで対象の行を探し、行は残したまま削除済みにする
+        target_user_ids = list(dict.fromkeys(str(u) for u in user_ids))
+        base_revisions = _read_user_revisions(sh, sheet_name, target_user_ids)
+        if indexed:
+            _ensure_row_index(sh, sheet_name, worksheet)
+            _save_row_index_entries(sh, sheet_name, {u: ([], INDEX_DIRTY) for u in target_user_ids})
+        row_numbers = _scan_user_row_numbers(worksheet, header, target_user_ids)
+        _tombstone_rows(worksheet, header, [r for rows in row_numbers.values() for r in rows])
+        _, advanced = _advance_revisions(sh, sheet_name, dict.fromkeys(target_user_ids))
+        advanced = {u: revision for u, revision in advanced.items() if revision == base_revisions[u] + 1}
+        if indexed:
+            _finish_row_index(sh, worksheet, sheet_name, {u: [] for u in target_user_ids}, advanced)
+
+# --- D-2. SQLite バックエンド ---
+# ネットワークなしで動かすためのローカルバックエンド。スプレッドシートIDごとに1つのDBファイルを作り、
+# シート名をテーブル名として、シートと同じ列（TEXT）で保存する。
+SQLITE_KEY_INDEXES = {'data': ('user_id', 'date'), 'users': ('user_id',), 'metrics': ('user_id', 'metric_key')}
+SQLITE_REVISION_TABLE = '_revisions'
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+class SQLiteBackend(StorageBackend):
+    """ローカルの SQLite ファイルを使うバックエンド（オフライン動作・負荷試験用）"""
+
+    def __init__(self, db_dir: str):
+        self.db_dir = db_dir
+        os.makedirs(db_dir, exist_ok=True)
+
+    def _connect(self, spreadsheet_id: str) -> sqlite3.Connection:
+        db_path = os.path.join(self.db_dir, re.sub(r'[^\w.-]', '_', spreadsheet_id) + '.sqlite3')
+        conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _ensure_table(self, conn: sqlite3.Connection, sheet_name: str) -> list:
+        """テーブルとキー列のインデックスを用意し、スキーマに足りない列を追加する"""
+        table = _quote_identifier(sheet_name)
+        schema_cols = get_sheet_schema(sheet_name)
+        col_defs = ', '.join(f"{_quote_identifier(col)} TEXT NOT NULL DEFAULT ''" for col in schema_cols)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (row_id INTEGER PRIMARY KEY AUTOINCREMENT, {col_defs})')
+        existing_cols = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')][1:]
+        for col in schema_cols:
+            if col not in existing_cols:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {_quote_identifier(col)} TEXT NOT NULL DEFAULT ''")
+                existing_cols.append(col)
+        key_cols = SQLITE_KEY_INDEXES.get(base_sheet_name(sheet_name))
+        if key_cols:
+            index_name = _quote_identifier(f'idx_{sheet_name}_' + '_'.join(key_cols))
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({', '.join(_quote_identifier(c) for c in key_cols)})")
+        return existing_cols
+
+    def _ensure_revision_table(self, conn: sqlite3.Connection):
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {SQLITE_REVISION_TABLE} '
+            '(sheet_name TEXT NOT NULL, user_id TEXT NOT NULL, revision INTEGER NOT NULL, PRIMARY KEY (sheet_name, user_id))'
+        )
+
+    def _begin_write(self, conn: sqlite3.Connection, sheet_name: str):
+        """テーブルを用意してから、書き込みロックを先に取るトランザクションを開始する"""
+        self._ensure_table(conn, sheet_name)
+        self._ensure_revision_table(conn)
+        conn.execute('BEGIN IMMEDIATE')
+
+    def _claim_revisions(self, conn: sqlite3.Connection, sheet_name: str, user_ids: list, expected_revisions: dict | None = None) -> set:
+        """トランザクション内でリビジョンを比較して進める（こちらは原子的な compare-and-swap）"""
+        conflicts = set()
+        for user_id in dict.fromkeys(str(u) for u in user_ids):
+            if expected_revisions is not None:
+                row = conn.execute(f'SELECT revision FROM {SQLITE_REVISION_TABLE} WHERE sheet_name = ? AND user_id = ?', (sheet_name, user_id)).fetchone()
+                if (row[0] if row else 0) != expected_revisions.get(user_id, 0):
+                    conflicts.add(user_id)
+                    continue
+            conn.execute(
+                f'INSERT INTO {SQLITE_REVISION_TABLE} (sheet_name, user_id, revision) VALUES (?, ?, 1) '
+                'ON CONFLICT (sheet_name, user_id) DO UPDATE SET revision = revision + 1',
+                (sheet_name, user_id)
+            )
+        return conflicts
+
+    def _select(self, conn: sqlite3.Connection, sheet_name: str, where: str = '', params: tuple = (), columns: tuple | None = None) -> pd.DataFrame:
+        cols = self._ensure_table(conn, sheet_name)
+        if columns is not None:
+            cols = [c for c in cols if c in columns]
+        select_cols = ', '.join(_quote_identifier(c) for c in cols)
+        cursor = conn.execute(f'SELECT {select_cols} FROM {_quote_identifier(sheet_name)} {where} ORDER BY row_id', params)
+        return pd.DataFrame(cursor.fetchall(), columns=cols)
+
+    def _insert(self, conn: sqlite3.Connection, sheet_name: str, df: pd.DataFrame):
+        cols = list(df.columns)
+        placeholders = ', '.join('?' for _ in cols)
+        conn.executemany(
+            f"INSERT INTO {_quote_identifier(sheet_name)} ({', '.join(_quote_identifier(c) for c in cols)}) VALUES ({placeholders})",
+            df.values.tolist()
+        )
+
+    def read_table(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None) -> pd.DataFrame:
+        with closing(self._connect(spreadsheet_id)) as conn:
+            return self._select(conn, sheet_name, columns=columns)
+
+    def iter_table_chunks(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None, chunk_size: int = 5000):
+        with closing(self._connect(spreadsheet_id)) as conn:
+            cols = self._ensure_table(conn, sheet_name)
+            if columns is not None:
+                cols = [c for c in cols if c in columns]
+            select_cols = ', '.join(_quote_identifier(c) for c in cols)
+            cursor = conn.execute(f'SELECT {select_cols} FROM {_quote_identifier(sheet_name)} ORDER BY row_id')
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield pd.DataFrame(rows, columns=cols)
+
+    def read_user_rows(self, sheet_name: str, spreadsheet_id: str, user_id: str, columns: tuple | None = None, fresh: bool = False) -> pd.DataFrame:
+        if columns is not None:
+            # Google Sheets バックエンドと同じく、user_id 列は常に含める
+            columns = tuple(dict.fromkeys(('user_id',) + tuple(columns)))
+        with closing(self._connect(spreadsheet_id)) as conn:
+            return self._select(conn, sheet_name, 'WHERE "user_id" = ?', (user_id,), columns=columns)
+
+    def read_revisions(self, sheet_name: str, spreadsheet_id: str, user_ids: list) -> dict:
+        with closing(self._connect(spreadsheet_id)) as conn:
+            self._ensure_revision_table(conn)
+            revisions = {}
+            for user_id in user_ids:
+                row = conn.execute(f'SELECT revision FROM {SQLITE_REVISION_TABLE} WHERE sheet_name = ? AND user_id = ?', (sheet_name, str(user_id))).fetchone()
+                revisions[str(user_id)] = row[0] if row else 0
+            return revisions
+
+    def write_table(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        with closing(self._connect(spreadsheet_id)) as conn, conn:
+            self._begin_write(conn, sheet_name)
+            self._claim_revisions(conn, sheet_name, df['user_id'].tolist())
+            conn.execute(f'DELETE FROM {_quote_identifier(sheet_name)}')
+            self._insert(conn, sheet_name, df)
+
+    def upsert_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple,
+                    expected_revisions: dict | None = None) -> set:
+        where = ' AND '.join(f'{_quote_identifier(col)} = ?' for col in key_cols)
+        with closing(self._connect(spreadsheet_id)) as conn, conn:
+            # リビジョンの確認・削除・追加を1つのトランザクションで行う
+            self._begin_write(conn, sheet_name)
+            conflicts = self._claim_revisions(conn, sheet_name, df['user_id'].tolist(), expected_revisions)
+            df_to_write = df[~df['user_id'].isin(conflicts)]
+            for record in df_to_write.to_dict('records'):
+                key = tuple(_normalize_key_value(col, record[col]) for col in key_cols)
+                conn.execute(f'DELETE FROM {_quote_identifier(sheet_name)} WHERE {where}', key)
+            self._insert(conn, sheet_name, df_to_write)
+            return conflicts
+
+    def append_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        with closing(self._connect(spreadsheet_id)) as conn, conn:
+            self._begin_write(conn, sheet_name)
+            self._claim_revisions(conn, sheet_name, df['user_id'].tolist())
+            self._insert(conn, sheet_name, df)
+
+    def delete_user_rows(self, sheet_name: str, spreadsheet_id: str, user_ids: list):
+        with closing(self._connect(spreadsheet_id)) as conn, conn:
+            self._begin_write(conn, sheet_name)
+            self._claim_revisions(conn, sheet_name, user_ids)
+            conn.executemany(f'DELETE FROM {_quote_identifier(sheet_name)} WHERE "user_id" = ?', [(str(u),) for u in user_ids])
+
+# --- D-3. シャーディング ---
+# user_id のハッシュで 'data' の行を N 個のシャードに振り分け、1回の読み書きが触る範囲を
+# ユーザー数に関係なく一定に保つ。配置（shard_layout）は次のいずれか:
+#   "worksheets"   : 同じスプレッドシート内の data_00, data_01, ... ワークシート
+#   "spreadsheets" : シャードごとに別のスプレッドシート（shard_spreadsheet_ids）、
+#                    SQLite の場合はシャードごとに別の DB ファイル
+# Google Sheets のセル数上限はスプレッドシート単位のため、上限対策には "spreadsheets" を使う。
+def shard_for_user(user_id: str, n_shards: int) -> int:
+    """プロセスやバージョンによらず同じ値になるよう、組み込みの hash() ではなく SHA-256 を使う"""
+    digest = hashlib.sha256(str(user_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % n_shards
+
+def shard_sheet_name(sheet_name: str, shard: int) -> str:
+    return f'{sheet_name}_{shard:02d}'
+
+class ShardedBackend(StorageBackend):
+    """SHARDED_SHEETS への読み書きを、user_id に対応するシャードへ振り分けるラッパー"""
+
+    def __init__(self, backend: StorageBackend, n_shards: int, layout: str = 'worksheets', shard_spreadsheet_ids: list | None = None):
+        if layout not in ('worksheets', 'spreadsheets'):
+            raise ValueError(f"未対応の shard_layout です: {layout}")
+        if shard_spreadsheet_ids and len(shard_spreadsheet_ids) != n_shards:
+            raise ValueError("shard_spreadsheet_ids の数が n_shards と一致しません。")
+        if layout == 'spreadsheets' and not shard_spreadsheet_ids and isinstance(backend, GoogleSheetsBackend):
+            # Sheets ではスプレッドシートIDを組み立てられないため、シャードごとのIDが必須
+            raise ValueError("Google Sheets で shard_layout = \"spreadsheets\" を使う場合は shard_spreadsheet_ids を設定してください。")
+        self.backend = backend
+        self.n_shards = n_shards
+        self.layout = layout
+        self.shard_spreadsheet_ids = list(shard_spreadsheet_ids or [])
+
+    def _route(self, sheet_name: str, spreadsheet_id: str, shard: int) -> tuple:
+        """(シート名, スプレッドシートID) をシャードの実際の格納先に変換する"""
+        if self.layout == 'worksheets':
+            return shard_sheet_name(sheet_name, shard), spreadsheet_id
+        if self.shard_spreadsheet_ids:
+            return sheet_name, self.shard_spreadsheet_ids[shard]
+        # SQLite のみ: シャードごとに別の DB ファイルになる
+        return sheet_name, f'{spreadsheet_id}_shard{shard:02d}'
+
+    def _split(self, df: pd.DataFrame) -> dict:
+        """{shard: そのシャードの行} に分ける"""
+        if df.empty:
+            return {}
+        shards = df['user_id'].map(lambda u: shard_for_user(u, self.n_shards))
+        return {shard: part for shard, part in df.groupby(shards, sort=True)}
+
+    def read_table(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None) -> pd.DataFrame:
+        if sheet_name not in SHARDED_SHEETS:
+            return self.backend.read_table(sheet_name, spreadsheet_id, columns)
+        # 全シャードを読むため、研究用エクスポートなどのメンテナンス処理だけで使う
+        parts = [self.backend.read_table(*self._route(sheet_name, spreadsheet_id, shard), columns) for shard in range(self.n_shards)]
+        parts = [part for part in parts if not part.empty]
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+    def iter_table_chunks(self, sheet_name: str, spreadsheet_id: str, columns: tuple | None = None, chunk_size: int = 5000):
+        if sheet_name not in SHARDED_SHEETS:
+            yield from self.backend.iter_table_chunks(sheet_name, spreadsheet_id, columns, chunk_size)
+            return
+        for shard in range(self.n_shards):
+            yield from self.backend.iter_table_chunks(*self._route(sheet_name, spreadsheet_id, shard), columns, chunk_size)
+
+    def read_user_rows(self, sheet_name: str, spreadsheet_id: str, user_id: str, columns: tuple | None = None, fresh: bool = False) -> pd.DataFrame:
+        if sheet_name in SHARDED_SHEETS:
+            sheet_name, spreadsheet_id = self._route(sheet_name, spreadsheet_id, shard_for_user(user_id, self.n_shards))
+        return self.backend.read_user_rows(sheet_name, spreadsheet_id, user_id, columns, fresh)
+
+    def read_revisions(self, sheet_name: str, spreadsheet_id: str, user_ids: list) -> dict:
+        if sheet_name not in SHARDED_SHEETS:
+            return self.backend.read_revisions(sheet_name, spreadsheet_id, user_ids)
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(shard_for_user(user_id, self.n_shards), []).append(user_id)
+        revisions = {}
+        for shard, shard_user_ids in by_shard.items():
+            revisions.update(self.backend.read_revisions(*self._route(sheet_name, spreadsheet_id, shard), shard_user_ids))
+        return revisions
+
+    def write_table(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        if sheet_name not in SHARDED_SHEETS:
+            return self.backend.write_table(sheet_name, spreadsheet_id, df)
+        parts = self._split(df)
+        for shard in range(self.n_shards):
+            self.backend.write_table(*self._route(sheet_name, spreadsheet_id, shard), parts.get(shard, df.iloc[0:0]))
+
+    def upsert_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple,
+                    expected_revisions: dict | None = None) -> set:
+        if sheet_name not in SHARDED_SHEETS:
+            return self.backend.upsert_rows(sheet_name, spreadsheet_id, df, key_cols, expected_revisions)
+        conflicts = set()
+        for shard, part in self._split(df).items():
+            conflicts |= self.backend.upsert_rows(*self._route(sheet_name, spreadsheet_id, shard), part, key_cols, expected_revisions)
+        return conflicts
+
+    def append_rows(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame):
+        if sheet_name not in SHARDED_SHEETS:
+            return self.backend.append_rows(sheet_name, spreadsheet_id, df)
+        for shard, part in self._split(df).items():
+            self.backend.append_rows(*self._route(sheet_name, spreadsheet_id, shard), part)
+
+    def delete_user_rows(self, sheet_name: str, spreadsheet_id: str, user_ids: list):
+        if sheet_name not in SHARDED_SHEETS:
+            return self.backend.delete_user_rows(sheet_name, spreadsheet_id, user_ids)
+        by_shard = {}
+        for user_id in user_ids:
+            by_shard.setdefault(shard_for_user(user_id, self.n_shards), []).append(user_id)
+        for shard, shard_user_ids in by_shard.items():
+            self.backend.delete_user_rows(*self._route(sheet_name, spreadsheet_id, shard), shard_user_ids)
+
+def split_into_shards(sheet_name: str = 'data', spreadsheet_id: str | None = None) -> dict:
+    """
+    シャード化する前の1枚のシートを読み、user_id ごとにシャードへ振り分けて書き込む（移行ツール）。
+    Secrets に n_shards などを設定した後、アプリを止めた状態で一度だけ実行する。
+        python -c "import app; print(app.split_into_shards())"
+    元のシートは消さずに残すので、件数を確認してから手動で削除する。{shard: 行数} を返す。
+    """
+    backend = get_storage_backend()
+    if not isinstance(backend, ShardedBackend):
+        raise ValueError("[storage] n_shards が 2 以上に設定されていません。")
+    spreadsheet_id = spreadsheet_id or st.secrets["connections"]["gsheets"]["data_sheet_id"]
+    source_df = backend.backend.read_table(sheet_name, spreadsheet_id)
+    backend.write_table(sheet_name, spreadsheet_id, source_df)
+    counts = {shard: 0 for shard in range(backend.n_shards)}
+    counts.update({shard: len(part) for shard, part in backend._split(source_df).items()})
+    return counts
+
+def get_storage_config() -> dict:
+    try:
+        return dict(st.secrets.get("storage", {}))
+    except FileNotFoundError:
+        return {}
+
+@st.cache_resource
+def get_storage_backend() -> StorageBackend:
+    """
+    Secrets の [storage] 設定に応じてバックエンドを返す。
+    例: [storage] backend = "sqlite", sqlite_dir = "local_db"（未設定なら Google Sheets）
+    """
+    storage_config = get_storage_config()
+    if storage_config.get("backend", "gsheets") == "sqlite":
+        backend = SQLiteBackend(storage_config.get("sqlite_dir", "local_db"))
+    else:
+        backend = GoogleSheetsBackend()
+
+    # 例: n_shards = 4, shard_layout = "spreadsheets", shard_spreadsheet_ids = ["...", ...]
+    n_shards = int(storage_config.get("n_shards", 1))
+    if n_shards > 1:
+        return ShardedBackend(
+            backend, n_shards,
+            layout=storage_config.get("shard_layout", "worksheets"),
+            shard_spreadsheet_ids=storage_config.get("shard_spreadsheet_ids"),
+        )
+    return backend
+
+# --- D-4. 読み書きの窓口 ---
+class DataRevisionRegistry:
+    """
+    (シート, ユーザー) ごとの書き込み世代を管理する。
+    読み込みキャッシュのキーに世代を含めることで、書き込みのたびに全キャッシュを消さず、
+    書き込まれたユーザー（とシート全体の読み込み）の分だけを無効化する。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._revisions = Counter()
+
+    def table_revision(self, sheet_name: str, spreadsheet_id: str) -> int:
+        with self._lock:
+            return self._revisions[(sheet_name, spreadsheet_id, None)]
+
+    def user_revision(self, sheet_name: str, spreadsheet_id: str, user_id: str) -> tuple:
+        # テーブル全体の書き直しは全ユーザーに影響するため、('*' の世代, ユーザーの世代) の組で表す
+        with self._lock:
+            return (self._revisions[(sheet_name, spreadsheet_id, '*')], self._revisions[(sheet_name, spreadsheet_id, user_id)])
+
+    def bump(self, sheet_name: str, spreadsheet_id: str, user_ids=None):
+        """user_ids が None ならテーブル全体、それ以外は指定ユーザーの世代を進める"""
+        with self._lock:
+            self._revisions[(sheet_name, spreadsheet_id, None)] += 1
+            if user_ids is None:
+                self._revisions[(sheet_name, spreadsheet_id, '*')] += 1
+            else:
+                for user_id in set(user_ids):
+                    self._revisions[(sheet_name, spreadsheet_id, user_id)] += 1
+
+@st.cache_resource
+def get_revision_registry() -> DataRevisionRegistry:
+    return DataRevisionRegistry()
+
+def read_data(sheet_name: str, spreadsheet_id: str, columns: list | None = None) -> pd.DataFrame:
+    """シート全体を読み込む。columns を指定すると、その列だけを読み込む"""
+    revision = get_revision_registry().table_revision(sheet_name, spreadsheet_id)
+    return _read_data_cached(sheet_name, spreadsheet_id, revision, tuple(columns) if columns is not None else None)
+
+def read_user_data(sheet_name: str, spreadsheet_id: str, user_id: str, columns: list | None = None) -> pd.DataFrame:
+    """指定ユーザーの行だけを読み込む。columns を指定すると、その列（と user_id）だけを読み込む"""
+    revision = get_revision_registry().user_revision(sheet_name, spreadsheet_id, user_id)
+    return _read_user_data_cached(sheet_name, spreadsheet_id, user_id, revision, tuple(columns) if columns is not None else None)
+
+@st.cache_data(ttl=60, max_entries=64)
+def _read_data_cached(sheet_name: str, spreadsheet_id: str, revision: int, columns: tuple | None) -> pd.DataFrame:
     try:
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.worksheet(sheet_name)
-        df = pd.DataFrame(worksheet.get_all_records())
+        df = get_storage_backend().read_table(sheet_name, spreadsheet_id, columns)
 
         if df.empty:
             return df
         
-        # --- ▼▼▼ タイムゾーンなし（ナイーブ）に統一 ▼▼▼ ---
-        if 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'], errors='coerce')
-        if 'record_timestamp' in df.columns:
-            df['record_timestamp'] = pd.to_datetime(df['record_timestamp'], errors='coerce')
-        # --- ▲▲▲ タイムゾーンなし（ナイーブ）に統一 ▲▲▲ ---
-
-        demographic_cols = list(DEMOGRAPHIC_OPTIONS.keys())
-        all_cols_to_process = Q_COLS + S_COLS + ALL_ELEMENT_COLS + ['g_happiness'] + demographic_cols
-        
-        for col in [c for c in all_cols_to_process if c in df.columns]:
-            if col not in demographic_cols:
-                 df[col] = pd.to_numeric(df[col], errors='coerce')
-            
-        return df
+        return coerce_loaded_types(df)
+    except StorageUnavailableError:
+        pass
+    except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound):
+        st.error(f"スプレッドシートまたはワークシート'{sheet_name}'が見つかりません。")
+    except Exception as e:
+        st.error(f"データの読み込み中にエラー: {e}")
+    return pd.DataFrame()
+
+@st.cache_data(ttl=60, max_entries=1000)
+def _read_user_data_cached(sheet_name: str, spreadsheet_id: str, user_id: str, revision: tuple, columns: tuple | None) -> pd.DataFrame:
+    try:
+        df = get_storage_backend().read_user_rows(sheet_name, spreadsheet_id, user_id, columns)
+        return coerce_loaded_types(df)
+    except StorageUnavailableError:
+        pass
     except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound):
         st.error(f"スプレッドシートまたはワークシート'{sheet_name}'が見つかりません。")
     except Exception as e:
         st.error(f"データの読み込み中にエラー: {e}")
     return pd.DataFrame()
 
+def iter_data_chunks(sheet_name: str, spreadsheet_id: str, columns: list | None = None, chunk_size: int = 5000):
+    """
+    テーブル全体を chunk_size 行ずつ型変換して返す（キャッシュなし）。
+    一括移行や研究用エクスポートなど、全行を扱うメンテナンス処理用。
+    """
+    columns = tuple(columns) if columns is not None else None
+    for chunk in get_storage_backend().iter_table_chunks(sheet_name, spreadsheet_id, columns, chunk_size):
+        if not chunk.empty:
+            yield coerce_loaded_types(chunk)
+
 def write_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> bool:
-    gc = get_gspread_client()
-    if gc is None:
-        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
-        return False
+    """
+    シート全体を消去して書き直す。
+    全行を送信するため、日々の保存では使わず、メンテナンス作業（一括移行・削除など）専用とする。
+    日々の記録の保存には upsert_data / append_data を使う。
+    """
     try:
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.worksheet(sheet_name)
-        
-        df_copy = df.copy()
-
-        # --- ▼▼▼ タイムゾーンなし（ナイーブ）に統一 ▼▼▼ ---
-        if 'date' in df_copy.columns:
-            df_copy['date'] = pd.to_datetime(df_copy['date'], errors='coerce').dt.strftime('%Y-%m-%d')
-        if 'record_timestamp' in df_copy.columns:
-            # タイムゾーン情報を完全に削除して、シンプルな文字列に変換
-            timestamps = pd.to_datetime(df_copy['record_timestamp'], errors='coerce').dt.tz_localize(None)
-            df_copy['record_timestamp'] = timestamps.dt.strftime('%Y-%m-%d %H:%M:%S')
-        # --- ▲▲▲ タイムゾーンなし（ナイーブ）に統一 ▲▲▲ ---
-
-        # (...以降のスキーマ定義と書き込み処理は変更なし...)
-        db_schema_cols = ['user_id', 'password_hash', 'consent'] + list(DEMOGRAPHIC_OPTIONS.keys())
-        if sheet_name == 'data':
-            element_cols_ordered = [f's_element_{e}' for domain_key in DOMAINS for e in LONG_ELEMENTS[domain_key]]
-            db_schema_cols = (
-                ['user_id', 'date', 'record_timestamp', 'consent', 'mode'] + 
-                Q_COLS + S_COLS + 
-                ['g_happiness', 'event_log'] +
-                element_cols_ordered
-            )
-        
-        for col in db_schema_cols:
-            if col not in df_copy.columns:
-                df_copy[col] = '' 
-        
-        df_to_write = df_copy[db_schema_cols]
-        df_to_write = df_to_write.fillna('').astype(str)
-        
-        worksheet.clear()
-        worksheet.update([df_to_write.columns.values.tolist()] + df_to_write.values.tolist(), value_input_option='USER_ENTERED')
-        
-        st.cache_data.clear()
-        st.cache_resource.clear()
+        get_storage_backend().write_table(sheet_name, spreadsheet_id, serialize_for_sheet(sheet_name, df))
+        get_revision_registry().bump(sheet_name, spreadsheet_id)
         
         return True
+    except StorageUnavailableError:
+        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
     except Exception as e:
         st.error(f"データの書き込み中にエラー: {e}")
+    return False
+
+def upsert_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple = ('user_id', 'date')) -> bool:
+    """
+    key_cols が一致する行だけを上書きし、一致する行がなければ末尾に追記する。
+    テーブル全体を書き直さないため、他ユーザーの行には一切触れない。
+    """
+    try:
+        df_to_write = serialize_for_sheet(sheet_name, df)
+        upsert_with_retry(get_storage_backend(), sheet_name, spreadsheet_id, df_to_write, tuple(key_cols))
+        get_revision_registry().bump(sheet_name, spreadsheet_id, df_to_write['user_id'].tolist())
+
+        return True
+    except StorageUnavailableError:
+        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
+    except Exception as e:
+        st.error(f"データの書き込み中にエラー: {e}")
+    return False
+
+def append_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> bool:
+    """既存行には触れず、新しい行を末尾に追記する"""
+    try:
+        df_to_write = serialize_for_sheet(sheet_name, df)
+        get_storage_backend().append_rows(sheet_name, spreadsheet_id, df_to_write)
+        get_revision_registry().bump(sheet_name, spreadsheet_id, df_to_write['user_id'].tolist())
+
+        return True
+    except StorageUnavailableError:
+        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
+    except Exception as e:
+        st.error(f"データの書き込み中にエラー: {e}")
+    return False
+
+def delete_user_data(sheet_name: str, spreadsheet_id: str, user_ids: list) -> bool:
+    """指定ユーザーの行だけを削除する（テーブル全体は書き直さない）"""
+    try:
+        get_storage_backend().delete_user_rows(sheet_name, spreadsheet_id, list(user_ids))
+        get_revision_registry().bump(sheet_name, spreadsheet_id, list(user_ids))
+
+        return True
+    except StorageUnavailableError:
+        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
+    except Exception as e:
+        st.error(f"データの削除中にエラー: {e}")
+    return False
+
+# --- 楽観的排他制御 ---
+# バックエンドにはユーザーごとのリビジョンが保存されており、書き込みのたびに進む。
+# 読み込み→編集→書き戻しを行う処理は、読んだ時点のリビジョンを添えて書き込み、
+# 他のレプリカが先に書いていた（書いている最中の）場合はそのユーザーの分だけを読み直してやり直す。
+def _wait_before_retry(attempt: int):
+    """競合後のやり直しの前に待つ（相手の書き込みが終わるのを待ち、同時にやり直さないよう時間をばらつかせる）"""
+    time.sleep(min(0.25 * 2 ** attempt, 4.0) * (0.5 + np.random.random()))
+
+def upsert_with_retry(backend: StorageBackend, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame,
+                      key_cols: tuple, max_attempts: int = 5) -> list:
+    """
+    書き込む直前のリビジョンを条件に upsert し、競合したユーザーの行だけを再送する。
+    書き込めたユーザーの一覧を返し、max_attempts 回で解消しなければ WriteConflictError を送出する。
+    """
+    written_user_ids = []
+    for attempt in range(max_attempts):
+        if attempt:
+            _wait_before_retry(attempt)
+        user_ids = df['user_id'].unique().tolist()
+        expected_revisions = backend.read_revisions(sheet_name, spreadsheet_id, user_ids)
+        conflicts = backend.upsert_rows(sheet_name, spreadsheet_id, df, key_cols, expected_revisions)
+        written_user_ids.extend(u for u in user_ids if u not in conflicts)
+        if not conflicts:
+            return written_user_ids
+        df = df[df['user_id'].isin(conflicts)]
+    raise WriteConflictError(conflicts)
+
+def update_user_rows(sheet_name: str, spreadsheet_id: str, user_id: str, transform, max_attempts: int = 5) -> pd.DataFrame | None:
+    """
+    ユーザーの行を読み、transform(df) で書き換えた結果でそのユーザーの行を置き換える。
+    読んだ後に他の書き込みが入っていたら、最新の行を読み直して transform からやり直す。
+    成功すれば書き込んだ行（型変換済み）を、失敗すれば None を返す。
+    """
+    backend = get_storage_backend()
+    try:
+        for attempt in range(max_attempts):
+            if attempt:
+                _wait_before_retry(attempt)
+            base_revision = backend.read_revisions(sheet_name, spreadsheet_id, [user_id])[user_id]
+            current_df = coerce_loaded_types(backend.read_user_rows(sheet_name, spreadsheet_id, user_id, fresh=True))
+            updated_df = transform(current_df.copy())
+            df_to_write = serialize_for_sheet(sheet_name, updated_df)
+            conflicts = backend.upsert_rows(sheet_name, spreadsheet_id, df_to_write, ('user_id',), {user_id: base_revision})
+            if not conflicts:
+                get_revision_registry().bump(sheet_name, spreadsheet_id, [user_id])
+                return updated_df
+        raise WriteConflictError([user_id])
+    except StorageUnavailableError:
+        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
+    except Exception as e:
+        st.error(f"データの書き込み中にエラー: {e}")
+    return None
+
+# --- D-5. 書き込みキュー（write-behind） ---
+# 夕方などに集中する保存を、一定間隔ごとに1回のバックエンド呼び出しにまとめる。
+# 受け付けた保存はローカルのスプールファイルに追記してから応答するため、
+# 書き込み前にプロセスが再起動しても、次回起動時に再送される。
+# 失敗したリクエストはリクエストごとに間隔を空けて再送し、後ろのリクエストの書き込みは止めない。
+# max_attempts 回失敗したものはデッドレター（別のスプールファイル）に移し、再送をやめる。
+class WriteTicket:
+    """
+    キューに入れた保存リクエストの受付票。最初の書き込みでコミット・再送待ち・デッドレターのどれかに決まる。
+    再送待ちになったリクエストは、後でコミットされることもある（retrying のまま、待ち手には受付済みとして返す）。
+    """
+    def __init__(self, entry_id: str):
+        self.entry_id = entry_id
+        self.error = None       # デッドレターに移したときの例外
+        self.retrying = False   # 一時的に失敗して、再送を待っている
+        self._settled = threading.Event()
+
+    def wait(self, timeout: float) -> bool:
+        """コミットされれば True、時間切れ・再送待ち・デッドレターの場合は False を返す"""
+        return self._settled.wait(timeout) and not self.retrying and self.error is None
+
+class WriteBehindQueue:
+    def __init__(self, backend: StorageBackend, registry: DataRevisionRegistry, spool_path: str,
+                 flush_interval: float = 2.0, max_batch_size: int = 500, max_attempts: int = 8,
+                 dead_letter_path: str | None = None):
+        self.backend = backend
+        self.registry = registry
+        self.spool_path = spool_path
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        spool_root, spool_ext = os.path.splitext(spool_path)
+        self.dead_letter_path = dead_letter_path or f'{spool_root}.dead{spool_ext or ".jsonl"}'
+        self._pending = []
+        self._tickets = {}
+        self._condition = threading.Condition()
+
+        spool_dir = os.path.dirname(spool_path)
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        self._replay_spool()
+        threading.Thread(target=self._run, name='write-behind-queue', daemon=True).start()
+
+    def submit_upsert(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple = ('user_id', 'date')) -> WriteTicket:
+        return self._submit('upsert', sheet_name, spreadsheet_id, df, tuple(key_cols))
+
+    def submit_append(self, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> WriteTicket:
+        return self._submit('append', sheet_name, spreadsheet_id, df, ())
+
+    def _submit(self, op: str, sheet_name: str, spreadsheet_id: str, df: pd.DataFrame, key_cols: tuple) -> WriteTicket:
+        entry = {
+            'id': uuid.uuid4().hex,
+            'op': op,
+            'sheet_name': sheet_name,
+            'spreadsheet_id': spreadsheet_id,
+            'key_cols': list(key_cols),
+            'rows': serialize_for_sheet(sheet_name, df).to_dict('records'),
+            'attempts': 0,
+            'retry_at': 0.0,
+        }
+        ticket = WriteTicket(entry['id'])
+        with self._condition:
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._tickets[entry['id']] = ticket
+            self._enqueue(entry)
+            self._condition.notify()
+        return ticket
+
+    def _entry_key(self, entry: dict, record: dict) -> tuple:
+        return (entry['sheet_name'], entry['spreadsheet_id'], tuple(_normalize_key_value(col, record[col]) for col in entry['key_cols']))
+
+    def _enqueue(self, entry: dict):
+        """同じキーへの未送信 upsert は、新しい方だけを残す（コアレス）"""
+        if entry['op'] == 'upsert':
+            new_keys = {self._entry_key(entry, record) for record in entry['rows']}
+            for pending in self._pending:
+                if pending['op'] == 'upsert' and pending['key_cols'] == entry['key_cols']:
+                    pending['rows'] = [r for r in pending['rows'] if self._entry_key(pending, r) not in new_keys]
+                    if not pending['rows']:
+                        # 中身がなくなった古いリクエストも、新しいリクエストのコミット時に完了扱いにする
+                        entry.setdefault('merged_ids', []).extend([pending['id']] + pending.get('merged_ids', []))
+            self._pending = [p for p in self._pending if p['rows']]
+        self._pending.append(entry)
+
+    def _replay_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    self._enqueue(json.loads(line))
+        self._rewrite_spool()
+
+    def _rewrite_spool(self):
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._pending:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.spool_path)
+
+    def _write_dead_letters(self, entries: list):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # 送信できるリクエストが出てから flush_interval だけ待ってまとめる（max_batch_size に達したらすぐ送る）。
+                # 再送待ちのリクエストは飛ばすだけで、その再送時刻まで新しいリクエストを待たせない
+                batch_deadline = None
+                while True:
+                    now = time.time()
+                    ready = [p for p in self._pending if p.get('retry_at', 0.0) <= now]
+                    if ready:
+                        batch_deadline = batch_deadline or now + self.flush_interval
+                        if len(ready) >= self.max_batch_size or now >= batch_deadline:
+                            break
+                        timeout = batch_deadline - now
+                    else:
+                        batch_deadline = None
+                        timeout = min((p['retry_at'] for p in self._pending), default=None)
+                        timeout = None if timeout is None else timeout - now
+                    self._condition.wait(timeout=timeout)
+                batch = ready[:self.max_batch_size]
+            self._flush(batch)
+
+    def _write_group(self, op: str, sheet_name: str, spreadsheet_id: str, key_cols: tuple, entries: list):
+        df = pd.DataFrame([row for entry in entries for row in entry['rows']], columns=get_sheet_schema(sheet_name))
+        if op == 'upsert':
+            # 他のレプリカと競合したユーザーの行だけを、最新のリビジョンで再送する
+            upsert_with_retry(self.backend, sheet_name, spreadsheet_id, df, key_cols)
+        else:
+            self.backend.append_rows(sheet_name, spreadsheet_id, df)
+        self.registry.bump(sheet_name, spreadsheet_id, df['user_id'].tolist())
+
+    def _flush(self, batch: list):
+        """
+        連続する同種のリクエストを1回のバックエンド呼び出しにまとめて書き込む。
+        まとめた書き込みが失敗したら、そのグループだけを1件ずつ書き直して失敗したリクエストを特定し、
+        残りのグループの書き込みは続ける。
+        """
+        groups = []
+        for entry in batch:
+            group_key = (entry['op'], entry['sheet_name'], entry['spreadsheet_id'], tuple(entry['key_cols']))
+            if groups and groups[-1][0] == group_key:
+                groups[-1][1].append(entry)
+            else:
+                groups.append((group_key, [entry]))
+
+        committed, failed = [], []
+        for group_key, entries in groups:
+            try:
+                self._write_group(*group_key, entries)
+                committed.extend(entries)
+                continue
+            except Exception as e:
+                if len(entries) == 1:
+                    failed.append((entries[0], e))
+                    continue
+            for entry in entries:
+                try:
+                    self._write_group(*group_key, [entry])
+                    committed.append(entry)
+                except Exception as e:
+                    failed.append((entry, e))
+
+        with self._condition:
+            dead_letters, dead_errors = [], {}
+            for entry, error in failed:
+                entry['attempts'] = entry.get('attempts', 0) + 1
+                if entry['attempts'] >= self.max_attempts:
+                    entry['error'] = repr(error)
+                    dead_letters.append(entry)
+                    dead_errors[entry['id']] = error
+                    continue
+                entry['retry_at'] = time.time() + min(self.flush_interval * 2 ** entry['attempts'], 300.0)
+                # 再送を待つリクエストの待ち手には、受付済みとしてすぐに返す
+                for entry_id in [entry['id']] + entry.get('merged_ids', []):
+                    ticket = self._tickets.get(entry_id)
+                    if ticket:
+                        ticket.retrying = True
+                        ticket._settled.set()
+            if dead_letters:
+                self._write_dead_letters(dead_letters)
+
+            finished_ids = {entry['id'] for entry in committed + dead_letters}
+            self._pending = [p for p in self._pending if p['id'] not in finished_ids]
+            self._rewrite_spool()
+            for entry in committed + dead_letters:
+                for entry_id in [entry['id']] + entry.get('merged_ids', []):
+                    ticket = self._tickets.pop(entry_id, None)
+                    if ticket:
+                        ticket.retrying = False
+                        ticket.error = dead_errors.get(entry['id'])
+                        ticket._settled.set()
+
+@st.cache_resource
+def get_write_queue() -> WriteBehindQueue:
+    """
+    Secrets の [storage] 設定で調整できる。
+    例: write_flush_interval = 2.0, write_spool_path = "local_db/write_spool.jsonl",
+        write_max_attempts = 8, write_dead_letter_path = "local_db/write_spool.dead.jsonl"
+    """
+    storage_config = get_storage_config()
+    return WriteBehindQueue(
+        get_storage_backend(),
+        get_revision_registry(),
+        spool_path=storage_config.get("write_spool_path", os.path.join("local_db", "write_spool.jsonl")),
+        flush_interval=float(storage_config.get("write_flush_interval", 2.0)),
+        max_attempts=int(storage_config.get("write_max_attempts", 8)),
+        dead_letter_path=storage_config.get("write_dead_letter_path"),
+    )
+
+def wait_for_write(ticket: WriteTicket, timeout: float = 10.0) -> bool:
+    """
+    キューに入れた保存のコミットを待つ。
+    時間内にコミットされなくても、再送待ちになっても、スプールに保存済みなら受付済みとして True を返し、
+    再送をあきらめてデッドレターに移した場合だけ False を返す。
+    """
+    if ticket.wait(timeout):
+        return True
+    if ticket.error is not None:
+        st.error(f"データの書き込み中にエラー: {ticket.error}")
         return False
+    st.info("保存を受け付けました。反映まで少し時間がかかる場合があります。")
+    return True
+
+# --- D-6. スキーマ移行 ---
+# 'data' の各行は schema_version 列に、どの移行ステップまで適用済みかを持つ。
+# 行は読み込み時に必要なステップだけを順に適用し（遅延移行）、保存はそのユーザーの行だけで行う。
+# スキーマを変えるときは、ステップ関数を SCHEMA_MIGRATIONS の末尾に追加し、DATA_SCHEMA_VERSION を上げる。
+def _schema_step_add_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """v1: 現在のスキーマにある列をそろえる"""
+    for col in get_sheet_schema('data'):
+        if col not in df.columns:
+            df[col] = pd.NA
+    return df
+
+def _schema_step_fill_mode(df: pd.DataFrame) -> pd.DataFrame:
+    """v2: mode 列がなかった頃の日次記録に、入力された列から mode を補う"""
+    mode = (df['mode'] if 'mode' in df.columns else pd.Series(pd.NA, index=df.index)).astype(object)
+    is_blank = mode.isna() | (mode == '')
+    has_elements = df[[c for c in ALL_ELEMENT_COLS if c in df.columns]].notna().any(axis=1)
+    has_daily_scores = df[[c for c in S_COLS + ['g_happiness'] if c in df.columns]].notna().any(axis=1)
+    mode = mode.mask(is_blank & has_elements, 'deep')
+    mode = mode.mask(is_blank & ~has_elements & has_daily_scores, 'quick')
+    df['mode'] = mode
+    return df
+
+SCHEMA_MIGRATIONS = [
+    (1, _schema_step_add_columns),
+    (2, _schema_step_fill_mode),
+]
+DATA_SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+def upgrade_rows(df: pd.DataFrame) -> tuple:
+    """
+    schema_version が古い行にだけ、未適用の移行ステップを順に適用する。
+    (移行後の DataFrame, 移行した行のマスク) を返す。
+    """
+    df = df.copy()
+    if 'schema_version' not in df.columns:
+        df['schema_version'] = 0
+    df['schema_version'] = pd.to_numeric(df['schema_version'], errors='coerce').fillna(0).astype(int)
+    upgraded_mask = df['schema_version'] < DATA_SCHEMA_VERSION
+    if not upgraded_mask.any():
+        return df, upgraded_mask
+
+    for version, step in SCHEMA_MIGRATIONS:
+        target = df['schema_version'] < version
+        if not target.any():
+            continue
+        upgraded = step(df.loc[target].copy())
+        upgraded['schema_version'] = version
+        # ステップで列が増えることがあるため、更新しなかった行と結合して元の順序に戻す
+        df = pd.concat([df.loc[~target], upgraded]).loc[df.index]
+
+    for col in [c for c in CATEGORICAL_COLS if c in df.columns]:
+        df[col] = df[col].astype('category')
+    return df, upgraded_mask
+
+def migrate_table_offline(spreadsheet_id: str | None = None, chunk_size: int = 5000) -> dict:
+    """
+    'data' 全体を最新のスキーマに移行する一括移行ツール（メンテナンス用）。
+    user_id と schema_version の列だけをチャンクごとに読んで古い行を持つユーザーを集め、
+    そのユーザーの行を1人ずつリビジョン付きで置き換える。メモリに載るのは1チャンク分の2列と1ユーザー分の行だけ。
+        python -c "import app; print(app.migrate_table_offline())"
+    """
+    spreadsheet_id = spreadsheet_id or st.secrets["connections"]["gsheets"]["data_sheet_id"]
+    outdated_user_ids = set()
+    for chunk in iter_data_chunks('data', spreadsheet_id, columns=['user_id', 'schema_version'], chunk_size=chunk_size):
+        versions = chunk['schema_version'] if 'schema_version' in chunk.columns else pd.Series(0, index=chunk.index)
+        outdated_user_ids.update(chunk.loc[versions < DATA_SCHEMA_VERSION, 'user_id'].dropna().astype(str))
+
+    failed_user_ids = []
+    for user_id in sorted(outdated_user_ids):
+        if update_user_rows('data', spreadsheet_id, user_id, lambda current_df: upgrade_rows(current_df)[0]) is None:
+            failed_user_ids.append(user_id)
+    return {'outdated_users': len(outdated_user_ids), 'migrated_users': len(outdated_user_ids) - len(failed_user_ids), 'failed_user_ids': failed_user_ids}
+
+# --- D-7. ユーザーストア ---
+class UserStore:
+    """
+    users シートを user_id で引くストア。ログイン・登録・同意確認などでシート全体を読まないようにする。
+    取得結果はプロセス内の dict に ttl 秒だけ保持し（read-through）、このプロセスからの書き込みで破棄する。
+    登録（get で存在確認→insert）やプロフィール・同意の更新も、バックエンドではそのユーザーの行と
+    インデックス・リビジョンの行だけを読み書きするため、ユーザー数が増えても重くならない。
+    """
+    def __init__(self, spreadsheet_id: str, ttl: float = 60.0):
+        self.spreadsheet_id = spreadsheet_id
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._records = {}
+
+    def get(self, user_id: str) -> dict | None:
+        """ユーザーのレコードを dict で返す（存在しない・読めない場合は None）"""
+        if not user_id:
+            return None
+        with self._lock:
+            cached = self._records.get(user_id)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return dict(cached[1])
+
+        try:
+            user_df = coerce_loaded_types(get_storage_backend().read_user_rows('users', self.spreadsheet_id, user_id))
+        except StorageUnavailableError:
+            return None
+        except Exception as e:
+            st.error(f"データの読み込み中にエラー: {e}")
+            return None
+        if user_df.empty:
+            return None
+        record = user_df.iloc[0].to_dict()
+        with self._lock:
+            self._records[user_id] = (time.monotonic(), record)
+        return dict(record)
+
+    def insert(self, record: dict) -> bool:
+        """新しいユーザーを1行だけ追記する"""
+        self._forget(record['user_id'])
+        return append_data('users', self.spreadsheet_id, pd.DataFrame([record]))
+
+    def update(self, user_id: str, changes: dict) -> bool:
+        """ユーザーの行の指定列だけを書き換える（リビジョン付きの読み込み→書き戻し）"""
+        def apply_changes(user_df: pd.DataFrame) -> pd.DataFrame:
+            user_df = user_df.astype(object)
+            for col, value in changes.items():
+                user_df[col] = value
+            return user_df
+
+        self._forget(user_id)
+        return update_user_rows('users', self.spreadsheet_id, user_id, apply_changes) is not None
+
+    def delete(self, user_id: str) -> bool:
+        self._forget(user_id)
+        return delete_user_data('users', self.spreadsheet_id, [user_id])
+
+    def _forget(self, user_id: str):
+        with self._lock:
+            self._records.pop(user_id, None)
+
+@st.cache_resource
+def get_user_store(spreadsheet_id: str) -> UserStore:
+    return UserStore(spreadsheet_id)
+
+# --- D-8. メトリクスストア ---
+# 行ごとに計算した S・U（と深掘りモードで置き換えた s_ 列）を 'metrics' シートに保存しておき、
+# 入力が変わっていない行は再計算しない。H は alpha から毎回 S・U を合成するだけなので保存しない。
+# 計算式を変えたときは METRICS_ENGINE_VERSION を上げると、全行が再計算される。
+METRICS_ENGINE_VERSION = 1
+METRIC_INPUT_COLS = ['mode'] + Q_COLS + S_COLS + ALL_ELEMENT_COLS
+
+def build_metric_keys(df: pd.DataFrame) -> pd.Series:
+    """(date, record_timestamp) と、同じ組が重複した場合の出現順から行のキーを作る"""
+    dates = pd.to_datetime(df['date'], errors='coerce').dt.strftime('%Y-%m-%d').fillna('') if 'date' in df.columns else pd.Series('', index=df.index)
+    timestamps = (
+        pd.to_datetime(df['record_timestamp'], errors='coerce').dt.strftime('%Y-%m-%dT%H:%M:%S.%f').fillna('')
+        if 'record_timestamp' in df.columns else pd.Series('', index=df.index)
+    )
+    base_keys = dates + '|' + timestamps
+    return base_keys + '|' + base_keys.groupby(base_keys).cumcount().astype(str)
+
+def metric_input_hashes(df: pd.DataFrame) -> pd.Series:
+    """S・U の計算に使う列だけから、行ごとの指紋（ハッシュ）を作る"""
+    inputs = df.reindex(columns=METRIC_INPUT_COLS)
+    inputs['mode'] = inputs['mode'].astype(object).where(inputs['mode'].notna(), '').astype(str)
+    numeric_cols = METRIC_INPUT_COLS[1:]
+    inputs[numeric_cols] = inputs[numeric_cols].astype(float)
+    hashes = pd.util.hash_pandas_object(inputs, index=False)
+    return hashes.map(lambda h: f'{METRICS_ENGINE_VERSION}:{h:016x}')
+
+def calculate_metrics_incremental(df: pd.DataFrame, user_id: str, spreadsheet_id: str, alpha: float = 0.6) -> pd.DataFrame:
+    """
+    calculate_metrics と同じ結果を返すが、保存済みの S・U と入力の指紋が一致する行は再計算しない。
+    新しく計算した行があれば、MetricsWriter 経由でそのユーザーの 'metrics' の行を置き換える（完了は待たない）。
+    """
+    if df.empty:
+        return calculate_metrics(df, alpha)
+
+    keys = build_metric_keys(df)
+    hashes = metric_input_hashes(df)
+    stored = read_user_data('metrics', spreadsheet_id, user_id)
+    stored_keys = []
+    if not stored.empty and {'metric_key', 'input_hash'} <= set(stored.columns):
+        stored_keys = stored['metric_key'].tolist()
+        stored = stored.drop_duplicates('metric_key', keep='last').set_index('metric_key').reindex(keys.values)
+        reusable = (stored['input_hash'].to_numpy() == hashes.to_numpy())
+    else:
+        stored = None
+        reusable = np.zeros(len(df), dtype=bool)
+
+    # 出力の形（型変換と q_・s_ の欠損補完）は calculate_metrics と同じにそろえる
+    result = df.copy()
+    numeric_cols = [c for c in SCORE_COLS if c in result.columns]
+    result[numeric_cols] = result[numeric_cols].astype(float)
+    for col in Q_COLS + S_COLS:
+        if col in result.columns:
+            result[col] = result[col].fillna(0)
+    result['S'] = np.nan
+    result['U'] = np.nan
+
+    if reusable.any():
+        result.loc[reusable, S_COLS + ['S', 'U']] = stored.loc[reusable, S_COLS + ['S', 'U']].astype(float).to_numpy()
+    if not reusable.all():
+        computed = calculate_metrics(df.loc[~reusable], alpha)
+        result.loc[~reusable, S_COLS + ['S', 'U']] = computed[S_COLS + ['S', 'U']].to_numpy()
+
+    # 日付を保存し直すと record_timestamp が変わり、古いキーの行が残る。
+    # 再計算した行があるか、今の記録にないキーが保存されていれば、そのユーザーの行をまとめて置き換える
+    has_stale_keys = stored is not None and len(stored_keys) > 0 and not set(stored_keys) <= set(keys)
+    if not reusable.all() or has_stale_keys:
+        metrics_rows = result[S_COLS + ['S', 'U']].copy()
+        metrics_rows['user_id'] = user_id
+        metrics_rows['metric_key'] = keys.to_numpy()
+        metrics_rows['input_hash'] = hashes.to_numpy()
+        get_metrics_writer().submit(spreadsheet_id, user_id, metrics_rows)
+
+    result['H'] = alpha * result['S'] + (1 - alpha) * result['U']
+    return result
+
+class MetricsWriter:
+    """
+    'metrics' への保存専用の書き込み。利用者の記録（書き込みキュー）とは別のスレッドで、ベストエフォートで書く。
+    計算結果は記録から作り直せるため、スプールも再送もしない。ユーザーごとに最新の1件だけを保持し、
+    失敗した書き込みは捨てる（次の表示で再計算され、もう一度保存される）。
+    書き込みは key_cols=('user_id',) の upsert で、そのユーザーの行をまるごと置き換える。
+    """
+    def __init__(self, backend: StorageBackend, registry: DataRevisionRegistry, max_pending: int = 1000):
+        self.backend = backend
+        self.registry = registry
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._written = 0
+        self._dropped = 0
+        self._last_error = None
+        threading.Thread(target=self._run, name='metrics-writer', daemon=True).start()
+
+    def submit(self, spreadsheet_id: str, user_id: str, df: pd.DataFrame):
+        rows = serialize_for_sheet('metrics', df)
+        with self._condition:
+            self._pending.pop((spreadsheet_id, user_id), None)
+            self._pending[(spreadsheet_id, user_id)] = rows
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self._dropped += 1
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                (spreadsheet_id, user_id), rows = self._pending.popitem(last=False)
+            try:
+                self.backend.upsert_rows('metrics', spreadsheet_id, rows, ('user_id',))
+                self.registry.bump('metrics', spreadsheet_id, [user_id])
+                self._written += 1
+            except Exception as e:
+                self._dropped += 1
+                self._last_error = repr(e)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {'pending': len(self._pending), 'written': self._written,
+                    'dropped': self._dropped, 'last_error': self._last_error}
+
+@st.cache_resource
+def get_metrics_writer() -> MetricsWriter:
+    return MetricsWriter(get_storage_backend(), get_revision_registry())
+
+class MetricsMemo:
+    """
+    メトリクス計算結果のメモ。キーは (user_id, データのリビジョン, alpha) で、
+    入力の DataFrame 全体をハッシュする st.cache_data と違い、キーの計算はほぼ無料。
+    LRU で古いものから捨て、エントリ数と合計サイズ（バイト）の上限を守る。
+    他のレプリカからの書き込みはリビジョンに現れないため、読み込みキャッシュと同じく ttl 秒で失効させる。
+    """
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key: tuple, compute, copy: bool = True):
+        """
+        キーに対応する結果のコピーを返す。なければ compute() を呼んで保存する。
+        呼び出し側が変更しない値（DailySummary など）は copy=False でそのまま共有する。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1].copy() if copy else entry[1]
+            self.misses += 1
+
+        result = compute()
+        if isinstance(result, pd.DataFrame):
+            size = int(result.memory_usage(index=True, deep=True).sum())
+        else:
+            size = int(result.nbytes)
+        with self._lock:
+            self._discard(key)
+            if size <= self.max_bytes:
+                self._entries[key] = (time.monotonic(), result.copy() if copy else result, size)
+                self._total_bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self._total_bytes,
+            }
+
+    def _discard(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+
+@st.cache_resource
+def get_metrics_memo() -> MetricsMemo:
+    """
+    Secrets の [storage] 設定で調整できる。
+    例: metrics_cache_max_entries = 256, metrics_cache_max_mb = 256
+    """
+    storage_config = get_storage_config()
+    return MetricsMemo(
+        max_entries=int(storage_config.get("metrics_cache_max_entries", 256)),
+        max_bytes=int(float(storage_config.get("metrics_cache_max_mb", 256)) * 1024 * 1024),
+    )
+
+def get_daily_summary(user_id: str, data_revision: int, alpha: float, df_processed: pd.DataFrame) -> DailySummary:
+    """
+    ユーザーの要約表を返す。キーにデータのリビジョンを含むので、記録を書き込むと次の表示で作り直される。
+    それ以外の操作（期間や閾値の切り替え）では作り直さず、同じ要約表を共有する。
+    """
+    return get_metrics_memo().get_or_compute(
+        ('daily_summary', user_id, data_revision, alpha),
+        lambda: DailySummary(df_processed),
+        copy=False,
+    )
+
+# --- D-9. 研究用一括集計 ---
+# 研究利用に同意したユーザーの H・RHI を、data テーブルをチャンクごとに読みながらまとめて計算する。
+# S・U・H は行ごとに決まるので、チャンク単位で calculate_metrics を行列計算し、
+# ユーザーごとの合計・二乗和・閾値未満の日数（部分集計）だけを返して最後に足し合わせる。
+# event_log（日記本文）は読み込む列に含めない。
+RESEARCH_EXPORT_COLS = ['user_id', 'date', 'mode', 'g_happiness'] + Q_COLS + S_COLS + ALL_ELEMENT_COLS
+RESEARCH_SUM_COLS = ['n_records', 'sum_S', 'sum_U', 'sum_H', 'sum_H2', 'n_below', 'n_g', 'sum_g'] + [f'sum_{c}' for c in Q_COLS + S_COLS]
+
+def _research_chunk_partials(chunk: pd.DataFrame, alpha: float, tau: float) -> pd.DataFrame:
+    """1チャンク分の S・U・H を計算し、ユーザーごとの部分集計を返す（ワーカープロセスで実行する）"""
+    metrics = calculate_metrics(chunk, alpha)
+    user_ids = metrics['user_id'].astype(str).to_numpy()
+    g = metrics['g_happiness'].astype(float)
+    sums = pd.DataFrame({
+        'n_records': 1,
+        'sum_S': metrics['S'].to_numpy(),
+        'sum_U': metrics['U'].to_numpy(),
+        'sum_H': metrics['H'].to_numpy(),
+        'sum_H2': metrics['H'].to_numpy() ** 2,
+        'n_below': (metrics['H'] < tau).astype(int).to_numpy(),
+        'n_g': g.notna().astype(int).to_numpy(),
+        'sum_g': g.fillna(0).to_numpy(),
+    })
+    for col in Q_COLS + S_COLS:
+        sums[f'sum_{col}'] = metrics[col].to_numpy(dtype=float)
+    sums['first_date'] = pd.to_datetime(metrics['date'], errors='coerce').to_numpy()
+    sums['last_date'] = sums['first_date']
+    sums['user_id'] = user_ids
+    aggregations = {col: 'sum' for col in RESEARCH_SUM_COLS}
+    aggregations.update({'first_date': 'min', 'last_date': 'max'})
+    return sums.groupby('user_id').agg(aggregations)
+
+def _combine_research_partials(partials: list) -> pd.DataFrame:
+    """チャンクごとの部分集計を、ユーザーごとに足し合わせる"""
+    if not partials:
+        return pd.DataFrame(columns=RESEARCH_SUM_COLS + ['first_date', 'last_date'])
+    aggregations = {col: 'sum' for col in RESEARCH_SUM_COLS}
+    aggregations.update({'first_date': 'min', 'last_date': 'max'})
+    return pd.concat(partials).groupby(level=0).agg(aggregations)
+
+def pseudonymize_user_ids(user_ids, salt: str) -> list:
+    """研究用の仮名ID（ソルト付き SHA-256 の先頭16桁）を作る"""
+    return [hashlib.sha256(f'{salt}{user_id}'.encode('utf-8')).hexdigest()[:16] for user_id in user_ids]
+
+def build_research_user_table(totals: pd.DataFrame, lambda_rhi: float, gamma_rhi: float, salt: str) -> pd.DataFrame:
+    """部分集計の合計から、ユーザーごとの平均・標準偏差・RHI（calculate_rhi_metrics と同じ定義）を求める"""
+    n = totals['n_records'].astype(float)
+    mean_H = totals['sum_H'] / n
+    std_H = np.sqrt((totals['sum_H2'] / n - mean_H ** 2).clip(lower=0)).where(n > 1, 0.0)
+    frac_below = totals['n_below'] / n
+    table = pd.DataFrame({
+        'research_id': pseudonymize_user_ids(totals.index, salt),
+        'n_records': totals['n_records'].astype(int).to_numpy(),
+        'first_date': pd.to_datetime(totals['first_date']).dt.strftime('%Y-%m-%d').to_numpy(),
+        'last_date': pd.to_datetime(totals['last_date']).dt.strftime('%Y-%m-%d').to_numpy(),
+        'mean_S': (totals['sum_S'] / n).to_numpy(),
+        'mean_U': (totals['sum_U'] / n).to_numpy(),
+        'mean_H': mean_H.to_numpy(),
+        'std_H': std_H.to_numpy(),
+        'frac_below': frac_below.to_numpy(),
+        'RHI': (mean_H - lambda_rhi * std_H - gamma_rhi * frac_below).to_numpy(),
+        'mean_g': (totals['sum_g'] / totals['n_g'].where(totals['n_g'] > 0)).to_numpy(),
+    })
+    for col in Q_COLS + S_COLS:
+        table[f'mean_{col}'] = (totals[f'sum_{col}'] / n).to_numpy()
+    return table
+
+def build_research_cohort_table(user_table: pd.DataFrame) -> pd.DataFrame:
+    """ユーザーごとの表から、コホート全体の要約（人数・分布）を作る"""
+    if user_table.empty:
+        return pd.DataFrame(columns=['metric', 'n_users', 'mean', 'std', 'min', 'q25', 'median', 'q75', 'max'])
+    metric_cols = ['n_records', 'mean_S', 'mean_U', 'mean_H', 'std_H', 'frac_below', 'RHI', 'mean_g']
+    described = user_table[metric_cols].describe().T
+    cohort = pd.DataFrame({
+        'metric': metric_cols,
+        'n_users': described['count'].astype(int).to_numpy(),
+        'mean': described['mean'].to_numpy(),
+        'std': described['std'].to_numpy(),
+        'min': described['min'].to_numpy(),
+        'q25': described['25%'].to_numpy(),
+        'median': described['50%'].to_numpy(),
+        'q75': described['75%'].to_numpy(),
+        'max': described['max'].to_numpy(),
+    })
+    return cohort
+
+def export_research_metrics(output_dir: str = 'research_export', alpha: float = 0.6, lambda_rhi: float = 0.5,
+                            gamma_rhi: float = 1.0, tau_rhi: float = 0.5, chunk_size: int = 5000,
+                            max_workers: int | None = None) -> dict:
+    """
+    研究用の一括集計ツール（メンテナンス用）。users テーブルの consent が True のユーザーだけを対象に、
+    ユーザーごとの表（research_users.csv）とコホートの要約（research_cohort.csv）を output_dir に書き出す。
+        python -c "import app; print(app.export_research_metrics())"
+    チャンクの計算は max_workers 個のプロセスに分散する（1 ならこのプロセスで順に計算する）。
+    ユーザーIDは Secrets の [research] id_salt を使って仮名化する。ソルトなしのハッシュは
+    ユーザー一覧から逆引きできてしまうため、id_salt が未設定なら ValueError を送出して何も書き出さない。
+    """
+    users_sheet_id = st.secrets["connections"]["gsheets"]["users_sheet_id"]
+    data_sheet_id = st.secrets["connections"]["gsheets"]["data_sheet_id"]
+    try:
+        salt = str(st.secrets.get("research", {}).get("id_salt", ''))
+    except FileNotFoundError:
+        salt = ''
+    if not salt:
+        raise ValueError("[research] id_salt が設定されていません。推測されにくい値を設定してから実行してください。")
+
+    consenting_user_ids = set()
+    for chunk in iter_data_chunks('users', users_sheet_id, columns=['user_id', 'consent'], chunk_size=chunk_size):
+        if 'consent' in chunk.columns:
+            consenting_user_ids.update(chunk.loc[chunk['consent'], 'user_id'].dropna().astype(str))
+
+    def consenting_chunks():
+        for chunk in iter_data_chunks('data', data_sheet_id, columns=RESEARCH_EXPORT_COLS, chunk_size=chunk_size):
+            chunk = chunk.drop(columns=['event_log'], errors='ignore')
+            chunk = chunk[chunk['user_id'].astype(str).isin(consenting_user_ids)]
+            if not chunk.empty:
+                yield chunk
+
+    partials = []
+    if max_workers == 1:
+        for chunk in consenting_chunks():
+            partials.append(_research_chunk_partials(chunk, alpha, tau_rhi))
+    else:
+        max_workers = max_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # 読み込みが計算より先行しすぎないよう、処理待ちのチャンク数を抑える
+            max_in_flight = 2 * max_workers
+            pending = deque()
+            for chunk in consenting_chunks():
+                pending.append(executor.submit(_research_chunk_partials, chunk, alpha, tau_rhi))
+                if len(pending) >= max_in_flight:
+                    partials.append(pending.popleft().result())
+            partials.extend(future.result() for future in pending)
+
+    user_table = build_research_user_table(_combine_research_partials(partials), lambda_rhi, gamma_rhi, salt)
+    cohort_table = build_research_cohort_table(user_table)
+    os.makedirs(output_dir, exist_ok=True)
+    user_table.to_csv(os.path.join(output_dir, 'research_users.csv'), index=False)
+    cohort_table.to_csv(os.path.join(output_dir, 'research_cohort.csv'), index=False)
+    return {'consenting_users': len(consenting_user_ids), 'exported_users': len(user_table), 'output_dir': output_dir}
+
+# --- D-10. イベントログの再暗号化 ---
+# 鍵はユーザーのパスワードから導出するため、一括の再暗号化はサーバー側ではできない。
+# ログイン中のセッションで旧形式の行を見つけたら、そのユーザーの行をまとめて v2 に置き換える。
+def reencrypt_legacy_logs(enc_manager: EncryptionManager, user_id: str, spreadsheet_id: str) -> int | None:
+    """
+    ユーザーの旧形式のイベントログを v2 に再暗号化して保存する。置き換えた行数を返す（失敗時は None）。
+    復号・暗号化はバッファ単位でまとめて行い、書き込みはユーザーの行を1回置き換えるだけ。
+    """
+    upgraded_count = 0
+
+    def upgrade(current_df: pd.DataFrame) -> pd.DataFrame:
+        nonlocal upgraded_count
+        if 'event_log' not in current_df.columns:
+            return current_df
+        mapping = enc_manager.upgrade_ciphertexts(current_df['event_log'])
+        upgraded_count = int(current_df['event_log'].isin(list(mapping)).sum())
+        current_df['event_log'] = current_df['event_log'].map(lambda value: mapping.get(value, value))
+        return current_df
+
+    if update_user_rows('data', spreadsheet_id, user_id, upgrade) is None:
+        return None
+    return upgraded_count
     # --- (D. データ永続化層 の後、E. UIコンポーネント の前に追加) ---
 
-def check_achievements(df: pd.DataFrame, rhi_results: dict, streak: int):
-    """ユーザーデータに基づいてアチーブメントの達成状況をチェックする"""
+def evaluate_achievements(inputs: dict, unlocked: set) -> set:
+    """
+    渡された入力だけで判定できる、まだ解除されていないアチーブメントを評価し、新しく解除されたものを返す。
+    1回の評価は、保存した1件の記録や RHI の結果だけを見るので、履歴の長さによらない。
+    """
     newly_unlocked = set()
-    currently_unlocked = st.session_state.unlocked_achievements.copy()
-
     for ach_id, details in ACHIEVEMENTS.items():
-        if ach_id not in currently_unlocked:
-            condition_met = False
-            # 条件判定をラムダ関数の引数の数で分岐
-            if 'streak' in details['condition'].__code__.co_varnames:
-                condition_met = details['condition'](df, streak)
-            elif 'rhi_results' in details['condition'].__code__.co_varnames:
-                 condition_met = details['condition'](df, rhi_results)
-            else:
-                condition_met = details['condition'](df)
-            
-            if condition_met:
-                newly_unlocked.add(ach_id)
+        if ach_id in unlocked or not all(name in inputs for name in details['inputs']):
+            continue
+        if details['condition'](**{name: inputs[name] for name in details['inputs']}):
+            newly_unlocked.add(ach_id)
+    return newly_unlocked
+
+def backfill_achievements(df: pd.DataFrame, streak_state: dict) -> set:
+    """
+    解除状態がまだ保存されていないユーザー向けに、既存の記録から一度だけまとめて判定する。
+    記録の条件は日々の記録の行（record_row_mask）に対してだけ評価し、連続記録は過去最長の連続日数で判定する
+    （RHI は次の表示時に判定される）。ガイドや q_t の更新だけの行では、保存時と同じく記録の条件を評価しない。
+    """
+    unlocked = set()
+    history_streak = {**streak_state, 'streak_current': streak_state.get('streak_longest', 0)}
+    unlocked |= evaluate_achievements({'streak': history_streak}, unlocked)
+    if 'date' in df.columns:
+        df = df.sort_values('date')
+    is_record = record_row_mask(df).to_numpy()
+    # ガイドで保存した最初の q_t の行は「更新」に数えない
+    q_rows_seen = 0
+    for record, record_row in zip(df.to_dict('records'), is_record):
+        has_q = any(pd.notna(record.get(col)) for col in Q_COLS)
+        if record_row:
+            candidates = evaluate_achievements({'record': record}, unlocked)
+            if has_q and q_rows_seen == 0:
+                candidates.discard('q_updated')
+            unlocked |= candidates
+        q_rows_seen += int(has_q)
+    return unlocked
+
+def parse_unlocked_achievements(record: dict | None) -> set | None:
+    """users テーブルの achievements 列（JSON の配列）を読む。まだ保存されていなければ None"""
+    raw = (record or {}).get('achievements')
+    if not isinstance(raw, str) or not raw.strip():
+        return None
+    try:
+        return {ach_id for ach_id in json.loads(raw) if ach_id in ACHIEVEMENTS}
+    except (ValueError, TypeError):
+        return None
 
+def check_achievements(inputs: dict, user_id: str, users_sheet_id: str):
+    """入力がそろったアチーブメントを判定し、新しく解除されたものを通知して users テーブルに保存する"""
+    newly_unlocked = evaluate_achievements(inputs, st.session_state.unlocked_achievements)
     if newly_unlocked:
         for ach_id in newly_unlocked:
             st.toast(f"{ACHIEVEMENTS[ach_id]['emoji']} 実績解除： {ACHIEVEMENTS[ach_id]['name']}", icon="🏆")
         st.session_state.unlocked_achievements.update(newly_unlocked)
-
-def calculate_streak(df: pd.DataFrame) -> int:
-    """連続記録日数を計算する"""
-    if df.empty:
-        return 0
-    
-    df_dates = df['date'].dropna().unique()
-    df_dates = sorted(list(df_dates), reverse=True)
-    
-    today = date.today()
-    streak = 0
-    
-    # 今日の記録があるか、または昨日の記録があるかで開始日を決める
-    if today in df_dates:
-        expected_date = today
-    elif (today - timedelta(days=1)) in df_dates:
-        expected_date = today - timedelta(days=1)
-        streak = 1 # 昨日は記録しているのでストリークは1から
-    else:
+        get_user_store(users_sheet_id).update(user_id, {'achievements': json.dumps(sorted(st.session_state.unlocked_achievements))})
+
+# 連続記録日数の状態は users テーブルに保存し、記録の保存時に1日分だけ進める。
+# streak_current は streak_last_date で終わる連続記録の日数（今日から見て途切れているかは表示時に判定する）。
+STREAK_COLS = ['streak_current', 'streak_longest', 'streak_last_date']
+
+def record_row_mask(df: pd.DataFrame) -> pd.Series:
+    """日々の記録の行（g_happiness か S のいずれかがある行）。ガイドや q_t の更新だけの行は含まない"""
+    record_cols = [c for c in ['g_happiness'] + S_COLS if c in df.columns]
+    if not record_cols:
+        return pd.Series(False, index=df.index)
+    return df[record_cols].notna().any(axis=1)
+
+def recorded_dates(df: pd.DataFrame) -> pd.Series:
+    """連続記録の計算に使う、日々の記録がある日付"""
+    if 'date' not in df.columns:
+        return pd.Series(dtype='datetime64[ns]')
+    return df.loc[record_row_mask(df), 'date']
+
+def streak_state_from_dates(dates) -> dict:
+    """記録日の配列から連続記録の状態をまとめて計算する（再計算・バックフィル用）"""
+    days = pd.to_datetime(pd.Series(dates), errors='coerce').dropna().to_numpy().astype('datetime64[D]')
+    days = np.unique(days)
+    if days.size == 0:
+        return {'streak_current': 0, 'streak_longest': 0, 'streak_last_date': None}
+    # 前日からの差が 1 日でないところで連続が切れる。切れ目ごとに番号を振り、番号ごとの日数を数える
+    run_ids = np.concatenate(([0], np.cumsum(np.diff(days).astype(np.int64) != 1)))
+    run_lengths = np.bincount(run_ids)
+    return {
+        'streak_current': int(run_lengths[-1]),
+        'streak_longest': int(run_lengths.max()),
+        'streak_last_date': pd.Timestamp(days[-1]).date(),
+    }
+
+def advance_streak_state(state: dict, record_date: date) -> dict | None:
+    """
+    record_date の記録を保存した後の状態を返す。
+    最終記録日より前の日付（過去分の追加・上書き）は連続がつながる可能性があるため None を返し、再計算に任せる。
+    """
+    last_date = state.get('streak_last_date')
+    if last_date is None:
+        return {'streak_current': 1, 'streak_longest': max(1, state.get('streak_longest', 0)), 'streak_last_date': record_date}
+    if record_date == last_date:
+        return dict(state)
+    if record_date < last_date:
+        return None
+    current = state['streak_current'] + 1 if record_date == last_date + timedelta(days=1) else 1
+    return {'streak_current': current, 'streak_longest': max(current, state['streak_longest']), 'streak_last_date': record_date}
+
+def current_streak(state: dict, today: date | None = None) -> int:
+    """今日か昨日まで記録が続いていれば、その連続日数を返す（それ以外は 0）"""
+    today = today or date.today()
+    last_date = state.get('streak_last_date')
+    if last_date is None or last_date < today - timedelta(days=1):
         return 0
+    return state['streak_current']
 
-    if streak == 0 and today in df_dates:
-        streak = 1
-        expected_date = today - timedelta(days=1)
+def parse_streak_state(record: dict | None) -> dict | None:
+    """users テーブルの行から連続記録の状態を読む。まだ保存されていなければ None"""
+    if not record:
+        return None
+    last_date = pd.to_datetime(record.get('streak_last_date'), errors='coerce')
+    current = pd.to_numeric(record.get('streak_current'), errors='coerce')
+    longest = pd.to_numeric(record.get('streak_longest'), errors='coerce')
+    if pd.isna(last_date) or pd.isna(current) or pd.isna(longest):
+        return None
+    return {'streak_current': int(current), 'streak_longest': int(longest), 'streak_last_date': last_date.date()}
 
-    for d in df_dates[1:]:
-        if d == expected_date:
-            streak += 1
-            expected_date -= timedelta(days=1)
-        else:
-            break
-            
-    return streak
+def calculate_streak(df: pd.DataFrame, today: date | None = None) -> int:
+    """連続記録日数を計算する"""
+    if df.empty or 'date' not in df.columns:
+        return 0
+    return current_streak(streak_state_from_dates(recorded_dates(df)), today)
 
 # --- E. UIコンポーネント ---
 def show_sample_dashboard():
@@ -914,41 +3569,21 @@ def get_safe_index(options, value):
 def migrate_and_ensure_schema(df: pd.DataFrame, user_id: str, sheet_id: str) -> pd.DataFrame:
     """
     ユーザーデータを読み込み、最新のスキーマに準拠しているか確認・修正する。
-    （擬似タイムスタンプ生成機能は削除）
+    古い行があれば移行ステップを適用し、このユーザーの行だけを保存し直す（シート全体は書き直さない）。
     """
-    EXPECTED_COLUMNS = ['user_id', 'date', 'record_timestamp', 'consent', 'mode'] + Q_COLS + S_COLS + ['g_happiness', 'event_log'] + ALL_ELEMENT_COLS
+    EXPECTED_COLUMNS = get_sheet_schema('data')
     
-    df_migrated = df.copy()
-    made_changes = False
-    
-    missing_cols = [col for col in EXPECTED_COLUMNS if col not in df_migrated.columns]
-    if missing_cols:
-        st.info("古いデータ形式を検出しました。スキーマを更新します...")
-        for col in missing_cols:
-            df_migrated[col] = pd.NA
-        made_changes = True
-
-    # 擬似タイムスタンプを生成していたロジックを完全に削除
-    # if 'record_timestamp' in df_migrated.columns:
-    #     ... (このブロック全体を削除)
+    df_migrated, upgraded_mask = upgrade_rows(df)
 
-    if made_changes:
-        st.info("データベースを最新の形式に更新しています...")
-        try:
-            all_data_df = read_data('data', sheet_id)
-            if not all_data_df.empty:
-                other_users_data = all_data_df[all_data_df['user_id'] != user_id]
-                all_data_df_updated = pd.concat([other_users_data, df_migrated], ignore_index=True)
-            else:
-                all_data_df_updated = df_migrated
-
-            if write_data('data', sheet_id, all_data_df_updated):
-                st.success("データ形式の更新が完了し、永続的に保存しました。")
-                return df_migrated
-            else:
-                st.error("スキーマ更新の保存に失敗しました。")
-        except Exception as e:
-            st.warning(f"スキーマ更新の保存中にエラーが発生しました: {e}")
+    if upgraded_mask.any():
+        st.info("古いデータ形式を検出しました。スキーマを更新します...")
+        # 他のレプリカが同時に書き込んでいても、最新の行を読み直して移行し直す
+        saved_df = update_user_rows('data', sheet_id, user_id, lambda current_df: upgrade_rows(current_df)[0])
+        if saved_df is not None:
+            st.success("データ形式の更新が完了し、永続的に保存しました。")
+            df_migrated = saved_df
+        else:
+            st.error("スキーマ更新の保存に失敗しました。")
     
     final_order = [col for col in EXPECTED_COLUMNS if col in df_migrated.columns] + [c for c in df_migrated.columns if c not in EXPECTED_COLUMNS]
     return df_migrated[final_order]
@@ -960,15 +3595,26 @@ def run_wizard_interface(container):
     
     with container:
         st.header("🧭 あなたの羅針盤を設定しましょう")
-        st.info("あなたの人生という航海で、何を大切にしたいかを見つけるための、最初のステップです。21の簡単な質問に答えることで、あなたの価値観の「たたき台」を一緒に探しましょう。")
+        st.info("あなたの人生という航海で、何を大切にしたいかを見つけるための、最初のステップです。いくつかの簡単な質問（最大21問）に答えることで、あなたの価値観の「たたき台」を一緒に探しましょう。")
+
+        # 適応モードでは、答えから順位が定まった時点で質問を打ち切る。詳細モードでは21問すべてに答える
+        st.toggle("全21問に答える（詳細モード）", key="q_wizard_full_mode",
+                  help="オフのときは、これまでの回答から最も判断に役立つ質問を選び、順位が安定したら終了します。")
+        comparisons = st.session_state.q_comparisons
+        pair = None
+        if st.session_state.q_wizard_step > 0:
+            if st.session_state.q_wizard_full_mode:
+                pair = next((p for p in pairs if p not in comparisons), None)
+            else:
+                pair = select_next_ahp_pair(comparisons, DOMAINS)
 
-        progress_value = (st.session_state.q_wizard_step - 1) / len(pairs) if st.session_state.q_wizard_step > 0 else 0
-        st.progress(progress_value, text=f"進捗: {st.session_state.q_wizard_step - 1} / {len(pairs)}")
+        answered_count = len(comparisons)
+        progress_value = answered_count / len(pairs) if pair is not None else 1.0
+        st.progress(progress_value, text=f"進捗: {answered_count} 問回答済み（最大 {len(pairs)} 問）")
 
-        if 0 < st.session_state.q_wizard_step <= len(pairs):
-            pair = pairs[st.session_state.q_wizard_step - 1]
+        if pair is not None:
             domain1, domain2 = pair
-            st.subheader(f"質問 {st.session_state.q_wizard_step}/{len(pairs)}")
+            st.subheader(f"質問 {answered_count + 1}")
             st.write("あなたの人生がより充実するために、今、より重要なのはどちらですか？")
             
             col1, col2 = st.columns(2)
@@ -992,32 +3638,26 @@ def run_wizard_interface(container):
         else:
             if st.session_state.q_comparisons:
                 st.success("✅ 診断完了！あなたの価値観の推定値が計算されました。")
-                estimated_weights = calculate_ahp_weights(st.session_state.q_comparisons, DOMAINS)
+                # 聞かなかった組は同等とみなさず、回答済みの組だけから推定する（Harker 法）
+                estimated_weights = calculate_ahp_weights(st.session_state.q_comparisons, DOMAINS, harker=True)
+                consistency_ratio = calculate_ahp_consistency(st.session_state.q_comparisons, DOMAINS, harker=True)
                 
                 st.session_state.q_values = {domain: weight for domain, weight in zip(DOMAINS, estimated_weights)}
+                if consistency_ratio > AHP_CR_WARNING:
+                    st.warning(f"回答の中に、お互いに食い違う選択（例: A>B, B>C なのに C>A）が含まれているようです（整合比 CR = {consistency_ratio:.2f}）。結果が実感と違う場合は、もう一度診断をやり直してみてください。")
                 
                 st.write("推定されたあなたの価値観:")
                 st.bar_chart({DOMAIN_NAMES_JP_DICT[k]: v for k, v in st.session_state.q_values.items()})
 
                 if st.button("✅ この価値観で航海を始める"):
                     user_id = st.session_state.user_id
-                    all_data_df = read_data('data', st.secrets["connections"]["gsheets"]["data_sheet_id"])
                     
-                    new_record = {'user_id': user_id, 'date': date.today(), 'record_timestamp': datetime.now(JST)}
+                    new_record = {'user_id': user_id, 'date': date.today(), 'record_timestamp': datetime.now(JST), 'schema_version': DATA_SCHEMA_VERSION}
                     new_record.update({f'q_{d}': v for d, v in st.session_state.q_values.items()})
                     new_df_row = pd.DataFrame([new_record])
 
-                    all_data_df_updated = pd.concat([all_data_df, new_df_row], ignore_index=True)
-
-                    # ★★★ TypeError バグ修正：並べ替えの前にデータ型を統一 ★★★
-                    if 'date' in all_data_df_updated.columns:
-                        all_data_df_updated['date'] = pd.to_datetime(all_data_df_updated['date'], errors='coerce')
-                    if 'record_timestamp' in all_data_df_updated.columns:
-                        all_data_df_updated['record_timestamp'] = pd.to_datetime(all_data_df_updated['record_timestamp'], errors='coerce')
-                    
-                    all_data_df_updated = all_data_df_updated.sort_values(by=['user_id', 'date', 'record_timestamp']).reset_index(drop=True)
-
-                    if write_data('data', st.secrets["connections"]["gsheets"]["data_sheet_id"], all_data_df_updated):
+                    ticket = get_write_queue().submit_append('data', st.secrets["connections"]["gsheets"]["data_sheet_id"], new_df_row)
+                    if wait_for_write(ticket):
                         st.session_state.auth_status = "AWAITING_DEMOGRAPHICS"
                         st.success("価値観を保存しました。次に、任意でプロフィール情報をご登録ください。")
                         time.sleep(1)
@@ -1038,9 +3678,8 @@ def run_demographics_interface(container):
         """)
         
         with st.form("profile_form_onboarding"):
-            users_df_for_profile = read_data('users', st.secrets["connections"]["gsheets"]["users_sheet_id"])
-            user_info = users_df_for_profile[users_df_for_profile['user_id'] == st.session_state.user_id]
-            current_profile = user_info.iloc[0] if not user_info.empty else pd.Series()
+            user_store = get_user_store(st.secrets["connections"]["gsheets"]["users_sheet_id"])
+            current_profile = user_store.get(st.session_state.user_id) or {}
             
             # 全てのプロフィール項目を追加
             age_group = st.selectbox("年代", options=DEMOGRAPHIC_OPTIONS['age_group'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['age_group'], current_profile.get('age_group')))
@@ -1090,21 +3729,21 @@ def run_demographics_interface(container):
                 skip_submitted = st.form_submit_button("⏩ 今は回答しない（スキップ）", use_container_width=True)
 
             if profile_submitted:
-                users_df_update = read_data('users', st.secrets["connections"]["gsheets"]["users_sheet_id"])
-                # 全てのプロフィール項目を更新
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'age_group'] = age_group
-                # ...このように2行に修正します
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'gender_identity'] = gender_identity if gender_identity != 'その他（自由記述）' else gender_identity_free_text
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'gender_assigned_at_birth_differs'] = gender_assigned_at_birth_differs
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'occupation_category'] = occupation_category
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'income_range'] = income_range
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'marital_status'] = marital_status
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'has_children'] = has_children
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'living_situation'] = living_situation
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'chronic_illness'] = chronic_illness
-                users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'country'] = country
+                # 全てのプロフィール項目を更新（このユーザーの行だけを書き換える）
+                profile_changes = {
+                    'age_group': age_group,
+                    'gender_identity': gender_identity if gender_identity != 'その他（自由記述）' else gender_identity_free_text,
+                    'gender_assigned_at_birth_differs': gender_assigned_at_birth_differs,
+                    'occupation_category': occupation_category,
+                    'income_range': income_range,
+                    'marital_status': marital_status,
+                    'has_children': has_children,
+                    'living_situation': living_situation,
+                    'chronic_illness': chronic_illness,
+                    'country': country,
+                }
                 
-                if write_data('users', st.secrets["connections"]["gsheets"]["users_sheet_id"], users_df_update):
+                if user_store.update(st.session_state.user_id, profile_changes):
                     st.session_state.auth_status = "INITIALIZING_SESSION"
                     st.success("ご協力ありがとうございます！メイン画面に移動します。")
                     time.sleep(1)
@@ -1203,6 +3842,7 @@ def main():
         st.session_state.q_values = {domain: 100 // len(DOMAINS) for domain in DOMAINS}
         st.session_state.q_values[DOMAINS[0]] += 100 % len(DOMAINS)
     if 'q_wizard_step' not in st.session_state: st.session_state.q_wizard_step = 0
+    if 'q_wizard_full_mode' not in st.session_state: st.session_state.q_wizard_full_mode = False
     if 'q_comparisons' not in st.session_state: st.session_state.q_comparisons = {}
     if 'record_streak' not in st.session_state: st.session_state.record_streak = 0
     if 'unlocked_achievements' not in st.session_state: st.session_state.unlocked_achievements = set()
@@ -1253,18 +3893,15 @@ def main():
                         submitted_login = st.form_submit_button("⚓ 乗船する", use_container_width=True)
                         if submitted_login:
                             if user_id_input and password_input:
-                                users_df = read_data('users', users_sheet_id)
-                                if not users_df.empty:
-                                    user_record = users_df[users_df['user_id'] == user_id_input]
-                                    if not user_record.empty and EncryptionManager.check_password(password_input, user_record.iloc[0]['password_hash']):
-                                        st.session_state.user_id = user_id_input
-                                        st.session_state.enc_manager = EncryptionManager(password_input)
-                                        st.session_state.auth_status = "CHECKING_USER_DATA"
-                                        st.rerun()
-                                    else:
-                                        st.error("合い言葉またはパスワードが間違っています。")
+                                user_record = get_user_store(users_sheet_id).get(user_id_input)
+                                enc_manager = get_password_hash_pool().login(password_input, user_record['password_hash'], user_id_input) if user_record is not None else None
+                                if enc_manager is not None:
+                                    st.session_state.user_id = user_id_input
+                                    st.session_state.enc_manager = enc_manager
+                                    st.session_state.auth_status = "CHECKING_USER_DATA"
+                                    st.rerun()
                                 else:
-                                    st.error("その合い言葉を持つ船は見つかりませんでした。")
+                                    st.error("合い言葉またはパスワードが間違っています。")
                             else:
                                 st.warning("両方のフィールドを入力してください。")
                 
@@ -1289,19 +3926,16 @@ def main():
                             elif new_password != new_password_confirm: st.error("パスワードが一致しません。")
                             else:
                                 new_user_id = f"user_{uuid.uuid4().hex[:12]}"
-                                hashed_pw = EncryptionManager.hash_password(new_password)
-                                
-                                users_df = read_data('users', users_sheet_id)
+                                hashed_pw, enc_manager = get_password_hash_pool().register(new_password, new_user_id)
                                 
                                 new_user_data = { 'user_id': new_user_id, 'password_hash': hashed_pw, 'consent': consent }
                                 for key in DEMOGRAPHIC_OPTIONS.keys():
                                     new_user_data[key] = '未選択'
 
-                                new_user_df = pd.DataFrame([new_user_data])
-                                updated_users_df = pd.concat([users_df, new_user_df], ignore_index=True)
-                                if write_data('users', users_sheet_id, updated_users_df):
+                                # 新しいユーザーの1行だけを追記する
+                                if get_user_store(users_sheet_id).insert(new_user_data):
                                     st.session_state.user_id = new_user_id
-                                    st.session_state.enc_manager = EncryptionManager(new_password)
+                                    st.session_state.enc_manager = enc_manager
                                     st.session_state.auth_status = "AWAITING_ID"
                                     st.rerun()
                     # --- ★★★ ここまでが新しいサイドバーログインのロジック ★★★ ---
@@ -1404,9 +4038,7 @@ def main():
                         elif new_password != new_password_confirm: st.error("パスワードが一致しません。")
                         else:
                             new_user_id = f"user_{uuid.uuid4().hex[:12]}"
-                            hashed_pw = EncryptionManager.hash_password(new_password)
-                            
-                            users_df = read_data('users', users_sheet_id)
+                            hashed_pw, enc_manager = get_password_hash_pool().register(new_password, new_user_id)
                             
                             new_user_data = {
                                 'user_id': new_user_id,
@@ -1416,11 +4048,10 @@ def main():
                             for key in DEMOGRAPHIC_OPTIONS.keys():
                                 new_user_data[key] = '未選択'
 
-                            new_user_df = pd.DataFrame([new_user_data])
-                            updated_users_df = pd.concat([users_df, new_user_df], ignore_index=True)
-                            if write_data('users', users_sheet_id, updated_users_df):
+                            # 新しいユーザーの1行だけを追記する
+                            if get_user_store(users_sheet_id).insert(new_user_data):
                                 st.session_state.user_id = new_user_id
-                                st.session_state.enc_manager = EncryptionManager(new_password)
+                                st.session_state.enc_manager = enc_manager
                                 st.session_state.auth_status = "AWAITING_ID"
                                 st.rerun()
 
@@ -1431,28 +4062,24 @@ def main():
                     submitted = st.form_submit_button("⚓ 乗船する", use_container_width=True)
                     if submitted:
                         if user_id_input and password_input:
-                            users_df = read_data('users', users_sheet_id)
-                            if not users_df.empty:
-                                user_record = users_df[users_df['user_id'] == user_id_input]
-                                if not user_record.empty and EncryptionManager.check_password(password_input, user_record.iloc[0]['password_hash']):
-                                    st.session_state.user_id = user_id_input
-                                    st.session_state.enc_manager = EncryptionManager(password_input)
-                                    st.session_state.auth_status = "CHECKING_USER_DATA"
-                                    st.success("乗船に成功しました！データを読み込んでいます...")
-                                    time.sleep(1)
-                                    st.rerun()
-                                else:
-                                    st.error("合い言葉またはパスワードが間違っています。")
+                            user_record = get_user_store(users_sheet_id).get(user_id_input)
+                            enc_manager = get_password_hash_pool().login(password_input, user_record['password_hash'], user_id_input) if user_record is not None else None
+                            if enc_manager is not None:
+                                st.session_state.user_id = user_id_input
+                                st.session_state.enc_manager = enc_manager
+                                st.session_state.auth_status = "CHECKING_USER_DATA"
+                                st.success("乗船に成功しました！データを読み込んでいます...")
+                                time.sleep(1)
+                                st.rerun()
                             else:
-                                st.error("その合い言葉を持つ船は見つかりませんでした。")
+                                st.error("合い言葉またはパスワードが間違っています。")
                         else:
                             st.warning("合い言葉とパスワードの両方を入力してください。")
 
     elif auth_status == "CHECKING_USER_DATA":
         user_id = st.session_state.user_id
-        all_data_df = read_data('data', data_sheet_id)
-        if not all_data_df.empty and 'user_id' in all_data_df.columns and user_id in all_data_df['user_id'].values:
-            user_data_df = all_data_df[all_data_df['user_id'] == user_id].copy()
+        user_data_df = read_user_data('data', data_sheet_id, user_id).copy()
+        if not user_data_df.empty:
             user_data_df = migrate_and_ensure_schema(user_data_df, user_id, data_sheet_id)
             
             has_q_data = not user_data_df[Q_COLS].dropna(how='all').empty
@@ -1470,8 +4097,8 @@ def main():
 
     elif auth_status == "INITIALIZING_SESSION":
         user_id = st.session_state.user_id
-        all_data_df = read_data('data', data_sheet_id)
-        user_data_df = all_data_df[all_data_df['user_id'] == user_id].copy()
+        # セッション初期化に必要な列だけを読み込む
+        user_data_df = read_user_data('data', data_sheet_id, user_id, columns=['record_timestamp', 'alpha', 'lambda', 'gamma'] + Q_COLS).copy()
         
         sortable_df = pd.DataFrame()
         if 'record_timestamp' in user_data_df.columns:
@@ -1483,7 +4110,7 @@ def main():
         if not q_data_rows.empty:
             latest_q_row = q_data_rows.iloc[0]
             latest_q_dict = latest_q_row[Q_COLS].to_dict()
-            st.session_state.q_values = {key.replace('q_', ''): int(val) for key, val in latest_q_dict.items() if isinstance(val, (int, float)) and pd.notna(val)}
+            st.session_state.q_values = {key.replace('q_', ''): int(val) for key, val in latest_q_dict.items() if pd.notna(val)}
         else:
             st.session_state.q_values = {domain: 100 // len(DOMAINS) for domain in DOMAINS}
             st.session_state.q_values[DOMAINS[0]] += 100 % len(DOMAINS)
@@ -1507,10 +4134,40 @@ def main():
     elif auth_status == "LOGGED_IN_UNLOCKED":
         user_id = st.session_state.user_id
         
-        all_data_df = read_data('data', data_sheet_id)
-        user_data_df = all_data_df[all_data_df['user_id'] == user_id].copy()
-
-        st.session_state.record_streak = calculate_streak(user_data_df)
+        user_data_df = read_user_data('data', data_sheet_id, user_id).copy()
+
+        # 旧形式の暗号文が残っていれば、セッション中に一度だけ v2 へ再暗号化する
+        if (not st.session_state.get('legacy_logs_checked') and 'event_log' in user_data_df.columns
+                and user_data_df['event_log'].map(EncryptionManager.is_legacy_ciphertext).any()):
+            if reencrypt_legacy_logs(st.session_state.enc_manager, user_id, data_sheet_id) is not None:
+                user_data_df = read_user_data('data', data_sheet_id, user_id).copy()
+        st.session_state.legacy_logs_checked = True
+
+        # 連続記録の状態はセッションの最初に一度だけ users テーブルから読み、以後の再実行では読み直さない。
+        # 保存されていない・記録と食い違う場合は、記録日の配列から再計算して保存し直す
+        if st.session_state.get('streak_state') is None:
+            user_store = get_user_store(users_sheet_id)
+            stored_streak_state = parse_streak_state(user_store.get(user_id))
+            streak_state = stored_streak_state
+            record_dates = recorded_dates(user_data_df)
+            latest_date = pd.to_datetime(record_dates, errors='coerce').max()
+            latest_date = None if pd.isna(latest_date) else latest_date.date()
+            if streak_state is None or streak_state['streak_last_date'] != latest_date:
+                streak_state = streak_state_from_dates(record_dates)
+                if streak_state['streak_last_date'] is not None:
+                    user_store.update(user_id, {**streak_state, 'streak_last_date': streak_state['streak_last_date'].isoformat()})
+                elif stored_streak_state is not None:
+                    # 記録の行がないのに保存されていた状態（ガイドの行から数えていた頃のもの）は消しておく
+                    user_store.update(user_id, {**streak_state, 'streak_last_date': ''})
+            st.session_state.streak_state = streak_state
+
+            # 解除済みのアチーブメントも同様に一度だけ読み、未保存なら既存の記録から判定して保存する
+            unlocked = parse_unlocked_achievements(user_store.get(user_id))
+            if unlocked is None:
+                unlocked = backfill_achievements(user_data_df, streak_state)
+                user_store.update(user_id, {'achievements': json.dumps(sorted(unlocked))})
+            st.session_state.unlocked_achievements = set(unlocked)
+        st.session_state.record_streak = current_streak(st.session_state.streak_state)
             
         st.sidebar.header(f"ようこそ、{user_id} さん！")
         st.sidebar.metric("🔥 連続記録日数", f"{st.session_state.record_streak} 日")
@@ -1633,15 +4290,15 @@ def main():
                         'record_timestamp': datetime.now(),
                         'alpha': st.session_state.alpha_value,
                         'lambda': st.session_state.lambda_value,
-                        'gamma': st.session_state.gamma_value
+                        'gamma': st.session_state.gamma_value,
+                        'schema_version': DATA_SCHEMA_VERSION
                     }
                     new_value_record.update({f'q_{d}': v for d, v in st.session_state.q_values.items()})
                     
                     new_df_row = pd.DataFrame([new_value_record])
-                    all_data_df_for_values = read_data('data', data_sheet_id)
-                    all_data_df_updated = pd.concat([all_data_df_for_values, new_df_row], ignore_index=True)
                     
-                    if write_data('data', data_sheet_id, all_data_df_updated):
+                    ticket = get_write_queue().submit_append('data', data_sheet_id, new_df_row)
+                    if wait_for_write(ticket):
                         st.success("あなたの羅針盤を更新しました！")
                         st.balloons()
                         time.sleep(1)
@@ -1758,16 +4415,15 @@ def main():
                         if mode_string == 'deep':
                             new_record.update({col: pd.NA for col in ALL_ELEMENT_COLS})
                             new_record.update(s_element_values)
-                            s_domain_scores = calculate_s_domains_from_row(pd.Series(new_record))
-                            new_record.update(s_domain_scores.to_dict())
+                            s_domain_scores = deep_domain_scores(pd.DataFrame([new_record]))[0]
+                            new_record.update({col: int(score) if not np.isnan(score) else np.nan for col, score in zip(S_COLS, s_domain_scores)})
                         else: # quick
                             new_record.update(s_domain_values)
 
                         encrypted_log = st.session_state.enc_manager.encrypt_log(event_log)
                         
-                        users_df_in_form = read_data('users', users_sheet_id)
-                        user_info_in_form = users_df_in_form[users_df_in_form['user_id'] == user_id]
-                        consent_status = user_info_in_form['consent'].iloc[0] if not user_info_in_form.empty and 'consent' in user_info_in_form.columns else False
+                        user_info_in_form = get_user_store(users_sheet_id).get(user_id) or {}
+                        consent_status = user_info_in_form.get('consent', False)
 
                         new_record.update({
                             'user_id': user_id, 
@@ -1776,41 +4432,26 @@ def main():
                             'mode': mode_string,
                             'consent': consent_status,
                             'g_happiness': int(g_happiness), 
-                            'event_log': encrypted_log
+                            'event_log': encrypted_log,
+                            'schema_version': DATA_SCHEMA_VERSION
                         })
                         new_record.update({f'q_{d}': v for d, v in st.session_state.q_values.items()})
 
                         new_df_row = pd.DataFrame([new_record])
 
-                        # 2. 既存の全データを読み込む
-                        try:
-                            df_existing = read_data('data', data_sheet_id)
-                        except Exception as e:
-                            st.warning(f"既存データの読み込みに失敗しました。新しいデータのみで保存を試みます。エラー: {e}")
-                            df_existing = pd.DataFrame()
-
-                        # 3. 安全なマージ処理（「同じユーザー」かつ「同じ日付」の行だけを置換）
-                        if df_existing.empty:
-                            df_to_write = new_df_row
-                        else:
-                            # 既存データから、今回保存するユーザーと日付に一致する行を"除く"
-                            # これにより、他ユーザーのデータや、同じ日付でもuser_idが異なる行（デバッグ行など）を保護する
-                            condition_to_remove = (df_existing['user_id'] == user_id) & (pd.to_datetime(df_existing['date']).dt.date == target_date)
-                            df_preserved = df_existing[~condition_to_remove]
-                            
-                            # 除外したデータフレームに、新しいレコードを追加する
-                            df_to_write = pd.concat([df_preserved, new_df_row], ignore_index=True)
-
-                        # 4. 書き込み前の最終的なデータ型統一と並べ替え
-                        if 'date' in df_to_write.columns:
-                            df_to_write['date'] = pd.to_datetime(df_to_write['date'], errors='coerce')
-                        if 'record_timestamp' in df_to_write.columns:
-                            df_to_write['record_timestamp'] = pd.to_datetime(df_to_write['record_timestamp'], errors='coerce')
-
-                        df_to_write = df_to_write.sort_values(by=['user_id', 'date', 'record_timestamp']).reset_index(drop=True)
-                        
-                        # 5. データベースへの書き込みとキャッシュのクリア
-                        if write_data('data', data_sheet_id, df_to_write):
+                        # 2. 「同じユーザー」かつ「同じ日付」の行だけを置換（なければ追記）する
+                        #    シート全体は書き直さないため、他ユーザーの行や同時保存を巻き込まない
+                        #    保存は書き込みキューでまとめて送信し、コミットを待ってから表示を更新する
+                        ticket = get_write_queue().submit_upsert('data', data_sheet_id, new_df_row, key_cols=('user_id', 'date'))
+                        if wait_for_write(ticket):
+                            # 連続記録の状態を1日分だけ進める（過去の日付の保存は記録日から再計算する）
+                            streak_state = advance_streak_state(st.session_state.streak_state, target_date)
+                            if streak_state is None:
+                                streak_state = streak_state_from_dates(list(recorded_dates(user_data_df)) + [target_date])
+                            if streak_state != st.session_state.streak_state:
+                                get_user_store(users_sheet_id).update(user_id, {**streak_state, 'streak_last_date': streak_state['streak_last_date'].isoformat()})
+                            st.session_state.streak_state = streak_state
+                            check_achievements({'record': new_record, 'streak': streak_state}, user_id, users_sheet_id)
                             st.success(f'{target_date.strftime("%Y-%m-%d")} の記録を永続的に保存しました！')
                             st.balloons()
                             time.sleep(1)
@@ -1834,21 +4475,35 @@ def main():
                 st.info('まだ記録がありません。まずは「今日の記録」タブから、最初の日誌を記録してみましょう！')
                 show_sample_dashboard()
             else:
-                df_processed = calculate_metrics(df_analysis_data, alpha=st.session_state.alpha_value)
+                alpha_value = st.session_state.alpha_value
+                data_revision = get_revision_registry().user_revision('data', data_sheet_id, user_id)
+                df_processed = get_metrics_memo().get_or_compute(
+                    (user_id, data_revision, alpha_value),
+                    lambda: calculate_metrics_incremental(df_analysis_data, user_id, data_sheet_id, alpha=alpha_value)
+                )
                 if 'date' in df_processed.columns:
                     df_processed['date'] = pd.to_datetime(df_processed['date'])
                     df_processed = df_processed.sort_values('date')
+                # 期間や閾値の切り替えは、要約表の累積値から引くだけで済ませる
+                daily_summary = get_daily_summary(user_id, data_revision, alpha_value, df_processed)
                 
                 st.subheader("📈 期間分析とリスク評価 (RHI)")
                 
                 period_options = [7, 30, 90]
                 
                 df_period = df_processed
+                period_days = len(df_processed)
                 if len(df_processed) >= 7:
                     valid_periods = [p for p in period_options if len(df_processed) >= p]
                     default_index = len(valid_periods) - 1 if valid_periods else 0
-                    selected_period = st.selectbox("分析期間を選択してください（日）:", valid_periods, index=default_index)
+                    custom_label = "任意の日数"
+                    selected_period = st.selectbox("分析期間を選択してください（日）:", valid_periods + [custom_label], index=default_index)
+                    if selected_period == custom_label:
+                        selected_period = int(st.number_input(
+                            "分析期間（日）", min_value=7, max_value=len(df_processed), value=min(14, len(df_processed)), step=1
+                        ))
                     df_period = df_processed.tail(selected_period)
+                    period_days = selected_period
                 
                     st.markdown("##### 分析の閾値を設定")
                     tau_param = st.slider(
@@ -1856,10 +4511,10 @@ def main():
                         help="この値を下回る日を「不調な日」としてカウントし、RHIの計算に使用します。"
                     )
 
-                    rhi_results = calculate_rhi_metrics(df_period, 
-                                                        st.session_state.lambda_value, 
-                                                        st.session_state.gamma_value, 
-                                                        tau_param)
+                    rhi_results = daily_summary.rhi(period_days,
+                                                    st.session_state.lambda_value,
+                                                    st.session_state.gamma_value,
+                                                    tau_param)
                                                         
                     st.markdown("##### 分析結果")
                     col1a, col2a, col3a, col4a = st.columns(4)
@@ -1868,7 +4523,18 @@ def main():
                     col3a.metric("不調日数割合", f"{rhi_results['frac_below']:.1%}")
                     col4a.metric("リスク調整済・幸福指数 (RHI)", f"{rhi_results['RHI']:.3f}", delta=f"{rhi_results['RHI'] - rhi_results['mean_H']:.3f} (平均との差)")
                     
-                    check_achievements(df_period, rhi_results, st.session_state.record_streak)
+                    rolling_rhi = daily_summary.rolling_rhi(period_days,
+                                                            st.session_state.lambda_value,
+                                                            st.session_state.gamma_value,
+                                                            tau_param)
+                    with st.expander(f"▼ RHI の推移（各日までの直近{period_days}日）"):
+                        fig_rhi = go.Figure()
+                        fig_rhi.add_trace(go.Scatter(x=rolling_rhi['date'], y=rolling_rhi['RHI'], mode='lines', name='RHI', line=dict(color='purple')))
+                        fig_rhi.add_trace(go.Scatter(x=rolling_rhi['date'], y=rolling_rhi['mean_H'], mode='lines', name='平均調和度 (H̄)', line=dict(color='blue', dash='dot')))
+                        fig_rhi.add_hline(y=0.2, line_dash='dash', line_color='red')
+                        st.plotly_chart(fig_rhi, use_container_width=True)
+
+                    check_achievements({'rhi': rhi_results}, user_id, users_sheet_id)
 
                     if rhi_results['RHI'] < 0.2: 
                         st.error("""
@@ -1880,7 +4546,13 @@ def main():
                     st.markdown("---")
                     st.subheader("🧭 次の航海へのヒント")
 
-                    focus_domain, proposal = generate_intervention_proposal(df_period, rhi_results)
+                    focus_domain, proposal = generate_intervention_proposal(
+                        df_period, rhi_results, user_id,
+                        alpha=alpha_value,
+                        lambda_rhi=st.session_state.lambda_value,
+                        gamma_rhi=st.session_state.gamma_value,
+                        tau_rhi=tau_param,
+                    )
 
                     if focus_domain and proposal:
                         with st.container(border=True):
@@ -1895,7 +4567,7 @@ def main():
                     st.info(f"現在{len(df_processed)}日分の有効なデータがあります。期間分析（RHIなど）には最低7日分のデータが必要です。")
                 
                 if not df_processed.empty:
-                    analyze_discrepancy(df_processed)
+                    analyze_discrepancy(df_processed, gap_std=daily_summary.gap_stats(len(df_processed))[1])
                     
                     st.markdown("---")
                     st.subheader("🗺️ あなたの心の航海図")
@@ -1922,8 +4594,7 @@ def main():
                             """)
                         
                         df_plot['insight_gap'] = df_plot['g_happiness'] - df_plot['H_scaled']
-                        gap_mean = df_plot['insight_gap'].mean()
-                        gap_std = df_plot['insight_gap'].std()
+                        gap_mean, gap_std = daily_summary.gap_stats(period_days)
                         upper_band = gap_mean + 1.5 * gap_std
                         lower_band = gap_mean - 1.5 * gap_std
 
@@ -1945,7 +4616,7 @@ def main():
                         
                         latest_q_values = np.array([st.session_state.q_values[d] for d in DOMAINS])
                         avg_q = latest_q_values
-                        avg_s = df_period[S_COLS].mean().values
+                        avg_s = daily_summary.mean_s(period_days)
                         
                         s_achieved_ratio = avg_s / 100.0 
                         s_plot = avg_q * s_achieved_ratio
@@ -1993,7 +4664,7 @@ def main():
                             - **白色**は、二つの要素に明確な関係性が見られない（無相関）ことを示します。
                             """)
                         
-                        corr_df = df_period[S_COLS].corr()
+                        corr_df = daily_summary.corr_s(period_days)
                         corr_df.fillna(0, inplace=True)
                         corr_df.columns = DOMAIN_NAMES_JP_VALUES
                         corr_df.index = DOMAIN_NAMES_JP_VALUES
@@ -2009,7 +4680,7 @@ def main():
                             """)
                         
                         df_period_logs = df_period.copy()
-                        df_period_logs['event_log'] = df_period_logs['event_log'].apply(st.session_state.enc_manager.decrypt_log)
+                        df_period_logs['event_log'] = st.session_state.enc_manager.decrypt_many(df_period_logs['event_log'])
                         
                         word_impact = {}
                         mean_h_total = df_period_logs['H'].mean()
@@ -2045,7 +4716,7 @@ def main():
                     st.subheader('📖 全記録データ')
                     df_display = user_data_df.copy()
                     if 'event_log' in df_display.columns:
-                        df_display['event_log'] = df_display['event_log'].apply(st.session_state.enc_manager.decrypt_log)
+                        df_display['event_log'] = st.session_state.enc_manager.decrypt_many(df_display['event_log'])
                         df_display.rename(columns={'event_log': 'イベントログ（復号済）'}, inplace=True)
                     st.dataframe(df_display.drop(columns=['user_id'], errors='ignore').sort_values(by='date', ascending=False).round(3))
 
@@ -2074,14 +4745,13 @@ def main():
             
             with st.container(border=True):
                 st.subheader("🔒 プライバシー設定")
-                users_df_privacy = read_data('users', users_sheet_id)
-                user_info_privacy = users_df_privacy[users_df_privacy['user_id'] == user_id]
-                current_consent = user_info_privacy['consent'].iloc[0] if not user_info_privacy.empty and 'consent' in user_info_privacy.columns else False
+                user_store = get_user_store(users_sheet_id)
+                user_info_privacy = user_store.get(user_id) or {}
+                current_consent = bool(user_info_privacy.get('consent', False))
                 
                 new_consent = st.checkbox("匿名化された数値データを学術研究に利用することに同意する", value=current_consent)
                 if new_consent != current_consent:
-                    users_df_privacy.loc[users_df_privacy['user_id'] == user_id, 'consent'] = new_consent
-                    if write_data('users', users_sheet_id, users_df_privacy):
+                    if user_store.update(user_id, {'consent': new_consent}):
                         st.success("研究協力への同意状況を更新しました。")
                     else:
                         st.error("設定の保存に失敗しました。")
@@ -2090,9 +4760,7 @@ def main():
             with st.container(border=True):
                 st.subheader("👤 プロフィール情報（研究協力用）")
                 with st.form("profile_form"):
-                    users_df_for_profile = read_data('users', users_sheet_id)
-                    user_info = users_df_for_profile[users_df_for_profile['user_id'] == user_id]
-                    current_profile = user_info.iloc[0] if not user_info.empty else pd.Series()
+                    current_profile = user_store.get(user_id) or {}
                     
                     # 全てのプロフィール項目を追加
                     age_group = st.selectbox("年代", options=DEMOGRAPHIC_OPTIONS['age_group'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['age_group'], current_profile.get('age_group')))
@@ -2137,21 +4805,21 @@ def main():
                     profile_submitted = st.form_submit_button("プロフィールを保存する", use_container_width=True)
 
                     if profile_submitted:
-                        users_df_update = read_data('users', users_sheet_id)
-                        # 全てのプロフィール項目を更新
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'age_group'] = age_group
-                        # ...このように2行に修正します
-                        users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'gender_identity'] = gender_identity if gender_identity != 'その他（自由記述）' else gender_identity_free_text
-                        users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'gender_assigned_at_birth_differs'] = gender_assigned_at_birth_differs
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'occupation_category'] = occupation_category
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'income_range'] = income_range
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'marital_status'] = marital_status
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'has_children'] = has_children
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'living_situation'] = living_situation
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'chronic_illness'] = chronic_illness
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'country'] = country
+                        # 全てのプロフィール項目を更新（このユーザーの行だけを書き換える）
+                        profile_changes = {
+                            'age_group': age_group,
+                            'gender_identity': gender_identity if gender_identity != 'その他（自由記述）' else gender_identity_free_text,
+                            'gender_assigned_at_birth_differs': gender_assigned_at_birth_differs,
+                            'occupation_category': occupation_category,
+                            'income_range': income_range,
+                            'marital_status': marital_status,
+                            'has_children': has_children,
+                            'living_situation': living_situation,
+                            'chronic_illness': chronic_illness,
+                            'country': country,
+                        }
                         
-                        if write_data('users', users_sheet_id, users_df_update):
+                        if user_store.update(user_id, profile_changes):
                             st.success("プロフィール情報を更新しました！")
                             time.sleep(1)
                             st.rerun()
@@ -2163,7 +4831,7 @@ def main():
                 if not user_data_df.empty:
                     df_export = user_data_df.copy()
                     if 'event_log' in df_export.columns:
-                        df_export['event_log_decrypted'] = df_export['event_log'].apply(st.session_state.enc_manager.decrypt_log)
+                        df_export['event_log_decrypted'] = st.session_state.enc_manager.decrypt_many(df_export['event_log'])
                     
                     csv_export = df_export.to_csv(index=False).encode('utf-8')
                     st.download_button(label="📥 全データをCSV形式でダウンロード", data=csv_export, file_name=f'harmony_data_{user_id}.csv', use_container_width=True)
@@ -2176,14 +4844,11 @@ def main():
                     delete_submitted = st.form_submit_button("本当にアカウントと全データを完全に削除する", type="primary", use_container_width=True)
 
                     if delete_submitted:
-                        users_df_to_delete = read_data('users', users_sheet_id)
-                        user_record = users_df_to_delete[users_df_to_delete['user_id'] == user_id]
-                        if not user_record.empty and EncryptionManager.check_password(password_for_delete, user_record.iloc[0]['password_hash']):
-                            users_df_updated = users_df_to_delete[users_df_to_delete['user_id'] != user_id]
-                            if write_data('users', users_sheet_id, users_df_updated):
-                                all_data_df_to_delete = read_data('data', data_sheet_id)
-                                all_data_df_updated = all_data_df_to_delete[all_data_df_to_delete['user_id'] != user_id]
-                                if write_data('data', data_sheet_id, all_data_df_updated):
+                        user_record = user_store.get(user_id)
+                        if user_record is not None and get_password_hash_pool().check_password(password_for_delete, user_record['password_hash']):
+                            if user_store.delete(user_id):
+                                # このユーザーの行だけを削除する（他ユーザーの行は書き直さない）
+                                if delete_user_data('data', data_sheet_id, [user_id]) and delete_user_data('metrics', data_sheet_id, [user_id]):
                                     for key in list(st.session_state.keys()):
                                         del st.session_state[key]
                                     st.success("アカウントと関連する全てのデータを削除しました。")